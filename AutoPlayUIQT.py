@@ -14,7 +14,34 @@ import os
 import sys
 import time
 import shutil
+import argparse
+import cProfile
+import functools
+import gc
+import heapq
+import hmac
+import importlib.metadata
+import io
+import ipaddress
+import json
+import mmap
+import multiprocessing as mp
+import platform
+import pstats
+import queue
+import secrets
+import statistics
+import struct
 import threading
+import tracemalloc
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import dropwhile, islice
 from time import perf_counter
 
 # ---- Qt 高 DPI：先設環境變數再 import Qt ----
@@ -22,18 +49,18 @@ os.environ.setdefault("QT_ENABLE_HIGHDPI_SCALING", "1")
 os.environ.setdefault("QT_AUTO_SCREEN_SCALE_FACTOR", "1")
 
 import mido
-from pynput.keyboard import Controller, KeyCode
+from pynput.keyboard import Controller, Key, KeyCode, GlobalHotKeys, HotKey, Listener
 
-from PySide6.QtCore import Qt, QObject, Signal, Slot, QThread, QSettings
-from PySide6.QtGui import QFont, QPalette, QColor
+from PySide6.QtCore import Qt, QObject, Signal, Slot, QThread, QSettings, QCoreApplication, QTimer, QRectF
+from PySide6.QtGui import QFont, QPalette, QColor, QPainter
 from PySide6.QtWidgets import (
-    QApplication, QMainWindow, QWidget,
+    QApplication, QMainWindow, QWidget, QDialog, QDialogButtonBox, QFormLayout,
     QVBoxLayout, QHBoxLayout, QGridLayout,
     QGroupBox, QLabel, QLineEdit, QPushButton,
     QFileDialog, QMessageBox, QSplitter,
     QListWidget, QListWidgetItem, QAbstractItemView,
-    QCheckBox, QSpinBox, QDoubleSpinBox,
-    QPlainTextEdit, QStatusBar, QGraphicsDropShadowEffect,QStyle,QSizePolicy
+    QCheckBox, QSpinBox, QDoubleSpinBox, QComboBox,
+    QPlainTextEdit, QStatusBar, QGraphicsDropShadowEffect,QStyle,QSizePolicy, QProgressBar
 )
 
 # ====== 你的鍵盤對照表（依你圖片）======
@@ -48,6 +75,228 @@ MIDI_TO_KEY = {
     42:'0', 43:'p', 44:'-', 45:'[', 46:'=', 47:'j',
 }
 
+# ---- 等待策略 ----
+# 長等待掛在 Condition 上（停止 / 暫停會立刻喚醒），
+# 剩下 WAIT_COARSE_MARGIN 內改用短 sleep 切片，最後 WAIT_SPIN_MARGIN 內忙等。
+WAIT_COARSE_MARGIN = 0.020   # Condition.wait 在 Windows 可能晚醒 ~15ms，預留給它
+WAIT_SPIN_MARGIN = 0.002
+WAIT_SLICE = 0.001           # 細等待每片上限 = 停止延遲上限
+
+# ---- 播放卡頓看門狗：送鍵落後排程超過門檻 = 卡頓（GC、磁碟 I/O、系統負載把播放 thread 排開）----
+STALL_POLICIES = {"skip": "跳過漏掉的按鍵", "catchup": "補送漏掉的按鍵", "release": "先放開所有鍵再跳過"}
+STALL_POLL_RANGE = (0.005, 0.05)   # 看門狗輪詢間隔 = 門檻 / 4，限制在這個範圍內
+
+# ---- 全域快捷鍵（pynput 格式，例：<f9>、<ctrl>+<alt>+p）----
+HOTKEY_ACTIONS = ("start", "stop", "pause", "next")
+HOTKEY_LABELS = {"start": "開始 / 繼續", "stop": "停止", "pause": "暫停 / 繼續", "next": "下一首"}
+DEFAULT_HOTKEYS = {"start": "<f9>", "stop": "<f10>", "pause": "<f11>", "next": "<f12>"}
+
+# ---- 效能分析（預設關閉；環境變數 AUTOPLAY_PROFILE、--profile 或 UI 勾選開啟）----
+PROFILE_ENV = "AUTOPLAY_PROFILE"
+PROFILE_MODES = ("timers", "gc", "cprofile", "tracemalloc")
+PROFILE_DIR = "profiles"          # 報告寫到程式所在資料夾底下
+PROFILE_TOP = 30                  # cProfile / tracemalloc 各列前 N 項
+
+def parse_profile_modes(spec: str) -> set:
+    """'1' / 'on' = 計時 + GC；'all' = 全部；或逗號列出 timers,gc,cprofile,tracemalloc。"""
+    spec = (spec or "").strip().lower()
+    if spec in ("", "0", "off", "no", "false"):
+        return set()
+    if spec in ("1", "on", "yes", "true"):
+        return {"timers", "gc"}
+    if spec == "all":
+        return set(PROFILE_MODES)
+    modes = {m.strip() for m in spec.split(",") if m.strip()}
+    unknown = modes - set(PROFILE_MODES)
+    if unknown:
+        raise ValueError(f"未知的分析模式：{', '.join(sorted(unknown))}（可用：{', '.join(PROFILE_MODES)}）")
+    return modes | {"timers"}
+
+class Profiler:
+    """分段計時（wall / CPU）、GC 暫停統計，選用 cProfile / tracemalloc。關閉時只多一次屬性判斷。"""
+
+    def __init__(self):
+        self.enabled = False
+        self.modes = set()
+        self.playing = False      # 播放 thread 設定；播放中發生的 GC 另外計數
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.started_at = time.time()
+        self.stages = {}          # name -> [次數, wall 總和, wall 最大, CPU 總和]
+        self.gc_stats = {}        # generation -> [次數, 暫停總和, 暫停最大, 播放中次數]
+        self._gc_t0 = None
+        self._profiles = []
+
+    def enable(self, modes):
+        modes = set(modes)
+        if not modes:
+            self.disable()
+            return
+        self.modes = modes
+        self.enabled = True
+        if "gc" in modes and self._on_gc not in gc.callbacks:
+            gc.callbacks.append(self._on_gc)
+        if "tracemalloc" in modes and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+    def disable(self):
+        self.enabled = False
+        self.modes = set()
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _on_gc(self, phase: str, info: dict):
+        if phase == "start":
+            self._gc_t0 = perf_counter()
+            return
+        if self._gc_t0 is None:
+            return
+        dt = perf_counter() - self._gc_t0
+        self._gc_t0 = None
+        row = self.gc_stats.setdefault(info.get("generation", -1), [0, 0.0, 0.0, 0])
+        row[0] += 1
+        row[1] += dt
+        row[2] = max(row[2], dt)
+        if self.playing:
+            row[3] += 1
+
+    def _record(self, name: str, wall: float, cpu: float):
+        with self._lock:
+            row = self.stages.get(name)
+            if row is None:
+                row = self.stages[name] = [0, 0.0, 0.0, 0.0]
+            row[0] += 1
+            row[1] += wall
+            row[2] = max(row[2], wall)
+            row[3] += cpu
+
+    @contextmanager
+    def stage(self, name: str):
+        """量測一段程式碼（with 區塊）。"""
+        if not self.enabled:
+            yield
+            return
+        w0, c0 = perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self._record(name, perf_counter() - w0, time.thread_time() - c0)
+
+    def call(self, name: str, capture: bool, fn, args, kwargs):
+        """量測一次函式呼叫；capture=True 且開了 cprofile 時順便錄這次呼叫。"""
+        prof = None
+        if capture and "cprofile" in self.modes:
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:    # Python 3.12+ 同時只能有一個 profiler
+                prof = None
+        w0, c0 = perf_counter(), time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._record(name, perf_counter() - w0, time.thread_time() - c0)
+            if prof is not None:
+                prof.disable()
+                with self._lock:
+                    self._profiles.append(prof)
+
+    def has_data(self) -> bool:
+        return bool(self.stages or self.gc_stats or self._profiles)
+
+    def report(self, settings: dict | None = None) -> str:
+        """產生文字報告（給使用者回報用）。"""
+        now = time.time()
+        with self._lock:
+            stages = {k: list(v) for k, v in self.stages.items()}
+            profiles = list(self._profiles)
+        out = [
+            "MIDI AutoPlay 效能分析報告",
+            f"產生時間：{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))}",
+            f"統計區間：{now - self.started_at:.1f} 秒",
+            f"模式：{', '.join(m for m in PROFILE_MODES if m in self.modes)}",
+            f"Python：{sys.version.split()[0]}（{platform.python_implementation()}）",
+            f"平台：{platform.platform()}，CPU {os.cpu_count()} 核",
+        ]
+        for pkg in ("mido", "PySide6", "pynput"):
+            try:
+                out.append(f"{pkg}：{importlib.metadata.version(pkg)}")
+            except importlib.metadata.PackageNotFoundError:
+                out.append(f"{pkg}：?")
+        if settings:
+            shown = {k: v for k, v in settings.items() if k != "track_excluded"}
+            out.append(f"設定：{json.dumps(shown, ensure_ascii=False, sort_keys=True)}")
+
+        out += ["", "== 分段計時（ms）==",
+                f"{'階段':<32}{'次數':>8}{'wall 總計':>12}{'wall 平均':>12}{'wall 最大':>12}{'CPU 總計':>12}"]
+        for name, (n, wall, peak, cpu) in sorted(stages.items(), key=lambda kv: -kv[1][1]):
+            out.append(f"{name:<32}{n:>8}{wall * 1000:>12.2f}{wall / n * 1000:>12.3f}"
+                       f"{peak * 1000:>12.3f}{cpu * 1000:>12.2f}")
+
+        if "gc" in self.modes:
+            out += ["", "== GC 暫停 ==",
+                    f"{'世代':<8}{'次數':>8}{'總計 ms':>12}{'最大 ms':>12}{'播放中次數':>12}"]
+            for gen, (n, total, peak, during) in sorted(self.gc_stats.items()):
+                out.append(f"{gen:<8}{n:>8}{total * 1000:>12.3f}{peak * 1000:>12.3f}{during:>12}")
+            out.append(f"門檻：{gc.get_threshold()}，目前計數：{gc.get_count()}")
+
+        snap = METRICS.snapshot()
+        out += ["", "== 播放延遲（最近事件）==",
+                f"事件數：{snap['events_dispatched']}，播放 thread CPU：{snap['playback_thread_cpu_seconds']:.3f} 秒",
+                "lateness：" + "、".join(f"{k} {v * 1000:.3f} ms" for k, v in snap["lateness_seconds"].items())]
+
+        if "tracemalloc" in self.modes and tracemalloc.is_tracing():
+            cur, peak = tracemalloc.get_traced_memory()
+            out += ["", "== 記憶體（tracemalloc）==",
+                    f"目前 {cur / 1024:.1f} KiB，峰值 {peak / 1024:.1f} KiB"]
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP]:
+                out.append(str(stat))
+
+        if profiles:
+            buf = io.StringIO()
+            stats = pstats.Stats(profiles[0], stream=buf)
+            for prof in profiles[1:]:
+                stats.add(prof)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+            out += ["", f"== cProfile（播放 thread，{len(profiles)} 首，依累計時間）==", buf.getvalue().rstrip()]
+        return "\n".join(out) + "\n"
+
+    def dump(self, settings: dict | None = None, folder: str | None = None) -> str:
+        """寫出帶時間戳的報告並清空累計資料，回傳檔案路徑。"""
+        if folder is None:
+            try:
+                folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), PROFILE_DIR)
+            except Exception:
+                folder = os.path.join(os.getcwd(), PROFILE_DIR)
+        os.makedirs(folder, exist_ok=True)
+        text = self.report(settings)
+        path = unique_dest_path(folder, time.strftime("autoplay-profile-%Y%m%d-%H%M%S.txt"))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        with self._lock:
+            self._reset()
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces()
+        return path
+
+PROFILER = Profiler()
+
+def profiled(name: str, capture: bool = False):
+    """裝飾器：把函式計入 PROFILER 的 name 階段。"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            return PROFILER.call(name, capture, fn, args, kwargs)
+        return wrapper
+    return deco
+
+@profiled("analysis.build_timed_events")
 def build_timed_events(mid: "mido.MidiFile"):
     """把 MIDI 合併成一條時間序列（秒），支援 tempo 變化。回傳 [(t_sec, msg), ...]"""
     ticks_per_beat = mid.ticks_per_beat
@@ -65,6 +314,7 @@ def build_timed_events(mid: "mido.MidiFile"):
             tempo = msg.tempo
     return events
 
+@profiled("analysis.pick_best_transpose")
 def pick_best_transpose(timed, mapping, candidates=(-36, -24, -12, 0, 12, 24, 36)):
     """掃描 note_on，找在候選移調中命中 mapping 最多的 transpose。"""
     notes = []
@@ -86,6 +336,1396 @@ def pick_best_transpose(timed, mapping, candidates=(-36, -24, -12, 0, 12, 24, 36
             best_tr = tr
     return best_tr, best_hit, total
 
+@profiled("analysis.pick_best_transpose")
+def pick_best_transpose_hist(hist, mapping, candidates=(-36, -24, -12, 0, 12, 24, 36)):
+    """同 pick_best_transpose，但輸入是音高直方圖（128 格），不用走過整首事件。"""
+    total = sum(hist)
+    if not total:
+        return 0, 0, 0
+    best_tr, best_hit = 0, -1
+    for tr in candidates:
+        hit = sum(c for n, c in enumerate(hist) if c and (n + tr) in mapping)
+        if hit > best_hit:
+            best_hit = hit
+            best_tr = tr
+    return best_tr, best_hit, total
+
+def pick_velocity_threshold(hist, duration: float, mode: str, rate: float = 0.0, share: int = 100, floor: int = 1):
+    """依力度直方圖（128 格）自動選 velocity 門檻，從 floor（手動門檻）往上調：
+    rate = 平均每秒音符數壓到 rate 以下；share = 至少保留 share% 的音符。
+    兩種模式都至少保留 VELOCITY_AUTO_MIN_SHARE 的音符（share 設更低也一樣），達不到目標就停在那裡。
+    回傳 (門檻, 保留音符數, 總音符數)。"""
+    total = sum(hist)
+    th = max(1, floor)
+    kept = sum(hist[th:])
+    need = total * VELOCITY_AUTO_MIN_SHARE
+    if mode == "share":
+        need = max(need, total * share / 100)
+    elif mode == "rate" and duration > 0:
+        if kept <= rate * duration:
+            return th, kept, total
+    else:
+        return th, kept, total
+    for v in range(th, 127):
+        if not hist[v]:
+            continue
+        if kept - hist[v] < need:
+            break
+        kept -= hist[v]
+        th = v + 1               # 只跨過真的有音符的力度：門檻停在剛好省略這一層的位置
+        if mode == "rate" and kept <= rate * duration:
+            break
+    return th, kept, total
+
+def decode_meta_text(raw: bytes) -> str:
+    """MIDI 文字事件（音軌名…）沒有規定編碼：能當 UTF-8 解就用 UTF-8（精簡版就是這樣寫的），不然照 latin-1。"""
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("latin1")
+
+# ---- 音軌 / 聲道索引 ----
+DRUM_CHANNEL = 9          # MIDI 第 10 聲道（0-based 9）= 打擊樂
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+MIDI_INDEX_CACHE_SIZE = 8
+
+# ---- 自動力度門檻 ----
+VELOCITY_MODES = {"fixed": "固定門檻", "rate": "限制每秒音符數", "share": "保留一定比例"}
+VELOCITY_AUTO_MIN_SHARE = 0.5     # 自動門檻（兩種模式）最多丟掉一半的音符
+
+# ---- 串流播放（大檔）----
+STREAM_THRESHOLD_BYTES = 2 * 1024 * 1024   # 超過這個大小自動用串流模式
+STREAM_CHUNK = 256                         # producer 一次放進 buffer 的事件數
+STREAM_BUFFER_CHUNKS = 16                  # lookahead 上限 = 16 × 256 事件
+STREAM_PREBUFFER_CHUNKS = 2                # 開播前至少預先解析的量
+STREAM_INDEX_PREVIEW_NOTES = 4096          # 完整索引在背景建好之前，先用開頭這麼多個音符估計移調 / 力度門檻
+
+# ---- 播放指標（本機 HTTP：/metrics = Prometheus 文字格式，/metrics.json = JSON）----
+METRICS_HOST_DEFAULT = "127.0.0.1"
+METRICS_PORT_DEFAULT = 8765
+METRICS_LATENESS_SAMPLES = 2048   # 延遲百分位取最近 N 個事件
+METRICS_RATE_WINDOW = 5.0         # events/sec 以最近 N 秒計算
+
+# ---- 本機控制 API（HTTP + JSON，/api/events 為 Server-Sent Events）----
+API_HOST_DEFAULT = "127.0.0.1"
+API_PORT_DEFAULT = 8766
+API_TOKEN_BYTES = 16        # 第一次開啟 API 時自動產生的 token 長度
+API_PROGRESS_INTERVAL = 0.25      # /api/events 進度事件最快 4 Hz
+API_SUBSCRIBER_BACKLOG = 256
+
+# ---- 送鍵延遲校準 ----
+CALIBRATION_SAMPLES = 40
+CALIBRATION_TIMEOUT = 0.25        # loopback 等不到事件就改用呼叫耗時
+CALIBRATION_GAP = 0.01
+CALIBRATION_PROBE = "f20"         # 用鍵盤上幾乎不存在的 F20 當探測鍵，避免干擾遊戲
+
+# ---- 獨立播放程序 ----
+ISOLATE_START_TIMEOUT = 20.0      # spawn 子程序（要重新 import PySide6）最久等這麼久
+ISOLATE_POLL = 0.05               # parent 等回報的輪詢間隔（只影響 UI 更新，不影響時序）
+ISOLATE_REPORT_BATCH = 64         # 子程序累積 N 個事件才送一次回報（或進入長等待時）
+
+# ---- 鍵盤配置：內建 = MIDI_TO_KEY；其他樂器 / 自訂配置放在程式旁的 keymaps/*.json ----
+#   {"name": "我的配置", "keys": {"C4": "q", "61": "2", ...}}
+KEYMAP_DIR = "keymaps"
+KEYMAP_DEFAULT = "default"
+TRANSPOSE_CANDIDATES = (-36, -24, -12, 0, 12, 24, 36)
+
+# ---- MIDI 庫搜尋 ----
+LIBRARY_CACHE_FILE = "library_cache.json"   # 時長 / 音高分布快取（依 mtime + 大小失效）
+LIBRARY_META_BATCH = 20                     # 背景分析每 N 首回報一次 UI
+LIBRARY_SCAN_BATCH = 500                    # 背景掃描最多累積 N 首就送進清單
+LIBRARY_SCAN_FLUSH = 0.1                    # …或距上次送出超過 N 秒（慢速 / 網路磁碟也能邊掃邊看）
+LIBRARY_ROOT_SEP = ";"                      # 「資料夾」欄可放多個根目錄
+MIDI_EXTS = (".mid", ".midi")
+
+# ---- 播放中的省效能 UI ----
+UI_PERF_FLUSH_MS = 250      # 播放中 log / 狀態列最多每 N ms 更新一次
+UI_LOG_MAX_LINES = 5000     # log 視窗保留的行數上限
+UI_PROGRESS_MS = 100        # 播放進度輪詢間隔（讀播放時鐘，不靠逐事件 signal）
+
+# ---- 鋼琴捲簾預覽 ----
+PIANO_ROLL_FPS = 30                 # 跟隨播放游標的重畫上限
+PIANO_ROLL_SPAN = (2.0, 30.0)       # 可視時間範圍（秒）的縮放上下限
+PIANO_ROLL_COLORS = ("#4C8BF5", "#E5534B", "#F0A020", "#9AA0A6")   # 送出 / 沒有對應鍵 / 和弦上限省略 / 力度不足
+
+# 播放設定預設值（UI 預設與無視窗的服務模式共用）
+DEFAULT_SETTINGS = dict(
+    transpose=0,
+    auto_transpose=True,
+    velocity=1,
+    countdown=3.0,
+    release_all_at_end=True,
+    auto_next=True,
+    loop_playlist=True,
+    track_excluded={},
+    stream=False,
+    key_backend="pynput",
+    latency_comp=True,
+    press_lead=0.0,      # 秒；校準後提早送出 press 的量
+    release_lead=0.0,
+    keymap=KEYMAP_DEFAULT,   # 鍵盤配置名稱（keymaps/*.json）
+    isolate=False,       # 在獨立的高優先權子程序播放
+    isolate_cpus="",     # 子程序綁定的 CPU，例如 "2,3"；空 = 不限制
+    frame_hz=0,          # 送鍵對齊到遊戲幀（60 / 120 ...）；0 = 不對齊
+    max_chord=0,         # 同一時間最多按幾個鍵（高音優先，其餘省略）；0 = 不限
+    velocity_mode="fixed",  # 力度門檻怎麼定，見 VELOCITY_MODES；自動模式下 velocity 是下限
+    velocity_rate=12.0,  # rate 模式：平均每秒最多幾個音符
+    velocity_share=90,   # share 模式：至少保留幾 % 的音符
+    stall_ms=100,        # 送鍵落後排程超過這麼多就算卡頓；0 = 不偵測
+    stall_policy="skip", # 卡頓時怎麼處理落後的按鍵，見 STALL_POLICIES
+)
+
+# 播放中改了會立即套用（重建目前位置之後的排程），其餘設定下一首起生效
+LIVE_SETTINGS = ("transpose", "auto_transpose", "velocity", "keymap", "max_chord",
+                 "velocity_mode", "velocity_rate", "velocity_share")
+
+# 布林設定接受的字串（API / --set 傳進來的可能是字串）；其他值一律報錯，不用 bool() 猜
+BOOL_STRINGS = {"true": True, "1": True, "false": False, "0": False}
+
+# 串流解析出的音符；欄位與 mido.Message 同名，播放 / 移調程式碼可以共用
+StreamNote = namedtuple("StreamNote", "type channel note velocity")
+
+def fmt_time(sec: float) -> str:
+    """秒數 → m:ss。"""
+    sec = max(0, int(sec))
+    return f"{sec // 60}:{sec % 60:02d}"
+
+def note_name(n: int) -> str:
+    """MIDI 音高 → 音名（60 = C4）。"""
+    return f"{NOTE_NAMES[n % 12]}{n // 12 - 1}"
+
+def parse_note(spec) -> int:
+    """60 / "60" / "C4" / "C#4" / "Db4" → MIDI 音高。"""
+    text = str(spec).strip()
+    if text.lstrip("-").isdigit():
+        n = int(text)
+    else:
+        name = text.rstrip("-0123456789")
+        octave = text[len(name):]
+        flats = {"DB": "C#", "EB": "D#", "GB": "F#", "AB": "G#", "BB": "A#"}
+        name = flats.get(name.upper(), name.upper())
+        if name not in NOTE_NAMES or not octave.lstrip("-").isdigit():
+            raise ValueError(f"無法解析音名：{spec}")
+        n = (int(octave) + 1) * 12 + NOTE_NAMES.index(name)
+    if not 0 <= n < 128:
+        raise ValueError(f"音高超出範圍：{spec}")
+    return n
+
+# ---- 鍵盤配置（keymap profile）----
+class KeymapProfile:
+    """一組鍵盤配置：MIDI 音高 → 按鍵，編譯成 128 格查表（沒有對應 = None）。"""
+
+    def __init__(self, name: str, mapping: dict, path: str = ""):
+        self.name = name
+        self.path = path
+        self.mapping = {int(n): k for n, k in mapping.items()}
+        self.table = tuple(self.mapping.get(n) for n in range(128))
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def keys(self) -> set:
+        return set(self.mapping.values())
+
+    @classmethod
+    def from_file(cls, path: str) -> "KeymapProfile":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        raw = data.get("keys") if isinstance(data, dict) else None
+        if not isinstance(raw, dict) or not raw:
+            raise ValueError("缺少 keys 對照表")
+        mapping = {}
+        for note, key in raw.items():
+            n = parse_note(note)
+            if not (isinstance(key, str) and len(key) == 1 and key.isascii() and key.isprintable()):
+                raise ValueError(f"{note} 的按鍵必須是單一 ASCII 字元：{key!r}")
+            mapping[n] = key.lower()
+        name = str(data.get("name") or os.path.splitext(os.path.basename(path))[0])
+        return cls(name, mapping, path)
+
+KEYMAPS = {KEYMAP_DEFAULT: KeymapProfile(KEYMAP_DEFAULT, MIDI_TO_KEY)}
+
+def keymap_dir() -> str:
+    try:
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), KEYMAP_DIR)
+    except Exception:
+        return os.path.join(os.getcwd(), KEYMAP_DIR)
+
+def reload_keymaps(folder: str | None = None) -> list[str]:
+    """重新讀取 keymaps/*.json（內建配置永遠保留）；回傳錯誤訊息清單。"""
+    folder = folder or keymap_dir()
+    profiles = {KEYMAP_DEFAULT: KEYMAPS[KEYMAP_DEFAULT]}
+    errors = []
+    try:
+        names = sorted(fn for fn in os.listdir(folder) if fn.lower().endswith(".json"))
+    except FileNotFoundError:
+        names = []
+    for fn in names:
+        path = os.path.join(folder, fn)
+        try:
+            prof = KeymapProfile.from_file(path)
+        except (OSError, ValueError) as e:    # json.JSONDecodeError 也是 ValueError
+            errors.append(f"{fn}：{e}")
+            continue
+        if prof.name in profiles:
+            errors.append(f"{fn}：名稱重複「{prof.name}」")
+            continue
+        profiles[prof.name] = prof
+    KEYMAPS.clear()
+    KEYMAPS.update(profiles)
+    return errors
+
+def get_keymap(name: str) -> KeymapProfile:
+    """依名稱取配置；找不到就用內建。"""
+    return KEYMAPS.get(name) or KEYMAPS[KEYMAP_DEFAULT]
+
+def all_keymap_keys() -> set:
+    """所有配置會用到的按鍵（快捷鍵不能和它們衝突）。"""
+    keys = set()
+    for prof in KEYMAPS.values():
+        keys |= prof.keys()
+    return keys
+
+@profiled("analysis.score_keymaps")
+def score_keymaps(hist, profiles=None, candidates=TRANSPOSE_CANDIDATES) -> list:
+    """一次算完「每個配置 × 每個移調」能彈到的音符數。
+    回傳 [(hit, total, 配置名稱, transpose), ...]，最好的在前（同分時偏好移調小的）。"""
+    profiles = list(KEYMAPS.values()) if profiles is None else list(profiles)
+    used = [(n, c) for n, c in enumerate(hist) if c]
+    total = sum(c for _, c in used)
+    rows = []
+    for prof in profiles:
+        table = prof.table
+        for tr in candidates:
+            hit = sum(c for n, c in used if 0 <= n + tr < 128 and table[n + tr] is not None)
+            rows.append((hit, total, prof.name, tr))
+    rows.sort(key=lambda r: (-r[0], abs(r[3])))
+    return rows
+
+def build_tempo_map(mid: "mido.MidiFile"):
+    """從所有音軌收集 set_tempo，回傳 [(tick, sec, tempo), ...]（tick 遞增）。"""
+    changes = []
+    for track in mid.tracks:
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if msg.type == "set_tempo":
+                changes.append((tick, msg.tempo))
+    changes.sort(key=lambda c: c[0])   # stable：同 tick 保留音軌順序，後者生效
+
+    tpb = mid.ticks_per_beat
+    tmap = [(0, 0.0, 500000)]  # default 120 BPM
+    for tick, tempo in changes:
+        last_tick, last_sec, last_tempo = tmap[-1]
+        sec = last_sec + mido.tick2second(tick - last_tick, tpb, last_tempo)
+        if tick == last_tick:
+            tmap[-1] = (tick, sec, tempo)
+        else:
+            tmap.append((tick, sec, tempo))
+    return tmap
+
+def tick_to_sec(tmap, ticks_per_beat: int, tick: int) -> float:
+    i = bisect_right(tmap, (tick, float("inf"))) - 1
+    seg_tick, seg_sec, tempo = tmap[max(i, 0)]
+    return seg_sec + mido.tick2second(tick - seg_tick, ticks_per_beat, tempo)
+
+def sec_to_tick(tmap, ticks_per_beat: int, sec: float) -> float:
+    i = bisect_right(tmap, sec, key=lambda seg: seg[1]) - 1
+    seg_tick, seg_sec, tempo = tmap[max(i, 0)]
+    return seg_tick + (sec - seg_sec) * 1e6 * ticks_per_beat / tempo
+
+class MidiIndex:
+    """單一 MIDI 的音符索引：依 (track, channel) 分組，每組有音符數、音域與音高 / 力度直方圖。
+    勾選改變時直接從索引重建 schedule，不用重新讀檔。
+    大檔（streamed=True）只保留統計，不保留事件；播放改走串流。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ticks_per_beat = 480
+        self.n_tracks = 0
+        self.tempo_map = [(0, 0.0, 500000)]
+        self.time_signatures = [(0, 4, 4)]   # [(tick, 分子, 分母), ...]；串流大檔一律當 4/4
+        self.groups: dict[tuple[int, int], dict] = {}
+        self.duration = 0.0
+        self.streamed = False
+        self.partial = False      # 只掃了開頭（from_stream max_notes），統計與長度都不完整
+
+    def _group(self, ti: int, ch: int) -> dict:
+        g = self.groups.get((ti, ch))
+        if g is None:
+            g = self.groups[(ti, ch)] = dict(track=ti, channel=ch, name="", count=0,
+                                             lo=127, hi=0, pitches=[0] * 128,
+                                             velocities=[0] * 128, events=[])
+        return g
+
+    @staticmethod
+    def _count_note(g: dict, note: int, velocity: int):
+        g["count"] += 1
+        g["pitches"][note] += 1
+        g["velocities"][velocity] += 1
+        if note < g["lo"]:
+            g["lo"] = note
+        if note > g["hi"]:
+            g["hi"] = note
+
+    @classmethod
+    def from_midi(cls, path: str, mid: "mido.MidiFile") -> "MidiIndex":
+        self = cls(path)
+        self.ticks_per_beat = mid.ticks_per_beat
+        self.n_tracks = len(mid.tracks)
+        self.tempo_map = build_tempo_map(mid)
+
+        tpb = self.ticks_per_beat
+        sigs = []
+        for ti, track in enumerate(mid.tracks):
+            name = ""
+            tick = 0
+            for j, msg in enumerate(track):
+                tick += msg.time
+                if msg.type == "track_name" and not name:
+                    name = decode_meta_text(msg.name.encode("latin1", "replace")).strip()
+                    continue
+                if msg.type == "time_signature":
+                    sigs.append((tick, msg.numerator, msg.denominator))
+                    continue
+                if msg.type not in ("note_on", "note_off"):
+                    continue
+                g = self._group(ti, msg.channel)
+                t_sec = tick_to_sec(self.tempo_map, tpb, tick)
+                # (t_sec, (tick, track, 位置)) 排序與 mido.merge_tracks 一致
+                g["events"].append((t_sec, (tick, ti, j), msg))
+                if msg.type == "note_on" and msg.velocity > 0:
+                    self._count_note(g, msg.note, msg.velocity)
+                if t_sec > self.duration:
+                    self.duration = t_sec
+            for (gt, _), g in self.groups.items():
+                if gt == ti:
+                    g["name"] = name
+        sigs.sort(key=lambda s: s[0])   # stable：同 tick 後者生效
+        for sig in sigs:
+            if sig[0] == self.time_signatures[-1][0]:
+                self.time_signatures[-1] = sig
+            else:
+                self.time_signatures.append(sig)
+        return self
+
+    @classmethod
+    def from_stream(cls, path: str, max_notes: int = 0) -> "MidiIndex":
+        """掃一遍檔案只收統計（記憶體與檔案大小無關）。max_notes > 0：看到這麼多個音符就停（partial）。"""
+        self = cls(path)
+        self.streamed = True
+        names = {}
+        notes = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self.ticks_per_beat, spans = read_smf_layout(buf)
+            self.n_tracks = len(spans)
+            for t_sec, ti, ev in iter_smf_merged(buf, self.ticks_per_beat, spans, tempo_map=self.tempo_map):
+                if type(ev) is str:
+                    names.setdefault(ti, ev)
+                    continue
+                g = self._group(ti, ev.channel)
+                self.duration = t_sec
+                if ev.type == "note_on" and ev.velocity > 0:
+                    self._count_note(g, ev.note, ev.velocity)
+                    notes += 1
+                    if notes == max_notes:
+                        self.partial = True
+                        break
+        for (ti, _), g in self.groups.items():
+            g["name"] = names.get(ti, "")
+        return self
+
+    def note_count(self) -> int:
+        return sum(g["count"] for g in self.groups.values())
+
+    def group_keys(self) -> list[tuple[int, int]]:
+        return sorted(self.groups)
+
+    def describe(self, key) -> str:
+        g = self.groups[key]
+        label = g["name"] or f"Track {g['track'] + 1}"
+        if g["channel"] == DRUM_CHANNEL:
+            label += "（鼓）"
+        if not g["count"]:
+            return f"T{g['track'] + 1} · ch{g['channel'] + 1} · {label}  —  0 音 · —"
+        rng = f"{note_name(g['lo'])}–{note_name(g['hi'])}"
+        vel = [v for v, c in enumerate(g["velocities"]) if c]
+        return (f"T{g['track'] + 1} · ch{g['channel'] + 1} · {label}  —  {g['count']} 音 · {rng}"
+                f" · 力度 {vel[0]}–{vel[-1]}")
+
+    def bar_beat(self, t_sec: float) -> tuple[int, int]:
+        """播放位置 → (小節, 拍)，都從 1 起算；拍號改變時從新的小節開始數。"""
+        tick = sec_to_tick(self.tempo_map, self.ticks_per_beat, max(0.0, t_sec))
+        sigs = self.time_signatures
+        bar = 0
+        for i, (sig_tick, num, den) in enumerate(sigs):
+            beat_ticks = self.ticks_per_beat * 4 / den
+            if i + 1 < len(sigs) and tick >= sigs[i + 1][0]:
+                bar += -(-(sigs[i + 1][0] - sig_tick) // (beat_ticks * num))   # 不完整的小節也算一個
+                continue
+            beats = int((tick - sig_tick) // beat_ticks)
+            return int(bar) + beats // num + 1, beats % num + 1
+        return 1, 1
+
+    def default_excluded(self) -> set:
+        """預設不播打擊樂聲道（partial 索引還不知道後面會出現哪些分組，每一軌的鼓聲道都先排除）。"""
+        drums = {k for k in self.groups if k[1] == DRUM_CHANNEL}
+        if self.partial:
+            drums |= {(ti, DRUM_CHANNEL) for ti in range(self.n_tracks)}
+        return drums
+
+    @profiled("analysis.schedule")
+    def schedule(self, excluded=()):
+        """合併選取的分組，回傳 [(t_sec, msg), ...]（與 build_timed_events 同格式，只含音符事件）。"""
+        lists = [g["events"] for k, g in self.groups.items() if k not in excluded]
+        return [(t, msg) for t, _, msg in heapq.merge(*lists, key=lambda e: (e[0], e[1]))]
+
+    def pitch_histogram(self, excluded=()) -> list[int]:
+        return self._histogram("pitches", excluded)
+
+    def velocity_histogram(self, excluded=()) -> list[int]:
+        return self._histogram("velocities", excluded)
+
+    def _histogram(self, field: str, excluded) -> list[int]:
+        hist = [0] * 128
+        for k, g in self.groups.items():
+            if k not in excluded:
+                for n, c in enumerate(g[field]):
+                    hist[n] += c
+        return hist
+
+    def velocity_threshold(self, settings: dict, excluded=()) -> tuple[int, int, int]:
+        """依 settings 的 velocity_mode 算出這首（勾選的分組）要用的力度門檻，見 pick_velocity_threshold。"""
+        return pick_velocity_threshold(self.velocity_histogram(excluded), self.duration,
+                                       settings.get("velocity_mode", "fixed"),
+                                       float(settings.get("velocity_rate", DEFAULT_SETTINGS["velocity_rate"])),
+                                       int(settings.get("velocity_share", DEFAULT_SETTINGS["velocity_share"])),
+                                       int(settings["velocity"]))
+
+# ---- 串流解析：mmap + 每軌 generator + heapq.merge，不建立整首的訊息列表 ----
+def _read_vlq(buf, pos: int):
+    value = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, pos
+
+def read_smf_layout(buf):
+    """讀 MThd，回傳 (ticks_per_beat, [(track 資料起點, 終點), ...])。"""
+    if buf[:4] != b"MThd":
+        raise OSError("MThd not found. Probably not a MIDI file")
+    hsize, _fmt, ntrks, division = struct.unpack(">LHHH", buf[4:14])
+    pos = 8 + hsize
+    spans = []
+    while len(spans) < ntrks and pos + 8 <= len(buf):
+        name, size = struct.unpack(">4sL", buf[pos:pos + 8])
+        pos += 8
+        if name == b"MTrk":
+            spans.append((pos, min(pos + size, len(buf))))
+        pos += size
+    return division, spans
+
+def iter_smf_track(buf, start: int, end: int, ti: int):
+    """逐一解碼單軌事件（running status 規則同 mido）。
+    產出 (tick, ti, 序號, 事件)：事件為 StreamNote、tempo(int) 或音軌名稱(str)。"""
+    pos = start
+    tick = 0
+    j = 0
+    last_status = None
+    while pos < end:
+        delta, pos = _read_vlq(buf, pos)
+        tick += delta
+        status = buf[pos]
+        if status < 0x80:
+            if last_status is None:
+                raise OSError("running status without last_status")
+            status = last_status
+        else:
+            pos += 1
+            if status != 0xFF:
+                last_status = status
+        j += 1
+
+        if status == 0xFF:
+            mtype = buf[pos]
+            length, pos = _read_vlq(buf, pos + 1)
+            if mtype == 0x51 and length == 3:
+                yield tick, ti, j, (buf[pos] << 16) | (buf[pos + 1] << 8) | buf[pos + 2]
+            elif mtype == 0x03:
+                yield tick, ti, j, decode_meta_text(bytes(buf[pos:pos + length])).strip()
+            pos += length
+            if mtype == 0x2F:
+                return
+        elif status in (0xF0, 0xF7):
+            length, pos = _read_vlq(buf, pos)
+            pos += length
+        else:
+            kind = status & 0xF0
+            if kind in (0xC0, 0xD0):
+                pos += 1
+                continue
+            d1, d2 = buf[pos], buf[pos + 1]
+            pos += 2
+            if kind == 0x90:
+                yield tick, ti, j, StreamNote("note_on", status & 0x0F, d1, d2)
+            elif kind == 0x80:
+                yield tick, ti, j, StreamNote("note_off", status & 0x0F, d1, d2)
+
+def iter_smf_merged(buf, ticks_per_beat: int, spans, tempo_map=None):
+    """合併所有音軌（順序同 mido.merge_tracks），產出 (t_sec, track, 事件)。
+    tempo_map 若給 list，會順便記錄 tempo 變化。"""
+    gens = [iter_smf_track(buf, a, b, ti) for ti, (a, b) in enumerate(spans)]
+    tempo = 500000
+    last_tick = 0
+    abs_sec = 0.0
+    for tick, ti, _, ev in heapq.merge(*gens, key=lambda e: (e[0], e[1], e[2])):
+        if tick != last_tick:
+            abs_sec += mido.tick2second(tick - last_tick, ticks_per_beat, tempo)
+            last_tick = tick
+        if type(ev) is int:
+            tempo = ev
+            if tempo_map is not None:
+                if tempo_map[-1][0] == tick:
+                    tempo_map[-1] = (tick, abs_sec, tempo)
+                else:
+                    tempo_map.append((tick, abs_sec, tempo))
+            continue
+        yield abs_sec, ti, ev
+
+def iter_stream_timed(path: str, excluded=()):
+    """串流版 schedule：lazy 產出 [(t_sec, StreamNote), ...]，只含勾選分組的音符。"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        tpb, spans = read_smf_layout(buf)
+        for t_sec, ti, ev in iter_smf_merged(buf, tpb, spans):
+            if type(ev) is StreamNote and (ti, ev.channel) not in excluded:
+                yield t_sec, ev
+
+class StreamBuffer:
+    """有上限的 lookahead buffer：producer thread 解析，播放 loop 消費；記憶體固定。"""
+
+    def __init__(self, source, stop_event: threading.Event,
+                 chunk: int = STREAM_CHUNK, max_chunks: int = STREAM_BUFFER_CHUNKS,
+                 prebuffer_chunks: int = STREAM_PREBUFFER_CHUNKS):
+        self._source = source
+        self._stop_event = stop_event
+        self._chunk = chunk
+        self._prebuffer = prebuffer_chunks
+        self._q = queue.Queue(maxsize=max_chunks)
+        self._closed = threading.Event()
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, name="midi-stream", daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._q.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        produced = 0
+        try:
+            chunk = []
+            for ev in self._source:
+                chunk.append(ev)
+                if len(chunk) >= self._chunk:
+                    if not self._put(chunk):
+                        return
+                    chunk = []
+                    produced += 1
+                    if produced >= self._prebuffer:
+                        self._ready.set()
+            if chunk:
+                self._put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._ready.set()
+            self._put(None)
+            try:
+                self._source.close()
+            except Exception:
+                pass
+
+    def wait_ready(self, timeout: float = 2.0) -> bool:
+        """等 prebuffer 填好（或整首已解析完）。"""
+        return self._ready.wait(timeout)
+
+    def __iter__(self):
+        while True:
+            try:
+                chunk = self._q.get(timeout=0.05)
+            except queue.Empty:
+                if self._stop_event.is_set() or self._closed.is_set():
+                    return
+                continue
+            if chunk is None:
+                if self._error:
+                    raise self._error
+                return
+            yield from chunk
+
+    def close(self):
+        self._closed.set()
+
+_midi_index_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_midi_index_lock = threading.Lock()
+_midi_index_loading: dict[str, threading.Event] = {}   # 正在分析的檔：其他 thread 等它，不重複解析
+
+def cached_midi_index(path: str) -> MidiIndex | None:
+    """只查快取，不解析：檔案沒變而且分析過才回傳。"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with _midi_index_lock:
+        hit = _midi_index_cache.get(path)
+        if hit and hit[0] == (st.st_mtime_ns, st.st_size):
+            _midi_index_cache.move_to_end(path)
+            return hit[1]
+    return None
+
+def peek_midi_index(path: str) -> MidiIndex | None:
+    """UI thread 用：小檔直接讀；大檔（串流）要掃整個檔，只回傳快取裡的，沒有就回 None（請在背景 load_midi_index）。"""
+    index = cached_midi_index(path)
+    if index is None and os.path.getsize(path) < STREAM_THRESHOLD_BYTES:
+        index = load_midi_index(path)
+    return index
+
+@profiled("analysis.load_midi_index")
+def load_midi_index(path: str, cache: bool = True) -> MidiIndex:
+    """讀取（或從快取取得）檔案索引；檔案 mtime/大小改變才重新解析。UI 與播放 thread 共用。
+    cache=False：不放進快取（整個資料夾批次分析時用，避免把正在用的項目擠掉）。"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _midi_index_lock:
+        hit = _midi_index_cache.get(path)
+        if hit and hit[0] == stamp:
+            _midi_index_cache.move_to_end(path)
+            return hit[1]
+        loading = _midi_index_loading.get(path) if cache else None
+        if cache and loading is None:
+            _midi_index_loading[path] = threading.Event()
+    if loading is not None:
+        loading.wait()                       # 別的 thread 正在分析同一個檔（例如播放中的背景分析 + 音軌清單）
+        return load_midi_index(path, cache)
+    try:
+        if st.st_size >= STREAM_THRESHOLD_BYTES:
+            with PROFILER.stage("analysis.index_stream"):
+                index = MidiIndex.from_stream(path)
+        else:
+            with PROFILER.stage("analysis.parse_midi"):
+                mid = mido.MidiFile(path)
+            with PROFILER.stage("analysis.index_build"):
+                index = MidiIndex.from_midi(path, mid)
+        if not cache:
+            return index
+        with _midi_index_lock:
+            _midi_index_cache[path] = (stamp, index)
+            _midi_index_cache.move_to_end(path)
+            while len(_midi_index_cache) > MIDI_INDEX_CACHE_SIZE:
+                _midi_index_cache.popitem(last=False)
+        return index
+    finally:
+        if cache:
+            with _midi_index_lock:
+                _midi_index_loading.pop(path).set()
+
+# ---- MIDI 庫搜尋索引 ----
+def fold_text(text: str) -> str:
+    """搜尋用正規化：NFKC（全形→半形、半形假名→全形）、不分大小寫、片假名→平假名、標點當空白。"""
+    out = []
+    for ch in unicodedata.normalize("NFKC", text).casefold():
+        o = ord(ch)
+        if 0x30A1 <= o <= 0x30F6:
+            ch = chr(o - 0x60)
+        elif not ch.isalnum():
+            ch = " "
+        out.append(ch)
+    return " ".join("".join(out).split())
+
+def _grams(token: str) -> set:
+    """單字 + 相鄰兩字（中日文沒有空白，用 2-gram 才找得到片段）。"""
+    return set(token) | {token[i:i + 2] for i in range(len(token) - 1)}
+
+class LibraryIndex:
+    """MIDI 庫的搜尋索引：檔名正規化後的 1/2-gram 倒排表，可增量加入 / 移除；
+    另外保存每首的時長與音高分布（背景分析），供「時長 / 可彈比例」篩選。"""
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._paths: list[str | None] = []   # id -> path（None = 已移除）
+        self._norm: list[str] = []
+        self._postings = defaultdict(set)    # gram -> {id}
+        self.meta: dict[str, tuple] = {}     # path -> (mtime_ns, size, duration, {note: count})
+        self.dirs: dict[str, tuple] = {}     # 資料夾 -> (mtime_ns, [MIDI 檔名], [子資料夾名])，見 scan_midi_tree
+        self._playable: dict[tuple, float] = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, path: str):
+        return path in self._ids
+
+    def add(self, path: str, label: str | None = None):
+        if path in self._ids:
+            return
+        i = len(self._paths)
+        norm = fold_text(os.path.splitext(label or os.path.basename(path))[0])
+        self._ids[path] = i
+        self._paths.append(path)
+        self._norm.append(norm)
+        for token in norm.split():
+            for g in _grams(token):
+                self._postings[g].add(i)
+
+    def remove(self, path: str):
+        i = self._ids.pop(path, None)
+        if i is None:
+            return
+        for token in self._norm[i].split():
+            for g in _grams(token):
+                self._postings[g].discard(i)
+        self._paths[i] = None
+        self._norm[i] = ""
+
+    def sync(self, paths):
+        """讓索引內容等於 paths（只處理差異）。"""
+        want = set(paths)
+        for p in [p for p in self._ids if p not in want]:
+            self.remove(p)
+        for p in paths:
+            self.add(p)
+
+    def _match_term(self, term: str) -> set:
+        grams = [term] if len(term) == 1 else [term[i:i + 2] for i in range(len(term) - 1)]
+        hits = None
+        for g in sorted(grams, key=lambda g: len(self._postings.get(g, ()))):
+            post = self._postings.get(g)
+            if not post:
+                return set()
+            hits = set(post) if hits is None else hits & post
+            if not hits:
+                return hits
+        # 2-gram 交集只是候選，確認整段字串真的出現
+        return {i for i in hits if term in self._norm[i]} if len(term) > 2 else hits
+
+    # ---- 背景分析的 metadata ----
+    def meta_stale(self, path: str) -> bool:
+        m = self.meta.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return m is None or (m[0], m[1]) != (st.st_mtime_ns, st.st_size)
+
+    def set_meta(self, path: str, stamp: tuple, duration: float, hist):
+        self.meta[path] = (stamp[0], stamp[1], float(duration),
+                           {n: c for n, c in enumerate(hist) if c})
+        for key in [k for k in self._playable if k[0] == path]:
+            del self._playable[key]
+
+    def playable(self, path: str, keymap: KeymapProfile) -> float | None:
+        """這首在指定配置（最佳移調）下可彈的比例；還沒分析過回傳 None。"""
+        key = (path, keymap.name)
+        if key in self._playable:
+            return self._playable[key]
+        m = self.meta.get(path)
+        if m is None:
+            return None
+        hist = [0] * 128
+        for n, c in m[3].items():
+            hist[int(n)] = c
+        hit, total, _, _ = score_keymaps(hist, [keymap])[0]
+        ratio = hit / total if total else 0.0
+        self._playable[key] = ratio
+        return ratio
+
+    def clear_playable(self):
+        self._playable.clear()
+
+    @profiled("ui.library_search")
+    def search(self, query: str = "", max_duration: float = 0.0, min_playable: float = 0.0,
+               keymap: KeymapProfile | None = None) -> set:
+        """回傳符合的路徑；所有詞都要出現（AND），篩選條件啟用時沒分析過的先不顯示。"""
+        ids = None
+        for term in fold_text(query).split():
+            hits = self._match_term(term)
+            ids = hits if ids is None else ids & hits
+            if not ids:
+                return set()
+        paths = set(self._ids) if ids is None else {self._paths[i] for i in ids}
+        if max_duration > 0:
+            paths = {p for p in paths if p in self.meta and self.meta[p][2] <= max_duration}
+        if min_playable > 0:
+            km = keymap or get_keymap(KEYMAP_DEFAULT)
+            paths = {p for p in paths if (self.playable(p, km) or 0.0) >= min_playable}
+        return paths
+
+    # ---- 快取檔 ----
+    def load_cache(self, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(data.get("meta"), dict):     # 舊版快取只有 meta（整個檔就是 path -> meta）
+            for d, e in (data.get("dirs") or {}).items():
+                try:
+                    self.dirs[d] = (int(e[0]), [str(n) for n in e[1]], [str(n) for n in e[2]])
+                except (TypeError, ValueError, IndexError):
+                    continue
+            data = data["meta"]
+        for p, m in data.items():
+            try:
+                self.meta[p] = (int(m[0]), int(m[1]), float(m[2]), {int(n): int(c) for n, c in m[3].items()})
+            except (TypeError, ValueError, IndexError, AttributeError):
+                continue
+
+    def save_cache(self, path: str):
+        meta = {p: [m[0], m[1], m[2], {str(n): c for n, c in m[3].items()}]
+                for p, m in self.meta.items() if os.path.exists(p)}
+        data = {"meta": meta, "dirs": {d: list(e) for d, e in self.dirs.items()}}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+def _path_under(path: str, root: str) -> bool:
+    """path（已 normcase）是不是在 root 底下（含子資料夾）。"""
+    root = os.path.normcase(os.path.normpath(root))
+    try:
+        return os.path.commonpath([path, root]) == root
+    except ValueError:          # 不同磁碟機
+        return False
+
+def scan_midi_tree(root: str, known: dict, found: dict, cancel: threading.Event | None = None):
+    """迭代式（不遞迴）os.scandir 走訪 root，依序 yield MIDI 路徑（資料夾內先檔案、再子資料夾，皆不分大小寫排序）。
+    known / found 是 {資料夾: (mtime_ns, [MIDI 檔名], [子資料夾名])}：mtime 跟 known 一樣的資料夾
+    直接沿用上次的清單、不再列舉（新增 / 刪除 / 改名都會更新資料夾 mtime），走過的都寫進 found。
+    不跟隨資料夾 symlink，避免繞圈。"""
+    stack = [os.path.normpath(root)]
+    while stack:
+        if cancel is not None and cancel.is_set():
+            return
+        d = stack.pop()
+        try:
+            mtime = os.stat(d).st_mtime_ns
+        except OSError:
+            continue
+        entry = known.get(d)
+        if entry is None or entry[0] != mtime:
+            files, subs = [], []
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        try:
+                            if e.is_dir(follow_symlinks=False):
+                                subs.append(e.name)
+                            elif e.name.lower().endswith(MIDI_EXTS) and e.is_file():
+                                files.append(e.name)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            files.sort(key=str.lower)
+            subs.sort(key=str.lower)
+            entry = (mtime, files, subs)
+        found[d] = entry
+        for name in entry[1]:
+            yield os.path.join(d, name)
+        stack.extend(os.path.join(d, name) for name in reversed(entry[2]))
+
+class PlayerMetrics:
+    """播放指標。只有播放 thread 寫入（不加鎖、不經 Qt），HTTP thread 讀快照。"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.state = "idle"           # idle | countdown | playing | paused
+        self.song = ""
+        self.position = 0.0
+        self.duration = 0.0
+        # 播放時鐘 (原點 perf_counter, 暫停時刻或 None)：整個 tuple 一次替換，讀的一方不用加鎖
+        self.clock = None
+        self.events_dispatched = 0
+        self.held_keys = 0
+        self.songs_completed = 0
+        self.songs_failed = 0
+        self.stalls = 0
+        self.stall_max = 0.0          # 最長一次卡頓落後幾秒（跨多次播放）
+        self.thread_cpu = 0.0         # 播放 thread 累計 CPU 秒數（跨多次播放；獨立播放時含子程序的播放 thread）
+        self.lateness_sum = 0.0       # 所有送出事件的延遲總和（summary 的 _sum；_count = events_dispatched）
+        self._cpu_mark = None
+        self._since = perf_counter()
+        # (dispatch 時的 perf_counter, 延遲秒數)；deque.append 本身是 thread-safe
+        self.samples = deque(maxlen=METRICS_LATENESS_SAMPLES)
+
+    # ---- 播放 thread 呼叫 ----
+    def thread_started(self):
+        self._cpu_mark = time.thread_time()
+        self._since = perf_counter()
+
+    def _tick_cpu(self):
+        if self._cpu_mark is not None:
+            now = time.thread_time()
+            self.thread_cpu += now - self._cpu_mark
+            self._cpu_mark = now
+
+    def child_cpu(self, seconds: float):
+        """獨立播放：子程序回報它的播放 thread 用掉的 CPU 秒數（parent 這邊大多在等，量不到）。"""
+        self.thread_cpu += seconds
+
+    def song_started(self, path: str, duration: float):
+        self.song = path
+        self.duration = duration
+        self.position = 0.0
+        self.clock = None
+        self.state = "countdown"
+
+    def dispatched(self, t_sec: float, lateness: float, held: int):
+        self.events_dispatched += 1
+        self.position = t_sec
+        self.held_keys = held
+        self.lateness_sum += lateness
+        self.samples.append((perf_counter(), lateness))
+        self._tick_cpu()
+
+    def stalled(self, late: float):
+        self.stalls += 1
+        if late > self.stall_max:
+            self.stall_max = late
+
+    def song_finished(self, ok: bool):
+        if ok:
+            self.songs_completed += 1
+        else:
+            self.songs_failed += 1
+
+    def thread_finished(self):
+        self._tick_cpu()
+        self._cpu_mark = None
+        self.state = "idle"
+        self.clock = None
+        self.held_keys = 0
+
+    # ---- 任何 thread ----
+    def live_position(self) -> float:
+        """依播放時鐘推算目前位置（秒；倒數中為負），不用等下一個事件。"""
+        clock = self.clock
+        if clock is None:
+            return self.position
+        t0, paused_at = clock
+        return (paused_at if paused_at is not None else perf_counter()) - t0
+
+    # ---- HTTP thread 呼叫 ----
+    def snapshot(self) -> dict:
+        samples = list(self.samples)
+        now = perf_counter()
+        recent = [t for t, _ in samples if now - t <= METRICS_RATE_WINDOW]
+        if recent and len(recent) == len(samples) == self.samples.maxlen:
+            # ring 已滿且都在窗口內：用實際時間跨度估計
+            span = now - recent[0]
+        else:
+            span = min(METRICS_RATE_WINDOW, now - self._since)
+        rate = len(recent) / max(span, 1e-3)
+        late = sorted(l for _, l in samples)
+
+        def pct(q):
+            if not late:
+                return 0.0
+            return late[min(len(late) - 1, int(q * len(late)))]
+
+        return dict(
+            state=self.state,
+            song=self.song,
+            position_seconds=round(self.position, 3),
+            duration_seconds=round(self.duration, 3),
+            events_dispatched=self.events_dispatched,
+            events_per_second=round(rate, 2),
+            lateness_seconds={"p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99),
+                              "max": late[-1] if late else 0.0},
+            lateness_sum_seconds=round(self.lateness_sum, 6),
+            playback_thread_cpu_seconds=round(self.thread_cpu, 4),
+            held_keys=self.held_keys,
+            stalls=self.stalls,
+            stall_max_seconds=round(self.stall_max, 4),
+            songs_completed=self.songs_completed,
+            songs_failed=self.songs_failed,
+            uptime_seconds=round(time.time() - self.started_at, 1),
+        )
+
+    def prometheus(self) -> str:
+        snap = self.snapshot()
+
+        def esc(v: str) -> str:
+            return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        out = [
+            "# TYPE autoplay_info gauge",
+            f'autoplay_info{{state="{snap["state"]}",song="{esc(os.path.basename(snap["song"]))}"}} 1',
+            "# TYPE autoplay_position_seconds gauge",
+            f"autoplay_position_seconds {snap['position_seconds']}",
+            "# TYPE autoplay_song_duration_seconds gauge",
+            f"autoplay_song_duration_seconds {snap['duration_seconds']}",
+            "# TYPE autoplay_events_dispatched_total counter",
+            f"autoplay_events_dispatched_total {snap['events_dispatched']}",
+            "# TYPE autoplay_events_per_second gauge",
+            f"autoplay_events_per_second {snap['events_per_second']}",
+            "# TYPE autoplay_lateness_seconds summary",
+        ]
+        # 百分位取最近 METRICS_LATENESS_SAMPLES 個事件；_sum / _count 是累計值
+        for q, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"), ("1", "max")):
+            out.append(f'autoplay_lateness_seconds{{quantile="{q}"}} {snap["lateness_seconds"][key]:.6f}')
+        out += [
+            f"autoplay_lateness_seconds_sum {snap['lateness_sum_seconds']:.6f}",
+            f"autoplay_lateness_seconds_count {snap['events_dispatched']}",
+            "# TYPE autoplay_playback_thread_cpu_seconds_total counter",
+            f"autoplay_playback_thread_cpu_seconds_total {snap['playback_thread_cpu_seconds']}",
+            "# TYPE autoplay_held_keys gauge",
+            f"autoplay_held_keys {snap['held_keys']}",
+            "# TYPE autoplay_stalls_total counter",
+            f"autoplay_stalls_total {snap['stalls']}",
+            "# TYPE autoplay_stall_max_seconds gauge",
+            f"autoplay_stall_max_seconds {snap['stall_max_seconds']}",
+            "# TYPE autoplay_songs_completed_total counter",
+            f"autoplay_songs_completed_total {snap['songs_completed']}",
+            "# TYPE autoplay_songs_failed_total counter",
+            f"autoplay_songs_failed_total {snap['songs_failed']}",
+        ]
+        return "\n".join(out) + "\n"
+
+METRICS = PlayerMetrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics: PlayerMetrics = METRICS
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.metrics.prometheus().encode("utf-8")
+            ctype = "text/plain; version=0.0.4; charset=utf-8"
+        elif path in ("/metrics.json", "/status"):
+            body = json.dumps(self.metrics.snapshot(), ensure_ascii=False).encode("utf-8")
+            ctype = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MetricsServer:
+    """本機指標 HTTP 伺服器（daemon thread），與 Qt 完全無關。"""
+
+    def __init__(self, host: str = METRICS_HOST_DEFAULT, port: int = METRICS_PORT_DEFAULT):
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    def start(self) -> str:
+        """回傳錯誤訊息（空字串=OK）。"""
+        self.stop()
+        try:
+            self._httpd = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        except OSError as e:
+            self._httpd = None
+            return str(e)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+        return ""
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+# ---- 送鍵後端 ----
+class PynputBackend:
+    """pynput 送鍵（預設後端）。key 可以是字元或 pynput Key。"""
+    name = "pynput"
+
+    def __init__(self):
+        self._kb = Controller()
+        # 對照表裡的鍵先建好 KeyCode，送鍵時只查表
+        self._codes = {ch: KeyCode.from_char(ch) for ch in all_keymap_keys()}
+
+    def _code(self, key):
+        if isinstance(key, str):
+            code = self._codes.get(key)
+            return code if code is not None else KeyCode.from_char(key)
+        return key
+
+    def press(self, key):
+        self._kb.press(self._code(key))
+
+    def release(self, key):
+        self._kb.release(self._code(key))
+
+    def send_batch(self, actions):
+        """[(press, key), ...] 依序送出（pynput 沒有批次 API）。"""
+        for press, key in actions:
+            (self._kb.press if press else self._kb.release)(self._code(key))
+
+KEY_BACKENDS = {"pynput": PynputBackend}
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    class _KEYBDINPUT(ctypes.Structure):
+        _fields_ = [("wVk", wintypes.WORD), ("wScan", wintypes.WORD), ("dwFlags", wintypes.DWORD),
+                    ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class _MOUSEINPUT(ctypes.Structure):
+        _fields_ = [("dx", wintypes.LONG), ("dy", wintypes.LONG), ("mouseData", wintypes.DWORD),
+                    ("dwFlags", wintypes.DWORD), ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+    class _INPUTUNION(ctypes.Union):
+        _fields_ = [("mi", _MOUSEINPUT), ("ki", _KEYBDINPUT)]
+
+    class _INPUT(ctypes.Structure):
+        _fields_ = [("type", wintypes.DWORD), ("u", _INPUTUNION)]
+
+    class SendInputBackend:
+        """Windows SendInput：同一批按鍵用一次系統呼叫送出（掃描碼，DirectInput 遊戲也收得到）。"""
+        name = "sendinput"
+        INPUT_KEYBOARD = 1
+        KEYEVENTF_KEYUP = 0x0002
+        KEYEVENTF_SCANCODE = 0x0008
+
+        def __init__(self):
+            self._user32 = ctypes.WinDLL("user32", use_last_error=True)
+            self._scans = {ch: self._scan_of(ch) for ch in all_keymap_keys()}
+
+        def _scan_of(self, key) -> int:
+            if isinstance(key, str):
+                vk = self._user32.VkKeyScanW(ord(key)) & 0xFF
+                if vk == 0xFF:
+                    raise ValueError(f"目前的鍵盤語系打不出「{key}」")
+            else:
+                vk = getattr(getattr(key, "value", key), "vk", None)   # pynput Key（校準用的 F20）
+                if vk is None:
+                    raise ValueError(f"無法送出：{key!r}")
+            return self._user32.MapVirtualKeyW(vk, 0)   # MAPVK_VK_TO_VSC
+
+        def send_batch(self, actions):
+            arr = (_INPUT * len(actions))()
+            for i, (press, key) in enumerate(actions):
+                scan = self._scans.get(key) if isinstance(key, str) else None
+                arr[i].type = self.INPUT_KEYBOARD
+                arr[i].u.ki.wScan = scan if scan is not None else self._scan_of(key)
+                arr[i].u.ki.dwFlags = self.KEYEVENTF_SCANCODE | (0 if press else self.KEYEVENTF_KEYUP)
+            sent = self._user32.SendInput(len(actions), arr, ctypes.sizeof(_INPUT))
+            if sent != len(actions):
+                raise OSError(ctypes.get_last_error(), "SendInput 被擋下（遊戲以管理員執行時，本程式也要用管理員執行）")
+
+        def press(self, key):
+            self.send_batch(((True, key),))
+
+        def release(self, key):
+            self.send_batch(((False, key),))
+
+    KEY_BACKENDS["sendinput"] = SendInputBackend
+
+def make_key_backend(name: str):
+    return KEY_BACKENDS.get(name, PynputBackend)()
+
+class KeyTrace:
+    """記憶體裡的送鍵後端（模擬 / 測試用）：不真的送鍵，只記下 (時鐘時間, press, key)。"""
+    name = "trace"
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events: list[tuple] = []
+
+    def press(self, key):
+        self.events.append((self.clock.now(), True, key))
+
+    def release(self, key):
+        self.events.append((self.clock.now(), False, key))
+
+    def send_batch(self, actions):
+        now = self.clock.now()
+        self.events.extend((now, press, key) for press, key in actions)
+
+def _latency_stats(values: list[float]) -> dict:
+    vals = sorted(values)
+    return dict(
+        median_ms=statistics.median(vals) * 1000,
+        mean_ms=statistics.fmean(vals) * 1000,
+        stdev_ms=statistics.pstdev(vals) * 1000,
+        p95_ms=vals[min(len(vals) - 1, int(0.95 * len(vals)))] * 1000,
+    )
+
+def calibrate_latency(backend, samples: int = CALIBRATION_SAMPLES) -> dict:
+    """量測 backend 送出 press / release 到系統看見按鍵的時間。
+    優先用本機 loopback listener（從呼叫前到 listener 收到事件）；
+    listener 無法使用或漏事件時，退回量測呼叫本身的耗時。"""
+    probe = getattr(Key, CALIBRATION_PROBE, None)
+    if probe is None:
+        raise RuntimeError(f"此平台沒有探測鍵 {CALIBRATION_PROBE}")
+
+    seen = threading.Event()
+    stamp = [0.0]
+
+    def on_event(k):
+        if k == probe:
+            stamp[0] = perf_counter()
+            seen.set()
+
+    listener = None
+    try:
+        listener = Listener(on_press=on_event, on_release=on_event)
+        listener.start()
+        listener.wait()
+    except Exception:
+        listener = None
+
+    loop = {"press": [], "release": []}
+    call = {"press": [], "release": []}
+    missed = 0
+    try:
+        for _ in range(samples):
+            for kind, fn in (("press", backend.press), ("release", backend.release)):
+                seen.clear()
+                t = perf_counter()
+                fn(probe)
+                call[kind].append(perf_counter() - t)
+                if listener is not None and seen.wait(CALIBRATION_TIMEOUT):
+                    loop[kind].append(stamp[0] - t)
+                else:
+                    missed += 1
+                time.sleep(CALIBRATION_GAP)
+    finally:
+        try:
+            backend.release(probe)
+        except Exception:
+            pass
+        if listener is not None:
+            listener.stop()
+
+    use_loop = listener is not None and missed == 0
+    src = loop if use_loop else call
+    return dict(
+        backend=getattr(backend, "name", "?"),
+        method="loopback" if use_loop else "call",
+        samples=samples,
+        press=_latency_stats(src["press"]),
+        release=_latency_stats(src["release"]),
+    )
+
+def latency_settings_key(backend: str) -> str:
+    """校準結果依機器 + 後端分開存。"""
+    return f"latency/{platform.node() or 'local'}/{backend}"
+
+def load_latency(backend: str) -> tuple[float, float]:
+    """回傳 (press_lead, release_lead) 秒；沒校準過就是 0。"""
+    s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+    key = latency_settings_key(backend)
+    return (float(s.value(f"{key}/press_ms", 0.0, type=float)) / 1000,
+            float(s.value(f"{key}/release_ms", 0.0, type=float)) / 1000)
+
+def save_latency(result: dict):
+    s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+    key = latency_settings_key(result["backend"])
+    s.setValue(f"{key}/press_ms", result["press"]["median_ms"])
+    s.setValue(f"{key}/release_ms", result["release"]["median_ms"])
+    s.setValue(f"{key}/press_jitter_ms", result["press"]["stdev_ms"])
+    s.setValue(f"{key}/release_jitter_ms", result["release"]["stdev_ms"])
+    s.setValue(f"{key}/method", result["method"])
+
+def load_api_token() -> str:
+    """控制 API 的 token（QSettings 的 api/token）；還沒有就產生一個存起來，之後沿用（要換就改 api/token）。"""
+    s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+    token = str(s.value("api/token", "") or "")
+    if not token:
+        token = secrets.token_urlsafe(API_TOKEN_BYTES)
+        s.setValue("api/token", token)
+    return token
+
+def validate_hotkey(spec: str, mapping=None) -> str:
+    """檢查快捷鍵字串；回傳錯誤訊息（空字串=OK）。
+    組合中不能含有任何鍵盤配置會輸出的鍵，否則播放時自己按的音符會觸發快捷鍵。"""
+    spec = spec.strip()
+    if not spec:
+        return ""
+    try:
+        keys = HotKey.parse(spec)
+    except ValueError:
+        return f"無法解析：{spec}"
+    note_keys = set(mapping.values()) if mapping is not None else all_keymap_keys()
+    for k in keys:
+        ch = getattr(k, "char", None)
+        if ch and ch.lower() in note_keys:
+            return f"「{ch}」是音符按鍵，不能當快捷鍵：{spec}"
+    return ""
+
+class GlobalHotkeys:
+    """全域快捷鍵：pynput 自己的 listener thread，handler 直接在該 thread 執行（不經 Qt event loop）。"""
+
+    def __init__(self, bindings: dict, handlers: dict):
+        self.bindings = dict(bindings)     # action -> spec
+        self.handlers = handlers           # action -> callable
+        self._listener = None
+
+    def start(self) -> list[str]:
+        """啟動 listener；回傳被略過的設定錯誤。"""
+        self.stop()
+        errors = []
+        hotkeys = {}
+        for action in HOTKEY_ACTIONS:
+            spec = self.bindings.get(action, "").strip()
+            if not spec:
+                continue
+            err = validate_hotkey(spec)
+            if err:
+                errors.append(err)
+                continue
+            if spec in hotkeys:
+                errors.append(f"快捷鍵重複：{spec}")
+                continue
+            hotkeys[spec] = self._make_handler(action)
+        if hotkeys:
+            try:
+                self._listener = GlobalHotKeys(hotkeys)
+                self._listener.daemon = True
+                self._listener.start()
+            except Exception as e:
+                self._listener = None
+                errors.append(f"快捷鍵監聽啟動失敗：{e}")
+        return errors
+
+    def _make_handler(self, action: str):
+        def handler():
+            fn = self.handlers.get(action)
+            if fn is None:
+                return
+            try:
+                fn()
+            except Exception:
+                pass
+        return handler
+
+    def stop(self):
+        if self._listener is not None:
+            try:
+                self._listener.stop()
+            except Exception:
+                pass
+            self._listener = None
+
 def unique_dest_path(folder: str, filename: str) -> str:
     """若檔名已存在，自動產生 xxx (1).mid 這種不重名檔名。"""
     base, ext = os.path.splitext(filename)
@@ -99,162 +1739,1951 @@ def unique_dest_path(folder: str, filename: str) -> str:
             return cand
         i += 1
 
+# ---- 獨立播放程序：parent 把勾選音軌的音符放進 shared memory，子程序等時間、轉成按鍵、送鍵 ----
+# 一筆 = (t_sec, 是否 note_on, 音高, velocity)；移調 / 配置等參數另外傳，中途改設定只換參數
+SCHEDULE_RECORD = struct.Struct("<d?BB")
+
+def group_by_onset(timed):
+    """[(t_sec, msg), ...] → 同一時間點的事件一組一組產出（只多看一個事件，串流也能用）。"""
+    group = []
+    for ev in timed:
+        if group and ev[0] != group[0][0]:
+            yield group
+            group = []
+        group.append(ev)
+    if group:
+        yield group
+
+def chord_allowed_keys(group, transpose: int, velocity_th: int, table, max_chord: int):
+    """和弦上限：這個時間點可以按的鍵（高音優先）；None = 不用省略。"""
+    if max_chord <= 0:
+        return None
+    top = {}
+    for _, msg in group:
+        if msg.type == "note_on" and msg.velocity > 0 and msg.velocity >= velocity_th:
+            n = msg.note + transpose
+            key = table[n] if 0 <= n < 128 else None
+            if key:
+                top[key] = max(top.get(key, -1), n)
+    if len(top) <= max_chord:
+        return None
+    return set(sorted(top, key=top.get, reverse=True)[:max_chord])
+
+def onset_key_actions(group, transpose: int, velocity_th: int, table, max_chord: int = 0, held=None) -> list:
+    """同一時間點的音符事件 → [(press, key), ...]（保持原順序）。
+    table 是 128 格的音高 → 鍵；max_chord > 0 時同時按下的鍵最多留 N 個（高音優先）。
+    held（原音高 → 鍵）記下按了哪個鍵，放鍵時放同一個 —— 中途換移調 / 配置也不會卡鍵。"""
+    if held is None:
+        held = {}
+    allowed = chord_allowed_keys(group, transpose, velocity_th, table, max_chord)
+    out = []
+    for _, msg in group:
+        if msg.type not in ("note_on", "note_off"):
+            continue
+        if msg.type == "note_off" or msg.velocity == 0:
+            key = held.pop(msg.note, None)
+            if key:
+                out.append((False, key))
+        elif msg.velocity >= velocity_th:
+            n = msg.note + transpose
+            key = table[n] if 0 <= n < 128 else None
+            if key and (allowed is None or key in allowed):
+                held[msg.note] = key
+                out.append((True, key))
+    return out
+
+def iter_key_events(timed, transpose: int, velocity_th: int, mapping=MIDI_TO_KEY, max_chord: int = 0):
+    """[(t_sec, msg), ...] 套用移調 / 力度門檻 / 和弦上限 → (t_sec, press, key)（generator，串流也能用）。"""
+    table = tuple(mapping.get(n) for n in range(128))
+    held = {}
+    for group in group_by_onset(timed):
+        t_sec = group[0][0]
+        for press, key in onset_key_actions(group, transpose, velocity_th, table, max_chord, held):
+            yield t_sec, press, key
+
+def iter_onset_steps(onsets):
+    """(t_sec, resolve) → (t_sec, [(press, key), ...])：一個時間點依序拆成同方向的幾段，放 / 按各用自己的提前量。
+    resolve() 在輪到這個時間點時才呼叫，中途改設定最多只影響正在等的那一步。"""
+    for t_sec, resolve in onsets:
+        run = []
+        for action in resolve():
+            if run and action[0] != run[-1][0]:
+                yield t_sec, run
+                run = []
+            run.append(action)
+        if run:
+            yield t_sec, run
+
+# 預覽用的音符狀態
+NOTE_SENT, NOTE_UNMAPPED, NOTE_THINNED, NOTE_QUIET = range(4)
+
+def preview_notes(timed, transpose: int, velocity_th: int, table, max_chord: int = 0) -> list:
+    """[(t_sec, msg), ...] → [(開始, 結束, 原音高, 狀態), ...]（依開始時間排序）；判斷規則與播放相同。"""
+    out, sounding, last = [], defaultdict(list), 0.0
+    for group in group_by_onset(timed):
+        t_sec = last = group[0][0]
+        allowed = chord_allowed_keys(group, transpose, velocity_th, table, max_chord)
+        for _, msg in group:
+            if msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
+                if sounding[msg.note]:
+                    out[sounding[msg.note].pop(0)][1] = t_sec
+            elif msg.type == "note_on":
+                n = msg.note + transpose
+                key = table[n] if 0 <= n < 128 else None
+                if msg.velocity < velocity_th:
+                    state = NOTE_QUIET
+                elif not key:
+                    state = NOTE_UNMAPPED
+                elif allowed is not None and key not in allowed:
+                    state = NOTE_THINNED
+                else:
+                    state = NOTE_SENT
+                sounding[msg.note].append(len(out))
+                out.append([t_sec, None, msg.note, state])
+    return [(a, last if b is None else b, n, st) for a, b, n, st in out]
+
+# ---- 離線最佳化：合併成單一音軌、只留 tempo / 拍號 / 音符的精簡副本 ----
+def optimize_midi(src: str, dest: str, keymap: "KeymapProfile", transpose=None, bake: bool = True,
+                  velocity_th: int = 1, max_chord: int = 0, thin: bool = False, excluded=None) -> dict:
+    """把 src 精簡後寫到 dest（原檔不動）：所有勾選分組合併成一軌，丟掉歌詞、sysex、CC、彎音等。
+    transpose=None 依配置自動挑；bake=True 直接改音高，否則只寫進 marker 給人看。
+    thin=True 時只留真的會按的音符（規則同播放：力度、沒有對應鍵、和弦上限）。回傳統計。"""
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise ValueError("輸出檔不能覆蓋原檔")
+    index = load_midi_index(src, cache=False)
+    if excluded is None:
+        excluded = index.default_excluded()
+    if transpose is None:
+        transpose = pick_best_transpose_hist(index.pitch_histogram(excluded), keymap.mapping)[0]
+    timed = list(iter_stream_timed(src, excluded)) if index.streamed else index.schedule(excluded)
+
+    kept = []
+    sounding = defaultdict(list)    # 原音高 -> [這個 note_on 有沒有留下, ...]（先開先關，同 preview_notes）
+    for group in group_by_onset(timed):
+        allowed = chord_allowed_keys(group, transpose, velocity_th, keymap.table, max_chord) if thin else None
+        for t_sec, msg in group:
+            n = msg.note + transpose if bake else msg.note
+            if msg.type == "note_off" or msg.velocity == 0:
+                if sounding[msg.note] and sounding[msg.note].pop(0):
+                    kept.append((t_sec, False, msg.channel, n, 0))
+                continue
+            key = keymap.table[msg.note + transpose] if 0 <= msg.note + transpose < 128 else None
+            keep = 0 <= n < 128 and (not thin or (msg.velocity >= velocity_th and key is not None
+                                                 and (allowed is None or key in allowed)))
+            sounding[msg.note].append(keep)
+            if keep:
+                kept.append((t_sec, True, msg.channel, n, msg.velocity))
+
+    tpb = index.ticks_per_beat
+    tmap = index.tempo_map
+    events = [(tick, 0, mido.MetaMessage("set_tempo", tempo=tempo)) for tick, _, tempo in tmap]
+    events += [(tick, 0, mido.MetaMessage("time_signature", numerator=num, denominator=den))
+               for tick, num, den in index.time_signatures]
+    for seq, (t_sec, on, ch, n, vel) in enumerate(kept, 1):
+        tick = round(sec_to_tick(tmap, tpb, t_sec))
+        msg = mido.Message("note_on" if on else "note_off", channel=ch, note=n, velocity=vel)
+        events.append((tick, seq, msg))
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    # mido 預設用 latin-1 寫文字事件，中日文檔名 / 配置名會 UnicodeEncodeError → 整個檔用 UTF-8 寫；
+    # 檔名裡解不出來的位元組（surrogateescape）換成 ?
+    name = os.path.splitext(os.path.basename(src))[0].encode("utf-8", "replace").decode("utf-8")
+    track = mido.MidiTrack([
+        mido.MetaMessage("track_name", name=name),
+        mido.MetaMessage("marker", text=f"autoplay keymap={keymap.name} transpose={transpose:+d}"
+                                        f" {'baked' if bake else 'not-baked'}"),
+    ])
+    last = 0
+    for tick, _, msg in events:
+        track.append(msg.copy(time=tick - last))
+        last = tick
+    out = mido.MidiFile(type=0, ticks_per_beat=tpb, charset="utf-8")
+    out.tracks.append(track)
+
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp = dest + ".tmp"
+    try:
+        out.save(tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    notes_in = sum(1 for _, msg in timed if msg.type == "note_on" and msg.velocity > 0)
+    return dict(src=src, dest=dest, transpose=transpose, notes_in=notes_in,
+                notes_out=sum(1 for e in kept if e[1]),
+                bytes_in=os.path.getsize(src), bytes_out=os.path.getsize(dest))
+
+def optimize_many(jobs, workers: int = 0, on_done=None, cancel: threading.Event | None = None, **opts) -> list:
+    """[(src, dest), ...] 分給多個程序平行跑 optimize_midi；每完成一首呼叫 on_done(結果 dict 或 Exception, src)。"""
+    workers = workers or max(1, min(len(jobs), (os.cpu_count() or 2) - 1))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+        futures = {pool.submit(optimize_midi, src, dest, **opts): src for src, dest in jobs}
+        for fut in as_completed(futures):
+            if cancel is not None and cancel.is_set():
+                for f in futures:
+                    f.cancel()
+                break
+            try:
+                res = fut.result()
+            except Exception as e:
+                res = e
+            results.append(res)
+            if on_done:
+                on_done(res, futures[fut])
+    return results
+
+def iter_frame_batches(onsets, hz: float):
+    """(t_sec, resolve) 對齊到 1/hz 的格子 → (格子時間, [(press, key), ...])；resolve 同 iter_onset_steps。
+    同一格裡同一個鍵換方向（短音符先按後放、連打先放後按）時，後面的動作延到下一格，
+    否則遊戲在同一幀看不到變化。"""
+    period = 1.0 / hz
+    slot, pending, resolves = None, [], []
+
+    def split(actions):
+        now, later, first, deferred = [], [], {}, set()
+        for press, key in actions:
+            if key in deferred or first.get(key, press) != press:
+                later.append((press, key))
+                deferred.add(key)
+            else:
+                first[key] = press
+                now.append((press, key))
+        return now, later
+
+    def close():
+        for resolve in resolves:
+            pending.extend(resolve())
+        resolves.clear()
+
+    for t_sec, resolve in onsets:
+        k = round(t_sec * hz)
+        if slot is not None and k > slot:
+            close()
+            while pending and k > slot:    # 延後的動作可能自己佔一格
+                now, pending[:] = split(pending)
+                yield slot * period, now
+                slot += 1
+        if slot is None or k > slot:
+            slot = k
+        resolves.append(resolve)
+    close()
+    while pending:
+        now, pending = split(pending)
+        yield slot * period, now
+        slot += 1
+
+def parse_cpu_list(spec: str) -> set:
+    """'2,3' / '0-3' → {2, 3} / {0, 1, 2, 3}。"""
+    cpus = set()
+    for part in str(spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def _raise_process_priority(cpus) -> str:
+    """提高目前程序的排程優先權，並視需要綁定 CPU；回傳說明文字（失敗不致命）。"""
+    notes = []
+    if sys.platform == "win32":
+        import ctypes
+        k32 = ctypes.windll.kernel32
+        handle = k32.GetCurrentProcess()
+        HIGH_PRIORITY_CLASS = 0x00000080
+        notes.append("優先權 HIGH" if k32.SetPriorityClass(handle, HIGH_PRIORITY_CLASS) else "優先權設定失敗")
+        if cpus:
+            mask = sum(1 << c for c in cpus)
+            ok = k32.SetProcessAffinityMask(handle, ctypes.c_size_t(mask))
+            notes.append(f"CPU {sorted(cpus)}" if ok else "CPU 綁定失敗")
+    else:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, -10)
+            notes.append("nice -10")
+        except OSError:
+            notes.append("優先權維持預設（需要權限）")
+        if cpus:
+            try:
+                os.sched_setaffinity(0, cpus)
+                notes.append(f"CPU {sorted(cpus)}")
+            except (AttributeError, OSError) as e:
+                notes.append(f"CPU 綁定失敗：{e}")
+    return "、".join(notes)
+
+# ---- 播放時鐘：PlayWorker 的「現在幾點 / 等一下」都經過這裡，模擬模式換成 VirtualClock ----
+class RealClock:
+    """真實時間：perf_counter + sleep / Condition.wait。"""
+    now = staticmethod(perf_counter)
+    sleep = staticmethod(time.sleep)
+
+    @staticmethod
+    def wait(cv: threading.Condition, timeout: float | None = None):
+        cv.wait(timeout)
+
+    @staticmethod
+    def spin(deadline: float):
+        """最後幾 ms 的忙等：真實時鐘什麼都不做，迴圈自己重讀 now()。"""
+
+REAL_CLOCK = RealClock()
+
+class VirtualClock:
+    """模擬用的時鐘：時間只在等待時前進，而且瞬間跳到要等的時刻，整首歌幾毫秒就播完、結果每次都一樣。
+    at() 排定的動作（停止、暫停、繼續…）在時間走到時執行，並讓正在等的一方醒來。只給單一 thread 用。"""
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+        self._events = []          # heap: (時間, 序號, callable)
+        self._seq = 0
+
+    def now(self) -> float:
+        return self._now
+
+    def at(self, t: float, fn):
+        self._seq += 1
+        heapq.heappush(self._events, (t, self._seq, fn))
+
+    def _advance(self, target: float):
+        """往前走到 target；中途有排定的動作就停在那裡執行（等待的一方會重新檢查狀態）。"""
+        if self._events and self._events[0][0] <= target:
+            t, _, fn = heapq.heappop(self._events)
+            self._now = max(self._now, t)
+            fn()
+            return
+        self._now = max(self._now, target)
+
+    def sleep(self, sec: float):
+        # 至少走 1 ns：剩下的等待小到 now + sec 捨入後不變時，等待的一方才不會原地打轉
+        self._advance(self._now + max(1e-9, sec))
+
+    def wait(self, cv: threading.Condition, timeout: float | None = None):
+        if timeout is None:
+            if not self._events:
+                raise RuntimeError("模擬時鐘：無限期等待，但沒有排定任何會叫醒它的動作")
+            self._advance(self._events[0][0])
+        else:
+            self._advance(self._now + max(1e-9, timeout))
+
+    def spin(self, deadline: float):
+        self._advance(deadline)
+
+class StallWatchdog:
+    """播放卡頓偵測。播放 thread 每次等待前用 arm() 登記下一步的 deadline（perf_counter）當心跳；
+    看門狗 thread 發現超過 deadline + 門檻還沒送出，就記下卡頓開始（release 策略當場放開所有鍵，不等播放 thread 醒來）。
+    播放 thread 送鍵前經過 filter()：落後超過門檻的依策略處理，趕上排程時結算這次卡頓，呼叫 on_stall(位置, 落後秒數, 跳過的按鍵數)。"""
+
+    def __init__(self, threshold: float = 0.0, policy: str = "skip", release_all=None, on_stall=None, lock=None,
+                 now=perf_counter):
+        self.now = now
+        self.threshold = threshold
+        self.policy = policy if policy in STALL_POLICIES else "skip"
+        self._release_all = release_all
+        self._on_stall = on_stall
+        self._lock = lock or threading.RLock()   # 送鍵用的鎖：filter() 在鎖內呼叫，看門狗放鍵也要拿
+        self.count = 0
+        self.worst = 0.0
+        self._due = None
+        self._flagged = False               # 看門狗已經看到這次卡頓
+        self._episode = None                # [位置, 最大落後, 跳過的按鍵數]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "StallWatchdog":
+        if self.threshold > 0:
+            self._thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+            self._thread.start()
+        return self
+
+    def _watch(self):
+        poll = min(max(self.threshold / 4, STALL_POLL_RANGE[0]), STALL_POLL_RANGE[1])
+        while not self._stop.wait(poll):
+            due = self._due
+            if due is None or self._flagged or self.now() - due <= self.threshold:
+                continue
+            if self.policy != "release":
+                self._flagged = True
+                continue
+            with self._lock:
+                if self._due != due or self._flagged:
+                    continue      # 等鎖的時候播放 thread 已經醒來往下走了，交給 filter()
+                self._flagged = True
+                self._release_all()
+
+    def arm(self, deadline: float):
+        self._due = deadline
+
+    def disarm(self):
+        """暫停 / 跳轉：時鐘會重設，舊的 deadline 作廢。"""
+        self._due = None
+        self._flagged = False
+
+    def filter(self, t_sec: float, late: float, actions) -> list:
+        """回傳這一步實際要送的動作。"""
+        if self.threshold <= 0:
+            return actions
+        if late <= self.threshold:
+            if self._episode is not None:
+                self._close()
+            return actions
+        ep = self._episode
+        if ep is None:
+            ep = self._episode = [t_sec, late, 0]
+            if self.policy == "release" and not self._flagged:
+                self._release_all()
+            self._flagged = True
+        ep[1] = max(ep[1], late)
+        if self.policy == "catchup":
+            return actions
+        kept = [a for a in actions if not a[0]]    # 放鍵照送，按著的狀態才不會亂
+        ep[2] += len(actions) - len(kept)
+        return kept
+
+    def _close(self):
+        pos, late, dropped = self._episode
+        self._episode = None
+        self._flagged = False
+        self.count += 1
+        self.worst = max(self.worst, late)
+        if self._on_stall:
+            self._on_stall(pos, late, dropped)
+
+    def finish(self):
+        """這首結束：停掉看門狗，還在卡頓中的也結算。"""
+        self._stop.set()
+        self._due = None
+        if self._episode is not None:
+            self._close()
+
+def stall_text(pos: float, late: float, dropped: int, policy: str) -> str:
+    text = f"🐢 播放卡頓：落後 {late * 1000:.0f} ms @ {fmt_time(pos)}"
+    if policy == "catchup":
+        return text + "（已補送）"
+    return text + ("（已放開所有鍵，" if policy == "release" else "（") + f"跳過 {dropped} 個按鍵）"
+
+class _ChildSong:
+    """子程序裡播一首：等待邏輯同 PlayWorker，但指令從 ctrl queue 來、結果批次回報。"""
+
+    def __init__(self, kb, ctrl, report, shm_name: str, count: int, countdown: float,
+                 press_lead: float, release_lead: float, release_all_end: bool, frame_hz: int, params, stall):
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            self.events = [(t_sec, StreamNote("note_on" if on else "note_off", 0, note, vel))
+                           for t_sec, on, note, vel in SCHEDULE_RECORD.iter_unpack(shm.buf[:count * SCHEDULE_RECORD.size])]
+        finally:
+            shm.close()
+        self.times = [e[0] for e in self.events]
+        self.params = params           # (transpose, velocity, 128 格 table, max_chord)
+        self.new_params = None
+        self.held = {}
+        self.kb, self.ctrl, self.report = kb, ctrl, report
+        self.countdown = countdown
+        self.press_lead, self.release_lead = press_lead, release_lead
+        self.release_all_end = release_all_end
+        self.frame_hz = frame_hz
+        self.pressed = set()
+        self.lock = threading.RLock()      # 看門狗 thread 也會放鍵
+        self.watchdog = StallWatchdog(stall[0], stall[1], self._release_all, self._on_stall, self.lock)
+        self.batch = []
+        self.stop = self.skip = self.paused = self.quit = False
+        self.seek_to = None
+        self.t0 = 0.0
+        self.thread = threading.get_ident()
+        self.cpu_mark = time.thread_time()   # 這首的播放 thread CPU，跟著事件批次回報給 parent
+
+    def _handle(self, cmd):
+        op = cmd[0]
+        if op == "stop":
+            self.stop = True
+        elif op == "pause":
+            self.paused = True
+        elif op == "resume":
+            self.paused = False
+        elif op == "skip":
+            self.skip, self.paused = True, False
+        elif op == "seek":
+            self.seek_to = max(0.0, float(cmd[1]))
+        elif op == "params":
+            self.new_params = cmd[1]
+        elif op == "quit":
+            self.stop = self.quit = True
+
+    def _poll(self, timeout=0.0):
+        """收指令：timeout=0 不等、None 一直等。"""
+        try:
+            if timeout == 0.0:
+                cmd = self.ctrl.get_nowait()
+            else:
+                cmd = self.ctrl.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self._handle(cmd)
+        while True:
+            try:
+                self._handle(self.ctrl.get_nowait())
+            except queue.Empty:
+                return
+
+    def _cpu_delta(self) -> float:
+        """上次回報後播放 thread 用掉的 CPU 秒數；看門狗 thread 呼叫時回傳 0（thread_time 量的是呼叫者）。"""
+        if threading.get_ident() != self.thread:
+            return 0.0
+        now = time.thread_time()
+        delta, self.cpu_mark = now - self.cpu_mark, now
+        return delta
+
+    def _flush(self):
+        if self.batch:
+            self.report.put(("events", self.batch, self._cpu_delta()))
+            self.batch = []
+
+    def _interrupted(self) -> bool:
+        return self.stop or self.paused or self.skip or self.seek_to is not None or self.new_params is not None
+
+    def _wait_until(self, deadline: float) -> bool:
+        self.watchdog.arm(deadline)
+        while True:
+            if self._interrupted():
+                return False
+            wait = deadline - perf_counter()
+            if wait <= 0:
+                return True
+            if wait > WAIT_COARSE_MARGIN:
+                self._flush()     # 有空檔才回報，不佔用送鍵前的時間
+                self._poll(wait - WAIT_COARSE_MARGIN)
+            elif wait > WAIT_SPIN_MARGIN:
+                self._poll()
+                time.sleep(min(wait - WAIT_SPIN_MARGIN, WAIT_SLICE))
+
+    def _release_all(self):
+        with self.lock:
+            for k in list(self.pressed):
+                try:
+                    self.kb.release(k)
+                except Exception:
+                    pass
+            self.pressed.clear()
+
+    def _on_stall(self, pos: float, late: float, dropped: int):
+        self._flush()
+        self.report.put(("stall", pos, late, dropped))
+
+    def _hold_pause(self):
+        self.watchdog.disarm()
+        self._release_all()
+        self._flush()
+        self.report.put(("state", "paused"))
+        paused_at = perf_counter()
+        self.report.put(("clock", self.t0, paused_at))
+        while self.paused and not (self.stop or self.skip):
+            self._poll(None)
+        self.t0 += perf_counter() - paused_at
+        self.report.put(("clock", self.t0, None))
+        if not (self.stop or self.skip):
+            self.report.put(("state", "playing" if perf_counter() >= self.t0 else "countdown"))
+
+    def _wait_song_time(self, t_sec: float) -> bool:
+        while not self._wait_until(self.t0 + t_sec):
+            if self.stop or self.skip or self.seek_to is not None:
+                return False
+            if self.new_params is not None:
+                self._apply_params()
+                continue
+            self._hold_pause()
+        return True
+
+    def _apply_params(self):
+        """同 PlayWorker._apply_live：換參數，按著但對不上新設定的鍵放開。"""
+        self.params, self.new_params = self.new_params, None
+        transpose, _, table, _ = self.params
+        with self.lock:
+            for note, key in list(self.held.items()):
+                n = note + transpose
+                if (table[n] if 0 <= n < 128 else None) == key or key not in self.pressed:
+                    continue
+                del self.held[note]
+                self.kb.release(key)
+                self.pressed.discard(key)
+
+    def _resolve(self, group, held):
+        transpose, velocity, table, max_chord = self.params
+        return onset_key_actions(group, transpose, velocity, table, max_chord, held)
+
+    def _steps(self, i: int):
+        """從第 i 個音符起的送鍵步驟：(時間, [(press, key), ...])；有設 frame_hz 就對齊成整幀一批。"""
+        onsets = ((group[0][0], functools.partial(self._resolve, group, self.held))
+                  for group in group_by_onset(islice(self.events, i, None)))
+        if self.frame_hz > 0:
+            return iter_frame_batches(onsets, self.frame_hz)
+        return iter_onset_steps(onsets)
+
+    def _send(self, t_sec: float, actions, lead: float):
+        with self.lock:
+            lateness = perf_counter() - self.t0 - (t_sec - lead)
+            actions = self.watchdog.filter(t_sec, lateness, actions)
+            actions = [(press, key) for press, key in actions if press != (key in self.pressed)]
+            if not actions:
+                return
+            self.kb.send_batch(actions)
+            for press, key in actions:
+                if press:
+                    self.pressed.add(key)
+                else:
+                    self.pressed.discard(key)
+                self.batch.append((t_sec, lateness, len(self.pressed)))
+        if len(self.batch) >= ISOLATE_REPORT_BATCH:
+            self._flush()
+
+    def run(self):
+        self.t0 = perf_counter() + max(0.0, self.countdown)
+        self.report.put(("clock", self.t0, None))
+        self.report.put(("state", "countdown"))
+        steps = self._steps(0)
+        self.watchdog.start()
+        try:
+            if not self._wait_song_time(-max(self.press_lead, self.release_lead)) and self.seek_to is None:
+                return
+            self.report.put(("state", "playing"))
+            while True:
+                interrupted = False
+                for t_sec, actions in steps:
+                    lead = self.press_lead if any(press for press, _ in actions) else self.release_lead
+                    if not self._wait_song_time(t_sec - lead):
+                        interrupted = True
+                        break
+                    self._send(t_sec, actions, lead)
+                if not interrupted or self.seek_to is None:
+                    break
+                target, self.seek_to = self.seek_to, None
+                self.watchdog.disarm()
+                self._release_all()
+                self.held = {}
+                self.t0 = perf_counter() - target
+                self.report.put(("clock", self.t0, None))
+                steps = self._steps(bisect_left(self.times, target))
+                self.report.put(("seeked", target))
+        finally:
+            self.watchdog.finish()
+            if self.release_all_end or self.skip:
+                self._release_all()
+            self._flush()
+            self.report.put(("cpu", self._cpu_delta()))
+            self.report.put(("done", "stop" if self.stop else "skip" if self.skip else "end"))
+
+def _playback_process_main(ctrl, report, backend_name: str, cpus):
+    """子程序進入點：常駐，一次播一首（("play", ...) 指令），("quit",) 結束。"""
+    try:
+        info = _raise_process_priority(cpus)
+        kb = make_key_backend(backend_name)
+    except Exception as e:
+        report.put(("error", str(e)))
+        return
+    report.put(("ready", info))
+    while True:
+        cmd = ctrl.get()
+        if cmd[0] == "quit":
+            return
+        if cmd[0] != "play":
+            continue          # 上一首結束後才到的 stop / pause 等，忽略
+        try:
+            song = _ChildSong(kb, ctrl, report, *cmd[1:])
+        except Exception as e:
+            report.put(("error", str(e)))
+            report.put(("done", "stop"))
+            continue
+        song.run()
+        if song.quit:
+            return
+
+class PlaybackProcess:
+    """獨立播放程序的 parent 端：第一次用到才 spawn，之後常駐重用，關閉程式時 shutdown()。"""
+
+    def __init__(self):
+        self._ctx = mp.get_context("spawn")
+        self._proc = None
+        self._ctrl = None
+        self._report = None
+        self._config = None
+        self.info = ""
+
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.is_alive()
+
+    def ensure(self, backend_name: str, cpus) -> str:
+        """確保子程序在跑（後端或 CPU 設定變了就重開）；失敗回傳錯誤訊息。"""
+        config = (backend_name, frozenset(cpus))
+        if self.alive() and self._config == config:
+            return ""
+        self.shutdown()
+        self._ctrl = self._ctx.Queue()
+        self._report = self._ctx.Queue()
+        self._proc = self._ctx.Process(target=_playback_process_main, name="autoplay-player",
+                                       args=(self._ctrl, self._report, backend_name, set(cpus)),
+                                       daemon=True)
+        self._proc.start()
+        try:
+            kind, info = self._report.get(timeout=ISOLATE_START_TIMEOUT)
+        except queue.Empty:
+            self.shutdown()
+            return "子程序啟動逾時"
+        if kind != "ready":
+            self.shutdown()
+            return info
+        self._config = config
+        self.info = info
+        return ""
+
+    def send(self, cmd):
+        if self._ctrl is not None:
+            self._ctrl.put(cmd)
+
+    def recv(self, timeout: float):
+        try:
+            return self._report.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def shutdown(self):
+        proc, self._proc = self._proc, None
+        if proc is not None:
+            if proc.is_alive():
+                self._ctrl.put(("quit",))
+                proc.join(2.0)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join(1.0)
+        self._ctrl = self._report = None
+        self._config = None
+
+# 一首歌目前生效的轉換參數；中途改設定時整個換掉（單一屬性指派）
+SongParams = namedtuple("SongParams", "keymap transpose velocity max_chord")
+
 class PlayWorker(QObject):
+    """常駐播放引擎：在自己的 thread 跑 serve()，從指令佇列接「播放」；停止 / 暫停 / 跳轉直接設旗標。"""
+
     log = Signal(str)
     status = Signal(str)
     finished = Signal()
+    paused_changed = Signal(bool)
     select_folder_index = Signal(int)
     select_playlist_index = Signal(int)
 
-    def __init__(self, *, mode: str, play_list: list[str], start_index: int, settings: dict):
+    def __init__(self, *, mode: str = "single", play_list: list[str] = (), start_index: int = 0,
+                 settings: dict | None = None, proc: PlaybackProcess | None = None, clock=None, kb=None):
         super().__init__()
         self.mode = mode                 # "playlist" | "folder" | "single"
-        self.play_list = play_list[:]    # full paths
+        self.play_list = list(play_list) # full paths
         self.idx = start_index
-        self.settings = settings
+        self.settings = dict(DEFAULT_SETTINGS) if settings is None else settings
         self.stop_event = threading.Event()
-        self.kb = Controller()
+        self.kb = kb or make_key_backend(self.settings.get("key_backend", "pynput"))   # 常駐，不每次重建
+        self._clock = clock or REAL_CLOCK   # 模擬模式傳 VirtualClock
         self.pressed = set()
+        self._kb_lock = threading.RLock()   # 卡頓看門狗 thread 也會放鍵
+        self._watchdog = StallWatchdog()
+        self._stalls: list[float] = []      # 這首每次卡頓落後的秒數
+        self._commands = queue.Queue()
+
+        # 所有等待都掛在這個 Condition 上：停止 / 暫停時 notify，等待者立刻醒來
+        self._cv = threading.Condition()
+        self._paused = False
+        self._skip = False   # 下一首：中斷目前這首，不管「自動下一首」
+        self._seek_to = None  # 跳轉目標（秒）；由播放 thread 取走處理
+        self.current_path = ""
+        self._t0 = 0.0    # 播放時鐘原點（self._clock.now()），暫停時往後推
+        self._press_lead = 0.0
+        self._release_lead = 0.0
+        self._params = SongParams(get_keymap(KEYMAP_DEFAULT), 0, 1, 0)
+        self._held_notes = {}     # 原音高 → 按下的鍵（放鍵用）
+        self._song = None         # (index, excluded, timed, streaming)：中途改設定時重算用
+        self._live_pending = False
+        self._song_gen = 0        # 每首 +1：背景分析完成時確認還是同一首
+        self._full_index = None   # 背景建好的完整索引，播放 thread 在下一個等待點換上
+        self._settings_live = False  # apply_live 改過設定（不只是換上完整索引）
+        self.proc = proc          # 獨立播放程序（settings["isolate"] 時使用）
+        self._child = False       # 目前這首正在子程序播放：控制指令要轉送過去
+
+    # ---- 引擎指令（service thread 呼叫）----
+    def submit_play(self, mode: str, play_list: list[str], start_index: int, settings: dict):
+        """重設狀態後排入一次播放；旗標在這裡清，之後馬上按停止也不會被吃掉。"""
+        with self._cv:
+            self.stop_event.clear()
+            self._paused = False
+            self._skip = False
+            self._seek_to = None
+            self.mode = mode
+            self.play_list = list(play_list)
+            self.idx = start_index
+            self.current_path = ""
+        self.settings = settings
+        self.pressed.clear()
+        backend = settings.get("key_backend", "pynput")
+        if getattr(self.kb, "name", None) != backend:
+            self.kb = make_key_backend(backend)
+        self._commands.put(("play",))
+
+    def shutdown(self):
+        """結束 serve()（會先停止目前的播放）。"""
+        self.stop()
+        self._commands.put(("quit",))
+
+    @Slot()
+    def serve(self):
+        """引擎 thread 主迴圈。"""
+        while True:
+            cmd = self._commands.get()
+            if cmd[0] == "quit":
+                return
+            if cmd[0] == "play":
+                self.run()
+
+    def _to_child(self, cmd):
+        if self._child:
+            self.proc.send(cmd)
 
     def stop(self):
-        self.stop_event.set()
+        with self._cv:
+            self.stop_event.set()
+            self._cv.notify_all()
+            self._to_child(("stop",))
+
+    def pause(self):
+        with self._cv:
+            self._paused = True
+            self._cv.notify_all()
+            self._to_child(("pause",))
+        self.paused_changed.emit(True)
+
+    def resume(self):
+        with self._cv:
+            self._paused = False
+            self._cv.notify_all()
+            self._to_child(("resume",))
+        self.paused_changed.emit(False)
+
+    def seek(self, t_sec: float):
+        with self._cv:
+            if self._child:
+                self.proc.send(("seek", max(0.0, float(t_sec))))
+            else:
+                self._seek_to = max(0.0, float(t_sec))
+            self._cv.notify_all()
+
+    def set_play_list(self, play_list: list[str]):
+        """播放中換掉清單（service thread 呼叫）：目前這首的位置跟著新順序走。
+        idx / play_list / current_path 只在 _cv 內改，播放 thread 換下一首也在 _cv 內一次做完。"""
+        with self._cv:
+            old = self.idx
+            self.play_list = list(play_list)
+            if self.current_path in self.play_list:
+                self.idx = self.play_list.index(self.current_path)
+            else:
+                self.idx = min(old, len(self.play_list)) - 1   # 目前這首被移除：下一首接替它的位置
+
+    def _select(self, idx: int) -> str | None:
+        """（持有 _cv 時呼叫）把 idx 設為目前這首並回傳路徑；超出範圍回傳 None。"""
+        if idx < 0 or idx >= len(self.play_list):
+            return None
+        self.idx = idx
+        self.current_path = self.play_list[idx]
+        return self.current_path
+
+    def next_song(self):
+        with self._cv:
+            self._skip = True
+            self._paused = False
+            self._cv.notify_all()
+            self._to_child(("skip",))
+        self.paused_changed.emit(False)
+
+    def apply_live(self, changes: dict):
+        """播放中改 LIVE_SETTINGS（其他 thread 呼叫）：播放 thread 在下一個等待點重建排程後半段。"""
+        with self._cv:
+            self.settings.update(changes)
+            self._live_pending = True
+            self._settings_live = True
+            self._cv.notify_all()
+
+    def is_paused(self) -> bool:
+        return self._paused
 
     def _release_all(self):
-        for k in list(self.pressed):
-            try:
-                self.kb.release(KeyCode.from_char(k))
-            except Exception:
-                pass
-        self.pressed.clear()
-
+        with self._kb_lock:
+            for k in list(self.pressed):
+                try:
+                    self.kb.release(k)
+                except Exception:
+                    pass
+            self.pressed.clear()
+
+    def _on_stall(self, pos: float, late: float, dropped: int):
+        self._stalls.append(late)
+        METRICS.stalled(late)
+        self.log.emit(stall_text(pos, late, dropped, self._watchdog.policy))
+
+    def _interrupted(self) -> bool:
+        return (self.stop_event.is_set() or self._paused or self._skip or self._seek_to is not None
+                or self._live_pending)
+
+    def _wait_until(self, deadline: float) -> bool:
+        """等到 clock.now() >= deadline。回傳 False=被停止 / 暫停 / 跳轉打斷。"""
+        self._watchdog.arm(deadline)
+        clock = self._clock
+        while True:
+            if self._interrupted():
+                return False
+            wait = deadline - clock.now()
+            if wait <= 0:
+                return True
+            if wait > WAIT_COARSE_MARGIN:
+                with self._cv:
+                    if not self._interrupted():
+                        clock.wait(self._cv, wait - WAIT_COARSE_MARGIN)
+            elif wait > WAIT_SPIN_MARGIN:
+                clock.sleep(min(wait - WAIT_SPIN_MARGIN, WAIT_SLICE))
+            else:
+                clock.spin(deadline)   # 微忙等
+
+    def _hold_pause(self):
+        """暫停：放開所有按鍵並凍結播放時鐘，直到繼續或停止。"""
+        self._watchdog.disarm()
+        self._release_all()
+        METRICS.state = "paused"
+        METRICS.held_keys = 0
+        self.status.emit("已暫停")
+        self.log.emit("⏸ 已暫停")
+        paused_at = self._clock.now()
+        METRICS.clock = (self._t0, paused_at)
+        with self._cv:
+            while self._paused and not (self.stop_event.is_set() or self._skip):
+                self._clock.wait(self._cv)
+        # 時鐘原點整段往後推，後面所有事件的相對時間不變 → 不會漂移
+        self._t0 += self._clock.now() - paused_at
+        METRICS.clock = (self._t0, None)
+        if not (self.stop_event.is_set() or self._skip):
+            self.log.emit("▶ 繼續播放")
+            playing = self._clock.now() >= self._t0
+            METRICS.state = "playing" if playing else "countdown"
+            self.status.emit("播放中…" if playing else "倒數中…")
+
+    def _wait_song_time(self, t_sec: float) -> bool:
+        """等到播放時鐘走到 t_sec（暫停期間不計時）。回傳 False=已停止 / 跳下一首 / 要跳轉。"""
+        while not self._wait_until(self._t0 + t_sec):
+            if self.stop_event.is_set() or self._skip or self._seek_to is not None:
+                return False
+            if self._live_pending:
+                self._apply_live()
+                continue
+            self._hold_pause()
+        return True
+
+    @profiled("play.seek")
+    def _reposition(self, target: float, timed, path: str, excluded, stream):
+        """跳轉：放開按鍵、把時鐘對到 target，回傳 (新的事件 iterator, 新的 stream)。"""
+        self._watchdog.disarm()
+        self._release_all()
+        self._held_notes = {}
+        self._t0 = self._clock.now() - target
+        METRICS.clock = (self._t0, None)
+        METRICS.position = target
+        self.log.emit(f"⏩ 跳到 {fmt_time(target)}")
+        if stream is None:
+            i = bisect_left(timed, target, key=lambda e: e[0])
+            return islice(timed, i, None), None
+        # 串流只能從頭重新解析，丟掉 target 之前的事件
+        stream.close()
+        stream = StreamBuffer(dropwhile(lambda e: e[0] < target, iter_stream_timed(path, excluded)),
+                              self.stop_event)
+        stream.wait_ready()
+        self._t0 = self._clock.now() - target
+        METRICS.clock = (self._t0, None)
+        return iter(stream), stream
+
+    @profiled("play.song", capture=True)
     def _play_one(self, path: str) -> bool:
         """播放單首（回傳 True=正常播完，False=停止）"""
-        mid = mido.MidiFile(path)
-        timed = build_timed_events(mid)
-
-        transpose = int(self.settings["transpose"])
-        auto_transpose = bool(self.settings["auto_transpose"])
-        velocity_th = int(self.settings["velocity"])
+        index = cached_midi_index(path)
+        pending = index is None and os.path.getsize(path) >= STREAM_THRESHOLD_BYTES
+        if pending:
+            # 大檔的完整索引要掃過整個檔：改在背景建，先用開頭的音符估計，串流照樣馬上開始預讀
+            index = MidiIndex.from_stream(path, max_notes=STREAM_INDEX_PREVIEW_NOTES)
+        elif index is None:
+            index = load_midi_index(path)
+        excluded = self.settings.get("track_excluded", {}).get(path)
+        if excluded is None:
+            excluded = index.default_excluded()
+        streaming = index.streamed or bool(self.settings.get("stream", False))
+
+        with self._cv:
+            self._live_pending = False   # 這首開頭就會讀最新設定
+            self._song_gen += 1
+            self._full_index = None
+            self._settings_live = False
+        if pending:
+            self._index_in_background(path)
         countdown = float(self.settings["countdown"])
         release_all_end = bool(self.settings["release_all_at_end"])
-
-        # auto transpose
-        if auto_transpose:
-            best_tr, hit, total = pick_best_transpose(timed, MIDI_TO_KEY)
-            transpose = best_tr
-            if total > 0:
-                self.log.emit(f"🎯 Auto Transpose：{transpose:+d}（可彈 {hit}/{total} = {hit/total:.1%}）")
+        if self.settings.get("latency_comp", False):
+            self._press_lead = max(0.0, float(self.settings.get("press_lead", 0.0)))
+            self._release_lead = max(0.0, float(self.settings.get("release_lead", 0.0)))
         else:
-            self.log.emit(f"🎚 使用手動 Transpose：{transpose:+d}")
+            self._press_lead = self._release_lead = 0.0
+        frame_hz = max(0, int(self.settings.get("frame_hz", 0)))
+        stall = (max(0, int(self.settings.get("stall_ms", 0))) / 1000.0,
+                 self.settings.get("stall_policy", DEFAULT_SETTINGS["stall_policy"]))
+        self._stalls = []
+        self._watchdog = StallWatchdog(*stall, self._release_all, self._on_stall, self._kb_lock, self._clock.now)
+
+        if streaming:
+            # 串流：背景 thread 邊解析邊填 buffer，播放 loop 從 buffer 取
+            stream = StreamBuffer(iter_stream_timed(path, excluded), self.stop_event)
+            timed = stream
+        else:
+            stream = None
+            timed = index.schedule(excluded)
+
+        self._song = (index, excluded, timed, streaming)
+        self._held_notes = {}
+        params = self._params = self._resolve_params()
+        keymap = params.keymap
+        if len(KEYMAPS) > 1:
+            hit, total, best_name, best_tr = score_keymaps(index.pitch_histogram(excluded))[0]
+            if best_name != keymap.name and total:
+                self.log.emit(f"💡 建議配置：{best_name} {best_tr:+d}（可彈 {hit / total:.1%}）")
 
         self.log.emit(f"✅ 載入：{path}")
-        self.log.emit(f"   tracks={len(mid.tracks)}, ticks_per_beat={mid.ticks_per_beat}")
-        self.log.emit(f"   velocity threshold={velocity_th}")
+        self.log.emit(f"   tracks={index.n_tracks}, ticks_per_beat={index.ticks_per_beat}")
+        if pending:
+            self.log.emit(f"   ⏳ 背景分析整首中：移調 / 力度門檻先依開頭 {index.note_count()} 個音符估計（倒數結束前分析完就改用整首的結果）")
+        used = len(index.groups) - len(excluded & index.groups.keys())
+        self.log.emit(f"   音軌/聲道：使用 {used}/{len(index.groups)} 組")
+        if streaming:
+            self.log.emit(f"🌊 串流模式：lookahead 上限 {STREAM_CHUNK * STREAM_BUFFER_CHUNKS} 個事件")
+        self.log.emit(f"   velocity threshold={params.velocity}")
+        if params.max_chord:
+            self.log.emit(f"   和弦上限：同時最多 {params.max_chord} 鍵（高音優先）")
+        if self._press_lead or self._release_lead:
+            self.log.emit(f"   延遲補償：press 提早 {self._press_lead * 1000:.2f} ms、"
+                          f"release 提早 {self._release_lead * 1000:.2f} ms")
+        if frame_hz:
+            self.log.emit(f"🎞 幀對齊送鍵：{frame_hz} Hz（每 {1000 / frame_hz:.2f} ms 一批，{self.kb.name}）")
+        isolate = bool(self.settings.get("isolate", False)) and self.proc is not None
+        if isolate and streaming:
+            self.log.emit("⚠️ 串流模式不支援獨立程序播放，改在本程序播放")
+            isolate = False
+        if isolate and not self._ensure_child():
+            isolate = False
         self.log.emit(f"⏳ {countdown} 秒後開始…請切到遊戲視窗（建議點一下讓遊戲取得焦點）")
         self.status.emit("倒數中…")
-
-        t_end = time.time() + max(0.0, countdown)
-        while time.time() < t_end:
-            if self.stop_event.is_set():
-                self.log.emit("🛑 已停止（倒數中）")
-                return False
-            time.sleep(0.05)
-
+        METRICS.song_started(path, index.duration)
+        if isolate:
+            return self._play_isolated(timed, countdown, release_all_end, frame_hz, stall)
+
+        # 倒數 = 播放時鐘的負時間：原點設在倒數結束那一刻
+        self._t0 = self._clock.now() + max(0.0, countdown)
+        METRICS.clock = (self._t0, None)
+        if not self._wait_song_time(-max(self._press_lead, self._release_lead)) and self._seek_to is None:
+            if stream:
+                stream.close()
+            if self._skip:
+                return True
+            self.log.emit("🛑 已停止（倒數中）")
+            return False
+
+        if stream:
+            if not stream.wait_ready():
+                self.log.emit("⚠️ 串流預先緩衝逾時，直接開始")
+            self._t0 = max(self._t0, self._clock.now())   # 緩衝比倒數久時，從現在起算
+            METRICS.clock = (self._t0, None)
         self.status.emit("播放中…")
-        t0 = perf_counter()
+        METRICS.state = "playing"
+        self._watchdog.start()
 
-        try:
-            for t_sec, msg in timed:
-                if self.stop_event.is_set():
-                    self.log.emit("🛑 已停止（播放中）")
-                    break
+        def steps(events):
+            onsets = self._onsets(events)
+            return iter_frame_batches(onsets, frame_hz) if frame_hz else iter_onset_steps(onsets)
 
-                # 穩定等待（sleep + 微忙等）
-                while True:
-                    now = perf_counter() - t0
-                    wait = t_sec - now
-                    if wait <= 0:
+        try:
+            events = iter(timed)
+            while True:
+                interrupted = False
+                for t_sec, actions in steps(events):
+                    # 穩定等待（Condition / sleep 切片 + 微忙等），可被停止 / 暫停 / 跳轉打斷
+                    # 延遲補償：依 press / release 各自的送鍵延遲提早送出
+                    lead = self._press_lead if any(press for press, _ in actions) else self._release_lead
+                    if not self._wait_song_time(t_sec - lead):
+                        interrupted = True
                         break
-                    if wait > 0.004:
-                        time.sleep(wait - 0.002)
+                    self._dispatch(t_sec, actions, lead)
+                if not interrupted:
+                    break
 
-                if msg.type not in ("note_on", "note_off"):
-                    continue
+                target = self._seek_to
+                if target is None:
+                    if not self._skip:
+                        self.log.emit("🛑 已停止（播放中）")
+                    break
+                self._seek_to = None
+                events, stream = self._reposition(target, timed, path, excluded, stream)
 
-                note = int(msg.note) + transpose
-                key = MIDI_TO_KEY.get(note)
-                if not key:
-                    continue
+        finally:
+            self._watchdog.finish()
+            if stream:
+                stream.close()
+            if release_all_end or self._skip:
+                self._release_all()
 
-                is_note_on = (msg.type == "note_on" and msg.velocity >= velocity_th)
-                is_note_off = (msg.type == "note_off") or (msg.type == "note_on" and msg.velocity == 0)
+        return not self.stop_event.is_set()
 
-                if is_note_on:
-                    if key not in self.pressed:
-                        self.kb.press(KeyCode.from_char(key))
-                        self.pressed.add(key)
+    def _resolve_params(self, live: bool = False) -> SongParams:
+        """依目前 settings 算出這首的轉換參數（鍵盤配置、移調、力度門檻、和弦上限）。"""
+        index, excluded, timed, streaming = self._song
+        keymap_name = self.settings.get("keymap", KEYMAP_DEFAULT)
+        keymap = get_keymap(keymap_name)
+        if keymap.name != keymap_name:
+            self.log.emit(f"⚠️ 找不到鍵盤配置「{keymap_name}」，改用 {keymap.name}")
+        transpose = int(self.settings["transpose"])
+        # auto transpose（只看勾選的音軌 / 聲道）
+        if self.settings["auto_transpose"]:
+            if streaming:
+                transpose, hit, total = pick_best_transpose_hist(index.pitch_histogram(excluded), keymap.mapping)
+            else:
+                transpose, hit, total = pick_best_transpose(timed, keymap.mapping)
+        velocity, kept, total_notes = index.velocity_threshold(self.settings, excluded)
+        params = SongParams(keymap, transpose, velocity, max(0, int(self.settings.get("max_chord", 0))))
+        mode = self.settings.get("velocity_mode", "fixed")
+        if mode != "fixed" and total_notes and not live:
+            rate = f"，平均 {kept / index.duration:.1f} 音/秒" if index.duration > 0 else ""
+            self.log.emit(f"🎚 自動力度門檻（{VELOCITY_MODES.get(mode, mode)}）：≥ {velocity}"
+                          f"（保留 {kept}/{total_notes} = {kept / total_notes:.1%}{rate}）")
+        if live:
+            self.log.emit(f"🔧 即時套用：{keymap.name}、Transpose {transpose:+d}、velocity ≥ {params.velocity}"
+                          + (f"、和弦上限 {params.max_chord}" if params.max_chord else ""))
+            return params
+        self.log.emit(f"⌨️ 鍵盤配置：{keymap.name}（{len(keymap)} 鍵）")
+        if not self.settings["auto_transpose"]:
+            self.log.emit(f"🎚 使用手動 Transpose：{transpose:+d}")
+        elif total > 0:
+            self.log.emit(f"🎯 Auto Transpose：{transpose:+d}（可彈 {hit}/{total} = {hit/total:.1%}）")
+        return params
 
-                if is_note_off:
-                    if key in self.pressed:
-                        self.kb.release(KeyCode.from_char(key))
-                        self.pressed.remove(key)
+    def _index_in_background(self, path: str):
+        """背景建完整索引；好了就當成一次即時設定變更，讓播放 thread 換上。"""
+        gen = self._song_gen
 
+        def work():
+            try:
+                index = load_midi_index(path)
+            except Exception as e:
+                self.log.emit(f"⚠️ 背景分析失敗：{e}")
+                return
+            with self._cv:
+                if gen != self._song_gen:
+                    return
+                self._full_index = index
+                self._live_pending = True
+                self._cv.notify_all()
+
+        threading.Thread(target=work, name="midi-index", daemon=True).start()
+
+    def _apply_live(self):
+        """播放 thread：換上新參數，之後的事件都用新值轉換；按著但新設定下對不上的鍵立刻放開。"""
+        with self._cv:
+            self._live_pending = False
+            full, self._full_index = self._full_index, None
+            settings_live, self._settings_live = self._settings_live, False
+        if full is not None:
+            _, excluded, timed, streaming = self._song
+            self._song = (full, excluded, timed, streaming)
+            METRICS.duration = full.duration
+            self.log.emit(f"📊 分析完成：{full.note_count()} 個音符、{fmt_time(full.duration)}")
+            if not settings_live and self._clock.now() >= self._t0:
+                self.log.emit("   已經開始彈了：保留開頭估計的移調 / 力度門檻（避免中途變調）")
+                return
+        params = self._params = self._resolve_params(live=True)
+        table = params.keymap.table
+        with self._kb_lock:
+            for note, key in list(self._held_notes.items()):
+                n = note + params.transpose
+                if (table[n] if 0 <= n < 128 else None) == key or key not in self.pressed:
+                    continue      # 還對得上；或是正在等的那一步剛轉換、還沒送出的（照原樣送，放鍵時放同一個）
+                del self._held_notes[note]
+                self.kb.release(key)
+                self.pressed.discard(key)
+
+    def _resolve_onset(self, group, held) -> list:
+        p = self._params
+        return onset_key_actions(group, p.transpose, p.velocity, p.keymap.table, p.max_chord, held)
+
+    def _onsets(self, events):
+        """(t_sec, msg) → 每個時間點一筆 (t_sec, resolve)。resolve 輪到那一步才用當下的 self._params 轉成按鍵，
+        所以中途改設定後，目前位置之後的排程都是用新值產生的。"""
+        held = self._held_notes
+        for group in group_by_onset(events):
+            yield group[0][0], functools.partial(self._resolve_onset, group, held)
+
+    def _ensure_child(self) -> bool:
+        """啟動（或沿用）獨立播放程序；失敗就記 log 並改在本程序播放。"""
+        try:
+            cpus = parse_cpu_list(self.settings.get("isolate_cpus", ""))
+        except ValueError:
+            self.log.emit(f"⚠️ isolate_cpus 格式錯誤：{self.settings.get('isolate_cpus')!r}（例：2,3 或 0-3），不綁定 CPU")
+            cpus = set()
+        if not self.proc.alive():
+            self.log.emit("🧩 啟動獨立播放程序…")
+        err = self.proc.ensure(self.settings.get("key_backend", "pynput"), cpus)
+        if err:
+            self.log.emit(f"⚠️ 獨立播放程序無法使用：{err}，改在本程序播放")
+            return False
+        self.log.emit(f"🧩 獨立程序播放（{self.proc.info}）")
+        return True
+
+    @staticmethod
+    def _child_params(params: SongParams) -> tuple:
+        return params.transpose, params.velocity, params.keymap.table, params.max_chord
+
+    def _play_isolated(self, timed, countdown: float, release_all_end: bool, frame_hz: int = 0,
+                       stall=(0.0, "skip")) -> bool:
+        """音符放進 shared memory 交給子程序播；這裡只轉送控制指令 / 新參數、收回報更新指標 / log。"""
+        notes = [(t_sec, msg.type == "note_on" and msg.velocity > 0, msg.note, msg.velocity)
+                 for t_sec, msg in timed if msg.type in ("note_on", "note_off")]
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(notes) * SCHEDULE_RECORD.size))
+        try:
+            for i, rec in enumerate(notes):
+                SCHEDULE_RECORD.pack_into(shm.buf, i * SCHEDULE_RECORD.size, *rec)
+            self.proc.send(("play", shm.name, len(notes), countdown, self._press_lead, self._release_lead,
+                            release_all_end, frame_hz, self._child_params(self._params), stall))
+            with self._cv:
+                self._child = True
+                # 子程序接手前就收到的指令補送過去
+                if self.stop_event.is_set():
+                    self.proc.send(("stop",))
+                if self._skip:
+                    self.proc.send(("skip",))
+                if self._paused:
+                    self.proc.send(("pause",))
+                if self._seek_to is not None:
+                    self.proc.send(("seek", self._seek_to))
+                    self._seek_to = None
+
+            state = "countdown"
+            while True:
+                if self._live_pending:
+                    with self._cv:
+                        self._live_pending = False
+                    self._params = self._resolve_params(live=True)
+                    self.proc.send(("params", self._child_params(self._params)))
+                msg = self.proc.recv(ISOLATE_POLL)
+                if msg is None:
+                    if not self.proc.alive():
+                        raise RuntimeError("獨立播放程序意外結束")
+                    continue
+                kind = msg[0]
+                if kind == "events":
+                    for t_sec, lateness, held in msg[1]:
+                        METRICS.dispatched(t_sec, lateness, held)
+                    METRICS.child_cpu(msg[2])
+                elif kind == "cpu":
+                    METRICS.child_cpu(msg[1])
+                elif kind == "state":
+                    prev, state = state, msg[1]
+                    METRICS.state = state
+                    if state == "paused":
+                        METRICS.held_keys = 0
+                        self.status.emit("已暫停")
+                        self.log.emit("⏸ 已暫停")
+                        continue
+                    if prev == "paused":
+                        self.log.emit("▶ 繼續播放")
+                    self.status.emit("播放中…" if state == "playing" else "倒數中…")
+                elif kind == "stall":
+                    self._on_stall(*msg[1:])
+                elif kind == "clock":
+                    METRICS.clock = (msg[1], msg[2])   # perf_counter 是全系統單調時鐘，跨程序可直接用
+                elif kind == "seeked":
+                    METRICS.position = msg[1]
+                    self.log.emit(f"⏩ 跳到 {fmt_time(msg[1])}")
+                elif kind == "error":
+                    self.log.emit(f"❌ 獨立播放程序：{msg[1]}")
+                elif kind == "done":
+                    if msg[1] == "stop":
+                        self.log.emit("🛑 已停止（倒數中）" if state == "countdown" else "🛑 已停止（播放中）")
+                        return False
+                    return True
         finally:
-            if release_all_end:
-                self._release_all()
-
-        return not self.stop_event.is_set()
+            with self._cv:
+                self._child = False
+            shm.close()
+            shm.unlink()
+
+    @profiled("play.dispatch")
+    def _dispatch(self, t_sec: float, actions, lead: float):
+        """送出這一步的按 / 放（幀對齊模式是一整格）；已按著的不重按、沒按的不放，一次交給送鍵後端。
+        落後排程超過卡頓門檻時由看門狗依策略決定送哪些。"""
+        with self._kb_lock:
+            lateness = self._clock.now() - self._t0 - (t_sec - lead)
+            actions = self._watchdog.filter(t_sec, lateness, actions)   # 可能先放開所有鍵，所以在去重之前
+            actions = [(press, key) for press, key in actions if press != (key in self.pressed)]
+            if not actions:
+                return
+            self.kb.send_batch(actions)
+            for press, key in actions:
+                if press:
+                    self.pressed.add(key)
+                else:
+                    self.pressed.discard(key)
+                METRICS.dispatched(t_sec, lateness, len(self.pressed))
 
     @Slot()
     def run(self):
         auto_next = bool(self.settings["auto_next"])
         loop_playlist = bool(self.settings["loop_playlist"])
+        METRICS.thread_started()
+        PROFILER.playing = True
 
         try:
-            while not self.stop_event.is_set():
-                if self.idx < 0 or self.idx >= len(self.play_list):
-                    break
-
-                cur = self.play_list[self.idx]
-
+            with self._cv:
+                cur = self._select(self.idx)
+                idx = self.idx
+            while cur is not None and not self.stop_event.is_set():
                 # 同步 UI highlight
                 if self.mode == "playlist":
-                    self.select_playlist_index.emit(self.idx)
+                    self.select_playlist_index.emit(idx)
                 elif self.mode == "folder":
-                    self.select_folder_index.emit(self.idx)
+                    self.select_folder_index.emit(idx)
 
                 ok = self._play_one(cur)
                 if not ok:
                     break
 
-                self.log.emit("✅ 此曲播放完畢")
-                self.status.emit("就緒")
-
-                if not auto_next:
+                skipped = self._skip
+                if not skipped:
+                    METRICS.song_finished(True)
+                self._skip = False
+                if skipped:
+                    self.log.emit("⏭ 跳到下一首")
+                else:
+                    self.log.emit("✅ 此曲播放完畢" + (f"（卡頓 {len(self._stalls)} 次，最長 {max(self._stalls) * 1000:.0f} ms）"
+                                                    if self._stalls else ""))
+                    self.status.emit("就緒")
+
+                if not auto_next and not skipped:
                     break
 
-                self.idx += 1
-                if self.idx >= len(self.play_list):
-                    if self.mode == "playlist" and loop_playlist:
-                        self.log.emit("🔁 播放清單循環：回到第一首")
-                        self.idx = 0
-                    else:
-                        self.log.emit("🏁 已到最後一首，停止。")
-                        break
+                # 換下一首要在 _cv 內一次做完：佇列同時被改時不會漏掉或重播
+                with self._cv:
+                    nxt = self.idx + 1
+                    wrapped = nxt >= len(self.play_list) and self.mode == "playlist" and loop_playlist
+                    cur = self._select(0 if wrapped else nxt)
+                    idx = self.idx
+                if wrapped and cur is not None:
+                    self.log.emit("🔁 播放清單循環：回到第一首")
+                elif cur is None:
+                    self.log.emit("🏁 已到最後一首，停止。")
+                    break
 
             self.log.emit("✅ 結束")
 
         except Exception as e:
             self.log.emit(f"❌ 發生錯誤：{e}")
+            METRICS.song_finished(False)
             try:
                 self._release_all()
             except Exception:
                 pass
         finally:
+            METRICS.thread_finished()
+            PROFILER.playing = False
+            if PROFILER.enabled and PROFILER.has_data():
+                try:
+                    self.log.emit(f"🧪 效能分析報告：{PROFILER.dump(self.settings)}")
+                except OSError as e:
+                    self.log.emit(f"⚠️ 效能分析報告寫入失敗：{e}")
             self.status.emit("就緒")
             self.finished.emit()
 
+def coerce_setting(k: str, v):
+    """檢查並轉成 DEFAULT_SETTINGS 的型別（API / 命令列共用）；未知鍵 KeyError、不合法的值 ValueError。"""
+    if k not in DEFAULT_SETTINGS:
+        raise KeyError(f"unknown setting: {k}")
+    default = DEFAULT_SETTINGS[k]
+    if k == "track_excluded":
+        v = {p: {tuple(int(x) for x in key) for key in keys} for p, keys in dict(v).items()}
+    elif isinstance(default, bool):
+        if isinstance(v, str) and v.strip().lower() in BOOL_STRINGS:
+            v = BOOL_STRINGS[v.strip().lower()]
+        elif isinstance(v, bool) or (isinstance(v, int) and v in (0, 1)):
+            v = bool(v)
+        else:
+            raise ValueError(f"{k} must be a boolean (true/false/1/0), got {v!r}")
+    else:
+        v = type(default)(v)
+    if k == "keymap" and v not in KEYMAPS:
+        raise ValueError(f"unknown keymap: {v}")
+    if k == "key_backend" and v not in KEY_BACKENDS:
+        raise ValueError(f"unknown key backend: {v}（可用：{', '.join(KEY_BACKENDS)}）")
+    if k in ("frame_hz", "max_chord", "stall_ms", "velocity_rate") and v < 0:
+        raise ValueError(f"{k} must be >= 0")
+    if k == "velocity_mode" and v not in VELOCITY_MODES:
+        raise ValueError(f"unknown velocity mode: {v}（可用：{', '.join(VELOCITY_MODES)}）")
+    if k == "velocity_share" and not 0 <= v <= 100:
+        raise ValueError("velocity_share must be 0–100")
+    if k == "stall_policy" and v not in STALL_POLICIES:
+        raise ValueError(f"unknown stall policy: {v}（可用：{', '.join(STALL_POLICIES)}）")
+    return v
+
+class PlayerService(QObject):
+    """常駐播放服務：擁有播放佇列、設定與 worker；Qt 視窗與本機 API 都只是它的 client。
+    佇列 / 開始 / 設定要在 service 所在 thread 呼叫（其他 thread 用 call()）；
+    停止 / 暫停 / 下一首 / 跳轉是 thread-safe，可從任何 thread 直接呼叫。"""
+
+    log = Signal(str)
+    status = Signal(str)
+    paused_changed = Signal(bool)
+    playing_changed = Signal(bool)
+    queue_changed = Signal()
+    settings_changed = Signal()
+    select_folder_index = Signal(int)
+    select_playlist_index = Signal(int)
+    _call = Signal(object)
+
+    def __init__(self, settings: dict | None = None):
+        super().__init__()
+        self.queue: list[str] = []
+        self.settings = dict(DEFAULT_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.mode = ""
+        self.proc = PlaybackProcess()
+        self._subscribers: list[queue.Queue] = []
+        self._sub_lock = threading.Lock()
+
+        # 常駐播放引擎：啟動時建立一次（thread、送鍵後端、KeyCode 表都先備好），之後每次播放只送指令
+        self.engine = PlayWorker(settings=dict(self.settings), proc=self.proc)
+        self.engine_thread = QThread()
+        self.engine.moveToThread(self.engine_thread)
+        self.engine_thread.started.connect(self.engine.serve)
+        self.engine.finished.connect(self._on_worker_finished)
+        self.engine.log.connect(self.log)
+        self.engine.status.connect(self.status)
+        self.engine.paused_changed.connect(self.paused_changed)
+        self.engine.select_folder_index.connect(self.select_folder_index)
+        self.engine.select_playlist_index.connect(self.select_playlist_index)
+        self.engine.select_playlist_index.connect(lambda i: self.publish("song", index=i, mode=self.mode))
+        self.engine.select_folder_index.connect(lambda i: self.publish("song", index=i, mode=self.mode))
+        self.engine_thread.start()
+        self.worker: PlayWorker | None = None    # 播放中 = self.engine，閒置 = None
+
+        self._call.connect(self._run_call, Qt.QueuedConnection)
+        self.log.connect(lambda text: self.publish("log", text=text))
+        self.status.connect(lambda text: self.publish("status", text=text))
+        self.paused_changed.connect(lambda paused: self.publish("paused", paused=paused))
+
+    # ---- 跨 thread 呼叫 ----
+    def call(self, fn, timeout: float = 10.0):
+        """在 service 所在 thread 執行 fn() 並等結果（HTTP thread 用）。"""
+        if QThread.currentThread() is self.thread():
+            return fn()
+        box = {}
+        done = threading.Event()
+        self._call.emit((fn, box, done))
+        if not done.wait(timeout):
+            raise TimeoutError("player service busy")
+        if "error" in box:
+            raise box["error"]
+        return box.get("result")
+
+    @Slot(object)
+    def _run_call(self, job):
+        fn, box, done = job
+        try:
+            box["result"] = fn()
+        except Exception as e:
+            box["error"] = e
+        finally:
+            done.set()
+
+    # ---- 事件推送（/api/events）----
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue(maxsize=API_SUBSCRIBER_BACKLOG)
+        with self._sub_lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._sub_lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def publish(self, event: str, **data):
+        with self._sub_lock:
+            subs = list(self._subscribers)
+        for q in subs:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                pass   # 太慢的 client 直接丟事件，不影響播放
+
+    # ---- 狀態 ----
+    def is_playing(self) -> bool:
+        return self.worker is not None
+
+    def is_paused(self) -> bool:
+        w = self.worker
+        return bool(w and w.is_paused())
+
+    def state(self) -> dict:
+        w = self.worker
+        return dict(
+            playing=w is not None,
+            paused=bool(w and w.is_paused()),
+            mode=self.mode if w else "",
+            index=w.idx if w else -1,
+            song=w.current_path if w else "",
+            position=round(METRICS.position, 3) if w else 0.0,
+            duration=round(METRICS.duration, 3) if w else 0.0,
+            queue=list(self.queue),
+            settings=self.settings_json(),
+        )
+
+    def settings_json(self) -> dict:
+        out = {k: v for k, v in self.settings.items() if k != "track_excluded"}
+        out["track_excluded"] = {p: sorted(list(k) for k in ex)
+                                 for p, ex in self.settings["track_excluded"].items()}
+        return out
+
+    # ---- 佇列 ----
+    def enqueue(self, paths, index: int | None = None) -> int:
+        added = []
+        for p in paths:
+            p = os.path.abspath(str(p).strip().strip('"'))
+            if not os.path.isfile(p):
+                self.log.emit(f"⚠️ 找不到檔案：{p}")
+                continue
+            if p in self.queue or p in added:
+                continue
+            added.append(p)
+        if added:
+            if index is None or not (0 <= int(index) <= len(self.queue)):
+                self.queue.extend(added)
+            else:
+                self.queue[int(index):int(index)] = added
+            self._queue_mutated()
+        return len(added)
+
+    def remove(self, indices) -> int:
+        rows = sorted({int(i) for i in indices if 0 <= int(i) < len(self.queue)}, reverse=True)
+        for r in rows:
+            self.queue.pop(r)
+        if rows:
+            self._queue_mutated()
+        return len(rows)
+
+    def move(self, src: int, dst: int) -> bool:
+        src, dst = int(src), int(dst)
+        if not (0 <= src < len(self.queue) and 0 <= dst < len(self.queue)) or src == dst:
+            return False
+        self.queue.insert(dst, self.queue.pop(src))
+        self._queue_mutated()
+        return True
+
+    def clear(self):
+        self.queue.clear()
+        self._queue_mutated()
+
+    def _queue_mutated(self):
+        # 播放清單模式下讓 worker 跟著新順序走，目前這首的位置不變
+        w = self.worker
+        if w and self.mode == "playlist":
+            w.set_play_list(self.queue)
+        self.queue_changed.emit()
+        self.publish("queue", queue=list(self.queue))
+
+    # ---- 設定 ----
+    def update_settings(self, **changes) -> dict:
+        """更新設定；播放中改 LIVE_SETTINGS 立即套用，其餘下一首起生效。未知鍵直接報錯。"""
+        for k, v in changes.items():
+            changes[k] = coerce_setting(k, v)
+        changed = {k: v for k, v in changes.items() if self.settings.get(k) != v}
+        if changed:
+            self.settings.update(changed)
+            live = {k: v for k, v in changed.items() if k in LIVE_SETTINGS}
+            if live and self.worker is not None:
+                self.worker.apply_live(live)
+            self.settings_changed.emit()
+            self.publish("settings", settings=self.settings_json())
+        return changed
+
+    # ---- 播放控制 ----
+    def play(self, mode: str, play_list: list[str], start_index: int) -> bool:
+        if self.worker is not None:
+            return False
+        if not play_list:
+            self.log.emit("⚠️ 沒有可播放的歌曲")
+            return False
+        self.mode = mode
+        start_index = max(0, min(int(start_index), len(play_list) - 1))
+
+        self.worker = self.engine
+        self.engine.submit_play(mode, play_list, start_index, dict(self.settings))
+        self.playing_changed.emit(True)
+        self.publish("playing", playing=True, mode=mode)
+        return True
+
+    def start(self, index: int | None = None) -> bool:
+        """播放佇列（播放清單模式）。"""
+        return self.play("playlist", self.queue, 0 if index is None else index)
+
+    @Slot()
+    def _on_worker_finished(self):
+        self.worker = None
+        self.mode = ""
+        self.playing_changed.emit(False)
+        self.publish("playing", playing=False)
+
+    def stop(self):
+        w = self.worker
+        if w:
+            w.stop()
+
+    def shutdown(self):
+        """關閉程式時呼叫：停止播放、結束引擎 thread，再結束獨立播放程序。"""
+        self.engine.shutdown()
+        self.engine_thread.quit()
+        self.engine_thread.wait(3000)
+        self.proc.shutdown()
+
+    def pause(self):
+        w = self.worker
+        if w:
+            w.pause()
+
+    def resume(self):
+        w = self.worker
+        if w:
+            w.resume()
+
+    def toggle_pause(self):
+        w = self.worker
+        if w:
+            w.resume() if w.is_paused() else w.pause()
+
+    def next_song(self):
+        w = self.worker
+        if w:
+            w.next_song()
+
+    def seek(self, t_sec: float):
+        w = self.worker
+        if w:
+            w.seek(t_sec)
+
+    # ---- API 指令（單筆或批次共用）----
+    def apply_op(self, op: str, args: dict):
+        if op == "state":
+            return self.state()
+        if op == "queue":
+            return list(self.queue)
+        if op == "enqueue":
+            paths = args.get("paths") or ([args["path"]] if "path" in args else [])
+            return {"added": self.enqueue(paths, args.get("index"))}
+        if op == "remove":
+            idx = args.get("indices", [args["index"]] if "index" in args else [])
+            return {"removed": self.remove(idx)}
+        if op == "move":
+            return {"moved": self.move(args["from"], args["to"])}
+        if op == "clear":
+            self.clear()
+            return {}
+        if op == "start":
+            return {"started": self.start(args.get("index"))}
+        if op == "stop":
+            self.stop()
+            return {}
+        if op == "pause":
+            self.pause()
+            return {}
+        if op == "resume":
+            self.resume()
+            return {}
+        if op == "next":
+            self.next_song()
+            return {}
+        if op == "seek":
+            self.seek(float(args["position"]))
+            return {}
+        if op == "settings":
+            return {"changed": list(self.update_settings(**args))}
+        raise KeyError(f"unknown op: {op}")
+
+    def apply_batch(self, ops) -> list:
+        results = []
+        for item in ops:
+            item = dict(item)
+            op = item.pop("op", "")
+            try:
+                results.append({"ok": True, "result": self.apply_op(op, item)})
+            except Exception as e:
+                results.append({"ok": False, "error": str(e)})
+        return results
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    service: PlayerService = None
+    token = ""
+
+    def _send_json(self, code: int, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        # 瀏覽器發的跨站請求一定帶 Origin；API 不提供網頁，只接受同一個本機位址來的
+        origin = self.headers.get("Origin")
+        if origin is not None and not _is_local_origin(origin, self.server.server_address[1]):
+            self._send_json(403, {"error": "forbidden origin"})
+            return False
+        if self.token and not hmac.compare_digest(self.headers.get("X-Auth-Token", ""), self.token):
+            self._send_json(401, {"error": "unauthorized"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/api/events":
+            self._stream_events()
+        elif path in ("/api/state", "/api/queue"):
+            op = path.rsplit("/", 1)[1]
+            self._send_json(200, self.service.call(lambda: self.service.apply_op(op, {})))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if not path.startswith("/api/"):
+            self._send_json(404, {"error": "not found"})
+            return
+        op = path[len("/api/"):].replace("/", "_")
+        # 只收 application/json：text/plain 這類「簡單請求」不用 CORS preflight 就能從任何網頁送來
+        length = int(self.headers.get("Content-Length") or 0)
+        ctype = self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if ctype != "application/json":
+            self._send_json(415, {"error": "Content-Type must be application/json"})
+            return
+        try:
+            args = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            if op == "batch":
+                result = self.service.call(lambda: self.service.apply_batch(args.get("ops", [])))
+            else:
+                op = {"queue_move": "move", "queue_remove": "remove", "queue_clear": "clear",
+                      "queue": "enqueue"}.get(op, op)
+                result = self.service.call(lambda: self.service.apply_op(op, args))
+        except Exception as e:
+            self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._send_json(200, result)
+
+    def _stream_events(self):
+        q = self.service.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self._send_event("state", self.service.state())
+            last_pos = None
+            while not getattr(self.server, "closing", False):
+                try:
+                    event, data = q.get(timeout=API_PROGRESS_INTERVAL)
+                    self._send_event(event, data)
+                except queue.Empty:
+                    pass
+                # 進度由這裡從 METRICS 取樣推送，播放 loop 不必為每個事件發訊號
+                if self.service.is_playing():
+                    pos = round(METRICS.position, 2)
+                    if pos != last_pos:
+                        last_pos = pos
+                        self._send_event("progress", dict(position=pos, duration=round(METRICS.duration, 2),
+                                                          song=METRICS.song, state=METRICS.state))
+                else:
+                    self.wfile.write(b": keep-alive\n\n")
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.service.unsubscribe(q)
+
+    def _send_event(self, event: str, data):
+        payload = json.dumps(data, ensure_ascii=False)
+        self.wfile.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+def is_loopback_host(host: str) -> bool:
+    if host.lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def _is_local_origin(origin: str, port: int) -> bool:
+    """Origin 是不是本機同一個 port（例 http://127.0.0.1:8766）。"""
+    scheme, _, rest = origin.partition("://")
+    host, _, origin_port = rest.rpartition(":")
+    return scheme == "http" and is_loopback_host(host.strip("[]")) and origin_port == str(port)
+
+class ControlServer:
+    """本機控制 API（daemon thread）：佇列、開始 / 停止 / 跳轉、設定、事件推送。"""
+
+    def __init__(self, service: PlayerService, host: str = API_HOST_DEFAULT,
+                 port: int = API_PORT_DEFAULT, token: str = ""):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.token = token
+        self._httpd = None
+
+    def start(self) -> str:
+        """回傳錯誤訊息（空字串=OK）。"""
+        self.stop()
+        if not self.token and not is_loopback_host(self.host):
+            return f"綁定非本機位址（{self.host}）必須設定 token"
+        handler = type("_BoundApiHandler", (_ApiHandler,), {"service": self.service, "token": self.token})
+        try:
+            self._httpd = ThreadingHTTPServer((self.host, self.port), handler)
+        except OSError as e:
+            self._httpd = None
+            return str(e)
+        self._httpd.daemon_threads = True
+        self._httpd.closing = False
+        threading.Thread(target=self._httpd.serve_forever, name="control-api", daemon=True).start()
+        return ""
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.closing = True
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+class PianoRoll(QWidget):
+    """鋼琴捲簾：只畫可視時間範圍內的音符（依開始時間排序 + bisect）；重畫只處理需要更新的那一塊。
+    滾輪捲動時間、Ctrl+滾輪縮放；播放游標超出畫面就翻頁。"""
+    KEY_W = 34   # 左側音名欄寬
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setMinimumSize(480, 220)
+        self.notes = []          # [(開始, 結束, 原音高, 狀態), ...]
+        self.starts = []
+        self.max_len = 0.0
+        self.lo, self.hi = 48, 84
+        self.mapped = set()      # 目前設定下有對應鍵的原音高（畫淡色底 = 鍵盤覆蓋範圍）
+        self.duration = 0.0
+        self.view_t = 0.0
+        self.span = 10.0
+        self.cursor = None
+        self._colors = [QColor(c) for c in PIANO_ROLL_COLORS]
+
+    def set_notes(self, notes: list, mapped: set, duration: float):
+        self.notes = notes
+        self.starts = [n[0] for n in notes]
+        self.max_len = max((b - a for a, b, _, _ in notes), default=0.0)
+        pitches = {n[2] for n in notes}
+        self.lo, self.hi = min(pitches, default=60) - 1, max(pitches, default=72) + 1
+        self.mapped = mapped
+        self.duration = duration
+        self.view_t = max(0.0, min(self.view_t, duration - self.span))
+        self.update()
+
+    def _x(self, t: float) -> float:
+        return self.KEY_W + (t - self.view_t) / self.span * (self.width() - self.KEY_W)
+
+    def _t(self, x: float) -> float:
+        return self.view_t + (x - self.KEY_W) / max(1, self.width() - self.KEY_W) * self.span
+
+    def set_cursor(self, t):
+        """播放位置（None = 不顯示）。只重畫游標新舊位置的窄條；超出畫面才整頁重畫。"""
+        if t is not None and not (self.view_t <= t < self.view_t + self.span):
+            self.view_t = max(0.0, t - self.span * 0.1)
+            self.cursor = t
+            self.update()
+            return
+        old, self.cursor = self.cursor, t
+        for c in (old, t):
+            if c is not None:
+                self.update(int(self._x(c)) - 2, 0, 5, self.height())
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if event.modifiers() & Qt.ControlModifier:
+            anchor = self._t(event.position().x())
+            span = min(max(self.span * 0.8 ** steps, PIANO_ROLL_SPAN[0]), PIANO_ROLL_SPAN[1])
+            self.view_t = max(0.0, anchor - (anchor - self.view_t) * span / self.span)
+            self.span = span
+        else:
+            self.view_t = max(0.0, min(self.view_t - steps * self.span * 0.1, self.duration - self.span * 0.5))
+        self.update()
+
+    def paintEvent(self, event):
+        p = QPainter(self)
+        rect = event.rect()
+        pal = self.palette()
+        w, h = self.width(), self.height()
+        row_h = h / (self.hi - self.lo + 1)
+        p.fillRect(rect, pal.base())
+
+        tint = QColor(pal.highlight().color())
+        tint.setAlpha(30)
+        for n in range(self.lo, self.hi + 1):
+            if n in self.mapped:
+                p.fillRect(QRectF(self.KEY_W, (self.hi - n) * row_h, w - self.KEY_W, row_h), tint)
+
+        # 只找和重畫範圍重疊的音符：開始時間在 [a - 最長音符, b] 之間
+        a, b = self._t(rect.left() - 1), self._t(rect.right() + 1)
+        lo_i = bisect_left(self.starts, a - self.max_len)
+        hi_i = bisect_right(self.starts, b)
+        for start, end, n, state in islice(self.notes, lo_i, hi_i):
+            if end < a:
+                continue
+            x0 = self._x(start)
+            p.fillRect(QRectF(x0, (self.hi - n) * row_h + 1, max(self._x(end) - x0, 2.0), max(row_h - 2, 1.0)),
+                       self._colors[state])
+
+        if rect.left() < self.KEY_W:
+            p.fillRect(QRectF(0, 0, self.KEY_W, h), pal.window())
+            p.setPen(pal.text().color())
+            for n in range(self.lo, self.hi + 1):
+                if n % 12 == 0:
+                    p.drawText(QRectF(2, (self.hi - n) * row_h - 6, self.KEY_W - 4, row_h + 12),
+                               Qt.AlignLeft | Qt.AlignVCenter, note_name(n))
+        if self.cursor is not None:
+            x = self._x(self.cursor)
+            if self.KEY_W <= x <= w:
+                p.setPen(pal.text().color())
+                p.drawLine(int(x), 0, int(x), h)
+        p.end()
+
 class MainWindow(QMainWindow):
+    hotkey_start = Signal()
+    calibration_done = Signal(object)
+    library_meta = Signal(object)    # 背景分析結果：[(path, stamp, duration, hist), ...]
+    library_found = Signal(int, object)          # 背景掃描：(第幾次掃描, [(path, 顯示名稱), ...])
+    library_scanned = Signal(int, object, bool)  # 掃描結束：(第幾次掃描, 走過的資料夾, 是否被取消)
+    track_index_ready = Signal(str, str)          # 大檔背景分析完成：(path, 錯誤訊息)
+    optimize_report = Signal(str, bool)          # 背景精簡 MIDI：(log 文字, 是否全部完成)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("MIDI AutoPlay — Modern (Fixed v2)")
@@ -263,12 +3692,76 @@ class MainWindow(QMainWindow):
         self.setMinimumSize(900, 650)
 
         self.mid_files: list[str] = []
-        self.playlist: list[str] = []
-
-        self.worker_thread: QThread | None = None
-        self.worker: PlayWorker | None = None
+        self.track_excluded: dict[str, set] = {}   # path -> 取消勾選的 (track, channel)
+        self._tracks_path = ""
+        self._pushing = False                      # 自己送出的設定變更：不要再同步回畫面
+        self._keymap_hint = None                   # (配置名稱, transpose)
+        self._perf_mode = False                    # 播放中：拿掉陰影、log / 狀態列節流
+        self._pending_log: list[str] = []
+        self._pending_status = None
+        self._ui_flush = QTimer(self)
+        self._ui_flush.setSingleShot(True)         # 有東西要顯示才排一次，閒著不會醒來
+        self._ui_flush.setInterval(UI_PERF_FLUSH_MS)
+        self._ui_flush.timeout.connect(self._flush_ui)
+        self._progress_timer = QTimer(self)          # 只在播放中跑
+        self._progress_timer.setInterval(UI_PROGRESS_MS)
+        self._progress_timer.timeout.connect(self._update_progress)
+        self._progress_text = ""
+        self._progress_index = None                  # 目前這首的 MidiIndex（算小節 / 拍）
+        self._preview = None                         # 鋼琴捲簾預覽視窗（第一次打開才建立）
+        self._preview_key = None
+        self._roll_timer = QTimer(self)              # 預覽視窗開著時跟隨播放游標
+        self._roll_timer.setInterval(1000 // PIANO_ROLL_FPS)
+        self._roll_timer.timeout.connect(self._follow_roll_cursor)
+        keymap_errors = reload_keymaps()
+        self.library = LibraryIndex()
+        self.library.load_cache(self._library_cache_path())
+        self._meta_cancel = threading.Event()
+        self._scan_cancel = threading.Event()       # set = 沒有在掃描
+        self._scan_cancel.set()
+        self._scan_gen = 0                           # 每次重新掃描 +1，舊掃描送來的結果直接丟掉
+        self._scan_seen: set[str] = set()
+        self._scan_select = ""                       # 掃到這個檔就選取它（挑檔案後）
+        self._scan_started = 0.0
+        self._optimize_cancel = threading.Event()
 
         self._build_ui()
+        s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+        roots = str(s.value("library/roots", "") or "")
+        if roots:
+            self.ed_folder.setText(roots)
+        self._fill_keymaps(str(s.value("keymap/name", KEYMAP_DEFAULT)))
+        backend = str(s.value("keys/backend", DEFAULT_SETTINGS["key_backend"]))
+        self.cb_backend.setCurrentText(backend if backend in KEY_BACKENDS else DEFAULT_SETTINGS["key_backend"])
+        self.sp_frame_hz.setValue(int(s.value("keys/frame_hz", DEFAULT_SETTINGS["frame_hz"], type=int)))
+        for err in keymap_errors:
+            self._log(f"⚠️ 鍵盤配置讀取失敗：{err}")
+
+        # 播放佇列 / 設定 / worker 都在 service；視窗只是其中一個 client
+        self.service = PlayerService(settings=self._settings())
+        self.service.log.connect(self._log)
+        self.service.status.connect(self._show_status)
+        self.service.paused_changed.connect(self._on_paused_changed)
+        self.service.playing_changed.connect(self._on_playing_changed)
+        self.service.queue_changed.connect(self.refresh_playlist_ui)
+        self.service.settings_changed.connect(self._load_service_settings)
+        self.service.select_folder_index.connect(self._select_folder_row)
+        self.service.select_playlist_index.connect(self._select_playlist_row)
+        for sig in (self.sp_transpose.valueChanged, self.sp_velocity.valueChanged,
+                    self.sp_countdown.valueChanged, self.chk_auto_tr.toggled,
+                    self.chk_release.toggled, self.chk_auto_next.toggled,
+                    self.chk_loop.toggled, self.chk_stream.toggled,
+                    self.chk_latency.toggled, self.chk_isolate.toggled,
+                    self.cb_keymap.currentTextChanged, self.sp_frame_hz.valueChanged,
+                    self.sp_max_chord.valueChanged, self.sp_stall.valueChanged,
+                    self.cb_stall.currentIndexChanged, self.cb_velocity_mode.currentIndexChanged,
+                    self.sp_velocity_rate.valueChanged, self.sp_velocity_share.valueChanged):
+            sig.connect(self._push_settings)
+        self.cb_backend.currentTextChanged.connect(self._on_backend_changed)
+        self.sp_frame_hz.valueChanged.connect(
+            lambda hz: QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("keys/frame_hz", hz))
+        self.calibration_done.connect(self._on_calibration_done)
+        self._update_latency_tip()
         self._set_std_icon(self.btn_pick_folder, "SP_DialogOpenButton")
         self._set_std_icon(self.btn_refresh,     "SP_BrowserReload")
         self._set_std_icon(self.btn_import,      "SP_FileDialogNewFolder")
@@ -280,12 +3773,52 @@ class MainWindow(QMainWindow):
         self._set_std_icon(self.btn_clear,       "SP_DialogResetButton")
         self._set_std_icon(self.btn_start,       "SP_MediaPlay")
         self._set_std_icon(self.btn_stop,        "SP_MediaStop")
+        self._set_std_icon(self.btn_pause,       "SP_MediaPause")
 
-        self.ed_folder.setPlaceholderText("選擇包含 .mid / .midi 的資料夾…")
+        self.ed_folder.setPlaceholderText("選擇包含 .mid / .midi 的資料夾…（多個用 ; 分隔，含子資料夾）")
         self.ed_midi.setPlaceholderText("選擇一個 MIDI 檔案…（或從清單雙擊）")
 
         self.refresh_midi_list()
 
+        # 全域快捷鍵：停止 / 暫停 / 下一首直接打到 worker；開始需要 UI 狀態，走 queued signal
+        self.hotkey_start.connect(self._on_hotkey_start)
+        self.hotkeys = GlobalHotkeys(self._load_hotkeys(), {
+            "start": self.hotkey_start.emit,
+            "stop": self.service.stop,
+            "pause": self.service.toggle_pause,
+            "next": self.service.next_song,
+        })
+        self._start_hotkeys()
+
+        # 指標伺服器：設定存在 QSettings（metrics/enabled、metrics/host、metrics/port）
+        s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+        self.metrics_server = MetricsServer(
+            str(s.value("metrics/host", METRICS_HOST_DEFAULT)),
+            int(s.value("metrics/port", METRICS_PORT_DEFAULT, type=int)),
+        )
+        self.chk_metrics.setToolTip(f"http://{self.metrics_server.host}:{self.metrics_server.port}/metrics")
+        self.chk_metrics.setChecked(bool(s.value("metrics/enabled", False, type=bool)))
+        self.chk_metrics.toggled.connect(self._toggle_metrics)
+        if self.chk_metrics.isChecked():
+            self._toggle_metrics(True)
+
+        # 控制 API：api/enabled、api/host、api/port、api/token
+        self.control_server = ControlServer(
+            self.service,
+            str(s.value("api/host", API_HOST_DEFAULT)),
+            int(s.value("api/port", API_PORT_DEFAULT, type=int)),
+            str(s.value("api/token", "")),
+        )
+        self._update_api_tip()
+        self.chk_api.setChecked(bool(s.value("api/enabled", False, type=bool)))
+        self.chk_api.toggled.connect(self._toggle_api)
+        if self.chk_api.isChecked():
+            self._toggle_api(True)
+
+    @property
+    def playlist(self) -> list[str]:
+        return self.service.queue
+
     def _default_folder(self) -> str:
         try:
             return os.path.dirname(os.path.abspath(__file__))
@@ -321,11 +3854,17 @@ class MainWindow(QMainWindow):
         row.addWidget(self.ed_folder, 1)
 
         self.btn_pick_folder = QPushButton("選擇資料夾")
+        self.btn_add_folder = QPushButton("＋")
+        self.btn_add_folder.setToolTip("再加一個資料夾（多個根目錄一起掃描）")
         self.btn_refresh = QPushButton("重新整理")
         self.btn_import = QPushButton("加入 MIDI（複製到此資料夾）")
+        self.btn_optimize = QPushButton("🗜 精簡…")
+        self.btn_optimize.setToolTip("把選取的 MIDI（沒選 = 目前顯示的全部）輸出成只有音符與速度的單軌精簡版，原檔不動")
         row.addWidget(self.btn_pick_folder)
+        row.addWidget(self.btn_add_folder)
         row.addWidget(self.btn_refresh)
         row.addWidget(self.btn_import)
+        row.addWidget(self.btn_optimize)
 
         # splitter: folder list + playlist
         splitter = QSplitter(Qt.Horizontal)
@@ -339,6 +3878,32 @@ class MainWindow(QMainWindow):
         left_layout.setSpacing(6)
         left_layout.addWidget(QLabel("資料夾內 MIDI（可 Ctrl/Shift 多選）"))
 
+        # 搜尋 + 篩選（索引在背景建好，打字即時過濾）
+        rows_ = QHBoxLayout()
+        rows_.setSpacing(6)
+        left_layout.addLayout(rows_)
+        self.ed_search = QLineEdit()
+        self.ed_search.setPlaceholderText("搜尋檔名（不分全形 / 半形、平假名 / 片假名）…")
+        self.ed_search.setClearButtonEnabled(True)
+        rows_.addWidget(self.ed_search, 1)
+        self.sp_max_minutes = QSpinBox()
+        self.sp_max_minutes.setRange(0, 60)
+        self.sp_max_minutes.setPrefix("≤ ")
+        self.sp_max_minutes.setSuffix(" 分")
+        self.sp_max_minutes.setSpecialValueText("時長不限")
+        self.sp_max_minutes.setToolTip("只顯示不超過這個長度的曲子（0 = 不限）")
+        rows_.addWidget(self.sp_max_minutes)
+        self.sp_min_playable = QSpinBox()
+        self.sp_min_playable.setRange(0, 100)
+        self.sp_min_playable.setSingleStep(5)
+        self.sp_min_playable.setPrefix("可彈 ≥ ")
+        self.sp_min_playable.setSuffix("%")
+        self.sp_min_playable.setSpecialValueText("可彈不限")
+        self.sp_min_playable.setToolTip("用目前的鍵盤配置、最佳移調計算可彈到的音符比例（0 = 不限）")
+        rows_.addWidget(self.sp_min_playable)
+        self.lbl_library = QLabel("")
+        left_layout.addWidget(self.lbl_library)
+
         self.list_folder = QListWidget()
         self.list_folder.setSelectionMode(QAbstractItemView.ExtendedSelection)
         # ★★★ 強制設定垂直滾動條為永遠顯示 ★★★
@@ -383,7 +3948,7 @@ class MainWindow(QMainWindow):
         self.btn_down = QPushButton("下移")
         self.btn_clear = QPushButton("清空")
         self.chk_loop = QCheckBox("循環播放清單")
-        self.chk_loop.setChecked(True)
+        self.chk_loop.setChecked(DEFAULT_SETTINGS["loop_playlist"])
 
         rowp.addWidget(self.btn_add)
         rowp.addWidget(self.btn_remove)
@@ -408,13 +3973,17 @@ class MainWindow(QMainWindow):
         # 左：目前 MIDI
         self.g_cur = QGroupBox("目前 MIDI")
         self.g_cur.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
-        self.g_cur.setMinimumHeight(100)
+        self.g_cur.setMinimumHeight(160)
         self._card_shadow(self.g_cur, alpha=self._shadow_alpha)
         bottom.addWidget(self.g_cur, 3)
 
-        rowc = QHBoxLayout(self.g_cur)
-        rowc.setContentsMargins(14, 12, 14, 12)
+        v_cur = QVBoxLayout(self.g_cur)
+        v_cur.setContentsMargins(14, 12, 14, 12)
+        v_cur.setSpacing(8)
+
+        rowc = QHBoxLayout()
         rowc.setSpacing(10)
+        v_cur.addLayout(rowc)
         rowc.addWidget(QLabel("檔案："), 0)
         self.ed_midi = QLineEdit("")
         self.ed_midi.setMinimumHeight(36)
@@ -423,6 +3992,33 @@ class MainWindow(QMainWindow):
         self.btn_pick_file.setMinimumHeight(36)
         rowc.addWidget(self.btn_pick_file)
 
+        # 音軌 / 聲道勾選（取消勾選的不播、也不列入 Auto Transpose）
+        self.list_tracks = QListWidget()
+        self.list_tracks.setMaximumHeight(110)
+        self.list_tracks.setToolTip("取消勾選的音軌 / 聲道不會播放，Auto Transpose 也只看勾選的部分")
+        v_cur.addWidget(self.list_tracks, 1)
+
+        # 鍵盤配置：對應遊戲裡不同樂器 / 自訂配置（keymaps/*.json）
+        rowk = QHBoxLayout()
+        rowk.setSpacing(10)
+        v_cur.addLayout(rowk)
+        rowk.addWidget(QLabel("鍵盤配置："), 0)
+        self.cb_keymap = QComboBox()
+        self.cb_keymap.setMinimumHeight(32)
+        self.cb_keymap.setMinimumWidth(140)
+        rowk.addWidget(self.cb_keymap)
+        self.btn_keymap_reload = QPushButton("重新載入")
+        self.btn_keymap_reload.setToolTip(f"重新讀取程式旁 {KEYMAP_DIR}/ 資料夾內的 *.json 配置")
+        rowk.addWidget(self.btn_keymap_reload)
+        self.lbl_keymap_hint = QLabel("")
+        rowk.addWidget(self.lbl_keymap_hint, 1)
+        self.btn_keymap_apply = QPushButton("套用建議")
+        self.btn_keymap_apply.setEnabled(False)
+        rowk.addWidget(self.btn_keymap_apply)
+        self.btn_preview = QPushButton("🎹 預覽")
+        self.btn_preview.setToolTip("鋼琴捲簾：依目前設定顯示哪些音會送出、哪些沒有對應鍵 / 被省略")
+        rowk.addWidget(self.btn_preview)
+
         # 右：設定（放大）
         self.g_set = QGroupBox("設定")
         self.g_set.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
@@ -442,7 +4038,7 @@ class MainWindow(QMainWindow):
         lbl_tr.setFont(label_font)
         self.sp_transpose = QSpinBox()
         self.sp_transpose.setRange(-60, 60)
-        self.sp_transpose.setValue(0)
+        self.sp_transpose.setValue(DEFAULT_SETTINGS["transpose"])
         self.sp_transpose.setMinimumHeight(32)
         self.sp_transpose.setMinimumWidth(80)
 
@@ -450,7 +4046,7 @@ class MainWindow(QMainWindow):
         lbl_vel.setFont(label_font)
         self.sp_velocity = QSpinBox()
         self.sp_velocity.setRange(0, 127)
-        self.sp_velocity.setValue(1)
+        self.sp_velocity.setValue(DEFAULT_SETTINGS["velocity"])
         self.sp_velocity.setMinimumHeight(32)
         self.sp_velocity.setMinimumWidth(80)
 
@@ -459,22 +4055,121 @@ class MainWindow(QMainWindow):
         self.sp_countdown = QDoubleSpinBox()
         self.sp_countdown.setRange(0, 30)
         self.sp_countdown.setSingleStep(0.5)
-        self.sp_countdown.setValue(3.0)
+        self.sp_countdown.setValue(DEFAULT_SETTINGS["countdown"])
         self.sp_countdown.setMinimumHeight(32)
         self.sp_countdown.setMinimumWidth(80)
 
         self.chk_auto_tr = QCheckBox("Auto Transpose")
-        self.chk_auto_tr.setChecked(True)
+        self.chk_auto_tr.setChecked(DEFAULT_SETTINGS["auto_transpose"])
         self.chk_auto_tr.setFont(label_font)
 
         self.chk_release = QCheckBox("結束放鍵")
-        self.chk_release.setChecked(True)
+        self.chk_release.setChecked(DEFAULT_SETTINGS["release_all_at_end"])
         self.chk_release.setFont(label_font)
 
         self.chk_auto_next = QCheckBox("自動下一首")
-        self.chk_auto_next.setChecked(True)
+        self.chk_auto_next.setChecked(DEFAULT_SETTINGS["auto_next"])
         self.chk_auto_next.setFont(label_font)
 
+        self.chk_stream = QCheckBox("串流模式")
+        self.chk_stream.setChecked(DEFAULT_SETTINGS["stream"])
+        self.chk_stream.setFont(label_font)
+        self.chk_stream.setToolTip(f"邊解析邊播，記憶體固定；超過 {STREAM_THRESHOLD_BYTES // (1024 * 1024)} MB 的檔案一律使用")
+
+        self.chk_metrics = QCheckBox("指標伺服器")
+        self.chk_metrics.setFont(label_font)
+
+        self.chk_api = QCheckBox("控制 API")
+        self.chk_api.setFont(label_font)
+
+        self.chk_latency = QCheckBox("延遲補償")
+        self.chk_latency.setChecked(DEFAULT_SETTINGS["latency_comp"])
+        self.chk_latency.setFont(label_font)
+
+        self.btn_calibrate = QPushButton("校準延遲")
+        self.btn_calibrate.setToolTip("量測目前送鍵後端的 press / release 延遲（會送出 F20 鍵），結果依機器保存")
+
+        self.chk_isolate = QCheckBox("獨立程序播放")
+        self.chk_isolate.setChecked(DEFAULT_SETTINGS["isolate"])
+        self.chk_isolate.setFont(label_font)
+        self.chk_isolate.setToolTip("在提高優先權的子程序送鍵，不受視窗重繪影響（綁定 CPU：API 設定 isolate_cpus，例如 \"2,3\"）")
+
+        lbl_backend = QLabel("送鍵:")
+        lbl_backend.setFont(label_font)
+        self.cb_backend = QComboBox()
+        self.cb_backend.addItems(list(KEY_BACKENDS))
+        self.cb_backend.setMinimumHeight(32)
+        self.cb_backend.setToolTip("送鍵後端；sendinput（僅 Windows）每一批按鍵只呼叫一次 SendInput，用掃描碼送出")
+
+        self.sp_frame_hz = QSpinBox()
+        self.sp_frame_hz.setRange(0, 1000)
+        self.sp_frame_hz.setSingleStep(30)
+        self.sp_frame_hz.setSuffix(" Hz")
+        self.sp_frame_hz.setSpecialValueText("不對齊")
+        self.sp_frame_hz.setValue(DEFAULT_SETTINGS["frame_hz"])
+        self.sp_frame_hz.setMinimumHeight(32)
+        self.sp_frame_hz.setToolTip("把送鍵對齊到遊戲幀率（例如 60 / 120），同一幀的按 / 放一次送出；"
+                                    "同一幀裡同一鍵先按後放的短音會延到下一幀放開")
+
+        lbl_chord = QLabel("和弦上限:")
+        lbl_chord.setFont(label_font)
+        self.sp_max_chord = QSpinBox()
+        self.sp_max_chord.setRange(0, 16)
+        self.sp_max_chord.setSpecialValueText("不限")
+        self.sp_max_chord.setValue(DEFAULT_SETTINGS["max_chord"])
+        self.sp_max_chord.setMinimumHeight(32)
+        self.sp_max_chord.setToolTip("同一時間最多按幾個鍵（保留高音）；遊戲吃不下太多同時按鍵時調小。播放中可直接調整")
+
+        lbl_stall = QLabel("卡頓:")
+        lbl_stall.setFont(label_font)
+        self.sp_stall = QSpinBox()
+        self.sp_stall.setRange(0, 2000)
+        self.sp_stall.setSingleStep(25)
+        self.sp_stall.setSuffix(" ms")
+        self.sp_stall.setSpecialValueText("不偵測")
+        self.sp_stall.setValue(DEFAULT_SETTINGS["stall_ms"])
+        self.sp_stall.setMinimumHeight(32)
+        self.sp_stall.setToolTip("送鍵落後排程超過這麼多就算卡頓（電腦忙、GC、讀硬碟），記在 log 與播放完畢的摘要")
+        self.cb_stall = QComboBox()
+        for policy, label in STALL_POLICIES.items():
+            self.cb_stall.addItem(label, policy)
+        self.cb_stall.setCurrentIndex(self.cb_stall.findData(DEFAULT_SETTINGS["stall_policy"]))
+        self.cb_stall.setMinimumHeight(32)
+        self.cb_stall.setToolTip("卡頓時落後的按鍵怎麼處理：跳過（回到排程位置）、補送（擠在一起送出），"
+                                 "或一偵測到就先放開所有鍵再跳過")
+
+        lbl_vmode = QLabel("力度門檻:")
+        lbl_vmode.setFont(label_font)
+        self.cb_velocity_mode = QComboBox()
+        for mode, label in VELOCITY_MODES.items():
+            self.cb_velocity_mode.addItem(label, mode)
+        self.cb_velocity_mode.setCurrentIndex(self.cb_velocity_mode.findData(DEFAULT_SETTINGS["velocity_mode"]))
+        self.cb_velocity_mode.setMinimumHeight(32)
+        self.cb_velocity_mode.setToolTip("每首依力度分布自動調高 Velocity 門檻，省略最輕的音符（Velocity ≥ 當下限）；"
+                                         "自動模式最多省略一半的音符")
+        self.sp_velocity_rate = QDoubleSpinBox()
+        self.sp_velocity_rate.setRange(1, 100)
+        self.sp_velocity_rate.setSingleStep(1)
+        self.sp_velocity_rate.setDecimals(1)
+        self.sp_velocity_rate.setSuffix(" 音/秒")
+        self.sp_velocity_rate.setValue(DEFAULT_SETTINGS["velocity_rate"])
+        self.sp_velocity_rate.setMinimumHeight(32)
+        self.sp_velocity_rate.setToolTip("限制每秒音符數：整首平均每秒最多這麼多個音符")
+        self.sp_velocity_share = QSpinBox()
+        self.sp_velocity_share.setRange(int(VELOCITY_AUTO_MIN_SHARE * 100), 100)
+        self.sp_velocity_share.setSuffix(" %")
+        self.sp_velocity_share.setValue(DEFAULT_SETTINGS["velocity_share"])
+        self.sp_velocity_share.setMinimumHeight(32)
+        self.sp_velocity_share.setToolTip("保留一定比例：至少保留這麼多的音符，只省略最輕的那些")
+        self.cb_velocity_mode.currentIndexChanged.connect(self._update_velocity_mode_ui)
+        self._update_velocity_mode_ui()
+
+        self.chk_profile = QCheckBox("效能分析")
+        self.chk_profile.setChecked(PROFILER.enabled)
+        self.chk_profile.setFont(label_font)
+        self.chk_profile.setToolTip(f"記錄各階段耗時、GC、cProfile 與記憶體；每次播放結束寫出報告到 {PROFILE_DIR}/")
+        self.chk_profile.toggled.connect(self._toggle_profile)
+
         self.chk_dark = QCheckBox("深色")
         self.chk_dark.setChecked(dark)
         self.chk_dark.setFont(label_font)
@@ -491,6 +4186,29 @@ class MainWindow(QMainWindow):
         grid.addWidget(self.chk_release,   1, 2, 1, 2)
         grid.addWidget(self.chk_auto_next, 1, 4, 1, 2)
         grid.addWidget(self.chk_dark,      2, 0, 1, 2, Qt.AlignLeft)
+        grid.addWidget(self.chk_stream,    3, 0, 1, 2)
+        grid.addWidget(self.chk_metrics,   3, 2, 1, 2)
+        grid.addWidget(self.chk_api,       3, 4, 1, 2)
+        grid.addWidget(self.chk_latency,   4, 0, 1, 2)
+        grid.addWidget(self.btn_calibrate, 4, 2, 1, 2)
+        grid.addWidget(self.chk_profile,   4, 4, 1, 2)
+        grid.addWidget(self.chk_isolate,   5, 0, 1, 2)
+        grid.addWidget(lbl_backend,        5, 2, Qt.AlignRight)
+        grid.addWidget(self.cb_backend,    5, 3)
+        grid.addWidget(self.sp_frame_hz,   5, 4, 1, 2)
+        grid.addWidget(lbl_chord,          6, 0, Qt.AlignRight)
+        grid.addWidget(self.sp_max_chord,  6, 1)
+        grid.addWidget(lbl_stall,          6, 2, Qt.AlignRight)
+        grid.addWidget(self.sp_stall,      6, 3)
+        grid.addWidget(self.cb_stall,      6, 4, 1, 2)
+        grid.addWidget(lbl_vmode,          7, 0, Qt.AlignRight)
+        grid.addWidget(self.cb_velocity_mode,  7, 1)
+        grid.addWidget(self.sp_velocity_rate,  7, 2, 1, 2)
+        grid.addWidget(self.sp_velocity_share, 7, 4, 1, 2)
+
+        self.btn_hotkeys = QPushButton("快捷鍵…")
+        self.btn_hotkeys.setMinimumHeight(40)
+        grid.addWidget(self.btn_hotkeys, 2, 2, 1, 1)
 
         self.btn_start = QPushButton("▶ 開始")
         self.btn_start.setObjectName("primary")
@@ -503,15 +4221,34 @@ class MainWindow(QMainWindow):
         self.btn_stop.setMinimumHeight(40)
         self.btn_stop.setMinimumWidth(100)
 
+        self.btn_pause = QPushButton("⏸ 暫停")
+        self.btn_pause.setEnabled(False)
+        self.btn_pause.setMinimumHeight(40)
+        self.btn_pause.setMinimumWidth(100)
+
+        grid.addWidget(self.btn_pause, 2, 3, 1, 1)
         grid.addWidget(self.btn_start, 2, 4, 1, 1)
         grid.addWidget(self.btn_stop,  2, 5, 1, 1)
 
         # =======================
-        # 3) 下方：Log
+        # 3) 下方：進度 + Log
         # =======================
+        prog_row = QHBoxLayout()
+        self.progress = QProgressBar()
+        self.progress.setRange(0, 1000)
+        self.progress.setValue(0)
+        self.progress.setTextVisible(False)
+        self.progress.setMaximumHeight(10)
+        self.lbl_position = QLabel("—")
+        self.lbl_position.setFont(label_font)
+        prog_row.addWidget(self.progress, 1)
+        prog_row.addWidget(self.lbl_position)
+        root.addLayout(prog_row)
+
         self.log = QPlainTextEdit()
         self.log.setReadOnly(True)
         self.log.setMinimumHeight(120)
+        self.log.setMaximumBlockCount(UI_LOG_MAX_LINES)
         root.addWidget(self.log, 1)
 
         sb = QStatusBar()
@@ -522,12 +4259,29 @@ class MainWindow(QMainWindow):
         # signals
         # =======================
         self.btn_pick_folder.clicked.connect(self.pick_folder)
-        self.btn_refresh.clicked.connect(self.refresh_midi_list)
+        self.btn_add_folder.clicked.connect(self.add_folder)
+        self.btn_refresh.clicked.connect(self._on_refresh_clicked)
+        self.ed_folder.returnPressed.connect(self.refresh_midi_list)
         self.btn_import.clicked.connect(self.import_midis)
+        self.btn_optimize.clicked.connect(self.optimize_midis)
+        self.optimize_report.connect(self._on_optimize_report)
         self.btn_pick_file.clicked.connect(self.pick_file)
 
         self.list_folder.itemSelectionChanged.connect(self.on_folder_select)
+        self.ed_midi.textChanged.connect(lambda _text: self.refresh_track_list())
+        self.list_tracks.itemChanged.connect(self.on_track_toggled)
+        self.cb_keymap.currentTextChanged.connect(self._on_keymap_changed)
+        self.library_meta.connect(self._on_library_meta)
+        self.library_found.connect(self._on_library_found)
+        self.library_scanned.connect(self._on_library_scanned)
+        self.track_index_ready.connect(self._on_track_index_ready)
+        self.btn_keymap_reload.clicked.connect(self.reload_keymaps)
+        self.btn_keymap_apply.clicked.connect(self.apply_keymap_hint)
+        self.btn_preview.clicked.connect(self.show_preview)
         self.list_folder.itemDoubleClicked.connect(self.on_folder_double)
+        self.ed_search.textChanged.connect(self.apply_library_filter)
+        self.sp_max_minutes.valueChanged.connect(self.apply_library_filter)
+        self.sp_min_playable.valueChanged.connect(self.apply_library_filter)
 
         self.btn_add.clicked.connect(self.add_selected_to_playlist)
         self.btn_remove.clicked.connect(self.remove_selected_from_playlist)
@@ -539,6 +4293,9 @@ class MainWindow(QMainWindow):
 
         self.btn_start.clicked.connect(self.start)
         self.btn_stop.clicked.connect(self.stop)
+        self.btn_pause.clicked.connect(self.toggle_pause)
+        self.btn_hotkeys.clicked.connect(self.edit_hotkeys)
+        self.btn_calibrate.clicked.connect(self.calibrate)
 
         self._log("✅ 系統就緒！請選擇 MIDI 資料夾或檔案開始播放\n")
 
@@ -863,49 +4620,401 @@ class MainWindow(QMainWindow):
         s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
         s.setValue("dark_mode", bool(dark))
 
+    @Slot(bool)
+    def _toggle_metrics(self, checked: bool):
+        QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("metrics/enabled", bool(checked))
+        if not checked:
+            self.metrics_server.stop()
+            self._log("📊 指標伺服器已關閉")
+            return
+        err = self.metrics_server.start()
+        if err:
+            self._log(f"⚠️ 指標伺服器啟動失敗：{err}")
+            self.chk_metrics.blockSignals(True)
+            self.chk_metrics.setChecked(False)
+            self.chk_metrics.blockSignals(False)
+        else:
+            self._log(f"📊 指標伺服器：http://{self.metrics_server.host}:{self.metrics_server.port}/metrics（JSON：/metrics.json）")
+
+    @Slot(bool)
+    def _toggle_profile(self, checked: bool):
+        if checked:
+            PROFILER.enable(PROFILER.modes or set(PROFILE_MODES))
+            self._log(f"🧪 效能分析已開啟（{', '.join(m for m in PROFILE_MODES if m in PROFILER.modes)}）")
+            return
+        self._dump_profile()
+        PROFILER.disable()
+        self._log("🧪 效能分析已關閉")
+
+    def _dump_profile(self):
+        if not (PROFILER.enabled and PROFILER.has_data()):
+            return
+        try:
+            self._log(f"🧪 效能分析報告：{PROFILER.dump(self._settings())}")
+        except OSError as e:
+            self._log(f"⚠️ 效能分析報告寫入失敗：{e}")
+
+    @Slot(bool)
+    def _toggle_api(self, checked: bool):
+        QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("api/enabled", bool(checked))
+        if not checked:
+            self.control_server.stop()
+            self._log("🔌 控制 API 已關閉")
+            return
+        if not self.control_server.token:
+            self.control_server.token = load_api_token()
+            self._update_api_tip()
+        err = self.control_server.start()
+        if err:
+            self._log(f"⚠️ 控制 API 啟動失敗：{err}")
+            self.chk_api.blockSignals(True)
+            self.chk_api.setChecked(False)
+            self.chk_api.blockSignals(False)
+        else:
+            self._log(f"🔌 控制 API：http://{self.control_server.host}:{self.control_server.port}/api/state"
+                      f"（X-Auth-Token 見「控制 API」的提示）")
+
+    def _update_api_tip(self):
+        srv = self.control_server
+        tip = f"http://{srv.host}:{srv.port}/api/state"
+        self.chk_api.setToolTip(f"{tip}\nX-Auth-Token: {srv.token}" if srv.token else tip)
+
+    # ---------- Hotkeys ----------
+    def _load_hotkeys(self) -> dict:
+        s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+        return {a: str(s.value(f"hotkeys/{a}", DEFAULT_HOTKEYS[a])) for a in HOTKEY_ACTIONS}
+
+    def _save_hotkeys(self, bindings: dict):
+        s = QSettings("AutoPlayQt", "MIDI-AutoPlay")
+        for a in HOTKEY_ACTIONS:
+            s.setValue(f"hotkeys/{a}", bindings.get(a, ""))
+
+    def _start_hotkeys(self):
+        for err in self.hotkeys.start():
+            self._log(f"⚠️ {err}")
+        shown = "、".join(f"{HOTKEY_LABELS[a]} {self.hotkeys.bindings[a]}"
+                         for a in HOTKEY_ACTIONS if self.hotkeys.bindings.get(a))
+        if shown:
+            self._log(f"⌨️ 全域快捷鍵：{shown}")
+
+    def edit_hotkeys(self):
+        dlg = QDialog(self)
+        dlg.setWindowTitle("全域快捷鍵")
+        form = QFormLayout(dlg)
+        form.addRow(QLabel("格式例：<f9>、<ctrl>+<alt>+p（留空=不使用）"))
+        edits = {}
+        for a in HOTKEY_ACTIONS:
+            ed = QLineEdit(self.hotkeys.bindings.get(a, ""))
+            form.addRow(HOTKEY_LABELS[a], ed)
+            edits[a] = ed
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(dlg.accept)
+        buttons.rejected.connect(dlg.reject)
+        form.addRow(buttons)
+        if dlg.exec() != QDialog.Accepted:
+            return
+
+        bindings = {a: edits[a].text().strip() for a in HOTKEY_ACTIONS}
+        errors = [e for e in (validate_hotkey(v) for v in bindings.values()) if e]
+        if errors:
+            QMessageBox.warning(self, "快捷鍵錯誤", "\n".join(errors))
+            return
+        self._save_hotkeys(bindings)
+        self.hotkeys.bindings = bindings
+        self._start_hotkeys()
+
+    @Slot()
+    def _on_hotkey_start(self):
+        if self.service.is_playing():
+            self.service.resume()
+            return
+        self.start()
+
     @Slot(bool)
     def _toggle_dark(self, checked: bool):
         self._apply_theme(checked)
         self._save_theme_pref(checked)
-        self._card_shadow(self.g_folder, alpha=self._shadow_alpha)
-        self._card_shadow(self.g_cur, alpha=self._shadow_alpha)
-        self._card_shadow(self.g_set, alpha=self._shadow_alpha)
+        if not self._perf_mode:
+            self._apply_card_shadows()
+
+    def _apply_card_shadows(self):
+        for g in (self.g_folder, self.g_cur, self.g_set):
+            self._card_shadow(g, alpha=self._shadow_alpha)
 
+    @profiled("ui.log")
     def _log(self, s: str):
+        if self._perf_mode:
+            self._pending_log.append(s)
+            if not self._ui_flush.isActive():
+                self._ui_flush.start()
+            return
         self.log.appendPlainText(s)
 
+    def _show_status(self, text: str):
+        if self._perf_mode:
+            self._pending_status = text
+            if not self._ui_flush.isActive():
+                self._ui_flush.start()
+            return
+        self.statusBar().showMessage(text)
+
+    @profiled("ui.flush")
+    def _flush_ui(self):
+        """把節流期間累積的 log / 狀態一次畫上去。"""
+        if self._pending_log:
+            self.log.appendPlainText("\n".join(self._pending_log))
+            self._pending_log.clear()
+        if self._pending_status is not None:
+            self.statusBar().showMessage(self._pending_status)
+            self._pending_status = None
+
+    def _update_progress(self):
+        """10 Hz 讀播放時鐘：進度條、已播 / 剩餘時間、小節與拍；內容沒變就不重畫。"""
+        path, duration = METRICS.song, METRICS.duration
+        if not path or METRICS.state == "idle":
+            return
+        pos = METRICS.live_position()
+        if pos < 0:
+            text = f"倒數 {-pos:.1f} 秒"
+            value = 0
+        else:
+            pos = min(pos, duration)
+            index = self._progress_index
+            if index is None or index.path != path:
+                index = self._progress_index = cached_midi_index(path)   # 大檔背景分析完才有
+            if index is not None:
+                bar, beat = index.bar_beat(pos)
+                where = f"　第 {bar} 小節 第 {beat} 拍"
+            else:
+                where = ""
+            text = f"{fmt_time(pos)} / {fmt_time(duration)}（-{fmt_time(duration - pos)}）{where}"
+            value = int(pos / duration * 1000) if duration > 0 else 0
+        if value != self.progress.value():
+            self.progress.setValue(value)
+        if text != self._progress_text:
+            self._progress_text = text
+            self.lbl_position.setText(text)
+
+    def _set_perf_mode(self, on: bool):
+        """播放中遊戲在前景：陰影效果整塊離屏重繪最貴，先拿掉；停止後還原。
+        背景的 MIDI 庫分析本來就會在播放時暫停。"""
+        if on == self._perf_mode:
+            return
+        self._perf_mode = on
+        if on:
+            for g in (self.g_folder, self.g_cur, self.g_set):
+                g.setGraphicsEffect(None)
+        else:
+            self._ui_flush.stop()
+            self._flush_ui()
+            self._apply_card_shadows()
+
     # -------- folder / list --------
     def pick_folder(self):
-        folder = QFileDialog.getExistingDirectory(self, "選擇含 MIDI 的資料夾", self.ed_folder.text() or os.getcwd())
+        start = (self._library_roots() or [os.getcwd()])[0]
+        folder = QFileDialog.getExistingDirectory(self, "選擇含 MIDI 的資料夾", start)
         if folder:
             self.ed_folder.setText(folder)
             self.refresh_midi_list()
 
+    def add_folder(self):
+        roots = self._library_roots()
+        folder = QFileDialog.getExistingDirectory(self, "加入含 MIDI 的資料夾", (roots or [os.getcwd()])[0])
+        if folder and os.path.normpath(folder) not in roots:
+            self.ed_folder.setText(LIBRARY_ROOT_SEP.join(roots + [os.path.normpath(folder)]))
+            self.refresh_midi_list()
+
+    def _library_roots(self) -> list[str]:
+        roots = []
+        for part in self.ed_folder.text().split(LIBRARY_ROOT_SEP):
+            part = part.strip().strip('"')
+            if part and os.path.normpath(part) not in roots:
+                roots.append(os.path.normpath(part))
+        return roots
+
+    def _on_refresh_clicked(self):
+        if self._scan_cancel.is_set():
+            self.refresh_midi_list()
+        else:
+            self._scan_cancel.set()
+
+    @profiled("ui.refresh_midi_list")
     def refresh_midi_list(self):
-        folder = self.ed_folder.text().strip().strip('"')
-        if not folder or not os.path.isdir(folder):
-            self._log(f"⚠️ 資料夾不存在：{folder}")
-            self.list_folder.clear()
-            self.mid_files = []
+        """清空清單並在背景重新掃描所有根目錄（含子資料夾），掃到的分批加進清單。"""
+        self._scan_cancel.set()
+        self._meta_cancel.set()
+        self._scan_gen += 1
+        self.list_folder.clear()
+        self.mid_files = []
+        self._scan_seen = set()
+
+        roots = []
+        for root in self._library_roots():
+            if os.path.isdir(root):
+                roots.append(root)
+            else:
+                self._log(f"⚠️ 資料夾不存在：{root}")
+        if not roots:
+            self._set_scanning(False)
+            self.lbl_library.setText("顯示 0 / 0 首")
             return
+        QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("library/roots", LIBRARY_ROOT_SEP.join(roots))
 
-        names = []
-        for name in os.listdir(folder):
-            low = name.lower()
-            if low.endswith(".mid") or low.endswith(".midi"):
-                names.append(name)
-        names.sort(key=lambda s: s.lower())
+        cancel = self._scan_cancel = threading.Event()
+        gen = self._scan_gen
+        known = dict(self.library.dirs)
+        self._scan_started = perf_counter()
+        self._set_scanning(True)
 
-        self.mid_files = [os.path.join(folder, n) for n in names]
-        self.list_folder.clear()
-        for n in names:
-            self.list_folder.addItem(QListWidgetItem(n))
+        def label(root: str, path: str) -> str:
+            rel = os.path.relpath(path, root)
+            return os.path.join(os.path.basename(root) or root, rel) if len(roots) > 1 else rel
 
-        self._log(f"📁 已載入資料夾：{folder}（{len(names)} 個 MIDI）")
+        def work():
+            found = {}
+            batch, last = [], perf_counter()
+            try:
+                for root in roots:
+                    for path in scan_midi_tree(root, known, found, cancel):
+                        batch.append((path, label(root, path)))
+                        if len(batch) >= LIBRARY_SCAN_BATCH or perf_counter() - last >= LIBRARY_SCAN_FLUSH:
+                            self.library_found.emit(gen, batch)
+                            batch, last = [], perf_counter()
+                self.library_found.emit(gen, batch)
+            finally:
+                self.library_scanned.emit(gen, found, cancel.is_set())
+
+        threading.Thread(target=work, name="library-scan", daemon=True).start()
+
+    def _set_scanning(self, on: bool):
+        self.btn_refresh.setText("停止掃描" if on else "重新整理")
+        self._set_std_icon(self.btn_refresh, "SP_BrowserStop" if on else "SP_BrowserReload")
+
+    def _filter_active(self) -> bool:
+        return bool(self.ed_search.text().strip() or self.sp_max_minutes.value() or self.sp_min_playable.value())
+
+    @Slot(int, object)
+    def _on_library_found(self, gen: int, batch):
+        if gen != self._scan_gen or not batch:
+            return
+        start = len(self.mid_files)
+        labels = []
+        for path, label in batch:
+            if path in self._scan_seen:      # 根目錄互相包含時避免重複
+                continue
+            self._scan_seen.add(path)
+            self.mid_files.append(path)
+            self.library.add(path, label)
+            labels.append(label)
+        self.list_folder.setUpdatesEnabled(False)
+        try:
+            self.list_folder.addItems(labels)
+            if self._filter_active():
+                matches = self.library.search(
+                    self.ed_search.text(),
+                    max_duration=self.sp_max_minutes.value() * 60.0,
+                    min_playable=self.sp_min_playable.value() / 100.0,
+                    keymap=get_keymap(self.cb_keymap.currentText()),
+                )
+                for row in range(start, len(self.mid_files)):
+                    self.list_folder.item(row).setHidden(self.mid_files[row] not in matches)
+        finally:
+            self.list_folder.setUpdatesEnabled(True)
+        self.lbl_library.setText(f"掃描中…已找到 {len(self.mid_files)} 首")
 
         if self.mid_files and not self.ed_midi.text().strip():
             self.ed_midi.setText(self.mid_files[0])
             self.list_folder.setCurrentRow(0)
+        if self._scan_select:
+            for row in range(start, len(self.mid_files)):
+                if os.path.normcase(self.mid_files[row]) == self._scan_select:
+                    self._scan_select = ""
+                    self.list_folder.setCurrentRow(row)
+                    break
+
+    @Slot(int, object, bool)
+    def _on_library_scanned(self, gen: int, found, cancelled: bool):
+        if gen != self._scan_gen:
+            return
+        self._scan_cancel.set()
+        self._scan_select = ""
+        self._set_scanning(False)
+        secs = perf_counter() - self._scan_started
+        if cancelled:
+            self.library.dirs.update(found)
+            self._log(f"⏹ 已停止掃描（{secs:.1f} 秒，已找到 {len(self.mid_files)} 個 MIDI）")
+        else:
+            self.library.dirs = found     # 只留這次走過的資料夾（刪掉 / 換掉的根目錄一併清掉）
+            self.library.sync(self.mid_files)
+            roots = self._library_roots()
+            where = roots[0] if len(roots) == 1 else f"{len(roots)} 個資料夾"
+            self._log(f"📁 已載入資料夾：{where}（{len(self.mid_files)} 個 MIDI，{secs:.1f} 秒）")
+        self.apply_library_filter()
+        self._start_library_scan()
+
+    # -------- library search / filter --------
+    def _library_cache_path(self) -> str:
+        return os.path.join(self._default_folder(), LIBRARY_CACHE_FILE)
+
+    @profiled("ui.library_filter")
+    def apply_library_filter(self, *_):
+        """依搜尋字串 + 時長 / 可彈比例篩選資料夾清單（隱藏不符合的列，列號不變）。"""
+        matches = self.library.search(
+            self.ed_search.text(),
+            max_duration=self.sp_max_minutes.value() * 60.0,
+            min_playable=self.sp_min_playable.value() / 100.0,
+            keymap=get_keymap(self.cb_keymap.currentText()),
+        )
+        shown = 0
+        for row, path in enumerate(self.mid_files):
+            it = self.list_folder.item(row)
+            hide = path not in matches
+            if it.isHidden() != hide:
+                it.setHidden(hide)
+                if hide:
+                    it.setSelected(False)
+            shown += not hide
+        analysed = sum(1 for p in self.mid_files if p in self.library.meta)
+        text = f"顯示 {shown} / {len(self.mid_files)} 首"
+        if analysed < len(self.mid_files):
+            text += f"（時長 / 可彈比例分析中 {analysed}/{len(self.mid_files)}）"
+        self.lbl_library.setText(text)
+
+    def _start_library_scan(self):
+        """背景分析資料夾內每首的時長與音高分布（有快取的跳過；播放中暫停，避免搶 CPU）。"""
+        self._meta_cancel.set()
+        cancel = self._meta_cancel = threading.Event()
+        paths = list(self.mid_files)
+        known = {p: (m[0], m[1]) for p, m in self.library.meta.items()}
+
+        def work():
+            batch = []
+            for p in paths:
+                while self.service.is_playing() and not cancel.is_set():
+                    cancel.wait(0.5)
+                if cancel.is_set():
+                    return
+                try:
+                    st = os.stat(p)
+                    stamp = (st.st_mtime_ns, st.st_size)
+                    if known.get(p) == stamp:
+                        continue
+                    index = load_midi_index(p, cache=False)
+                    batch.append((p, stamp, index.duration, index.pitch_histogram(index.default_excluded())))
+                except Exception:
+                    continue
+                if len(batch) >= LIBRARY_META_BATCH:
+                    self.library_meta.emit(batch)
+                    batch = []
+            self.library_meta.emit(batch)
+
+        threading.Thread(target=work, name="library-meta", daemon=True).start()
+
+    @Slot(object)
+    def _on_library_meta(self, batch):
+        for path, stamp, duration, hist in batch:
+            self.library.set_meta(path, stamp, duration, hist)
+        self.apply_library_filter()
 
     def on_folder_select(self):
         items = self.list_folder.selectedItems()
@@ -918,9 +5027,219 @@ class MainWindow(QMainWindow):
     def on_folder_double(self, _item: QListWidgetItem):
         self.start()
 
+    # -------- tracks / channels --------
+    @profiled("ui.refresh_track_list")
+    def refresh_track_list(self):
+        path = self.ed_midi.text().strip().strip('"')
+        if path == self._tracks_path:
+            return
+        self._tracks_path = path
+        self.list_tracks.blockSignals(True)
+        self.list_tracks.clear()
+        try:
+            if not path or not os.path.isfile(path):
+                return
+            try:
+                index = peek_midi_index(path)
+            except Exception as e:
+                self._log(f"⚠️ 讀取音軌失敗：{e}")
+                return
+            if index is None:
+                it = QListWidgetItem("⏳ 分析音軌中…（大檔）")
+                it.setFlags(Qt.NoItemFlags)
+                self.list_tracks.addItem(it)
+                self._index_track_list(path)
+                return
+            excluded = self.track_excluded.get(path, index.default_excluded())
+            for key in index.group_keys():
+                it = QListWidgetItem(index.describe(key))
+                it.setData(Qt.UserRole, key)
+                it.setFlags(it.flags() | Qt.ItemIsUserCheckable)
+                it.setCheckState(Qt.Unchecked if key in excluded else Qt.Checked)
+                self.list_tracks.addItem(it)
+        finally:
+            self.list_tracks.blockSignals(False)
+            self._update_keymap_hint()
+            self.refresh_preview()
+
+    def _index_track_list(self, path: str):
+        def work():
+            try:
+                load_midi_index(path)
+                err = ""
+            except Exception as e:
+                err = str(e)
+            self.track_index_ready.emit(path, err)
+
+        threading.Thread(target=work, name="track-index", daemon=True).start()
+
+    @Slot(str, str)
+    def _on_track_index_ready(self, path: str, err: str):
+        if path != self._tracks_path:
+            return
+        if err:
+            self.list_tracks.clear()
+            self._log(f"⚠️ 讀取音軌失敗：{err}")
+            return
+        self._tracks_path = ""
+        self.refresh_track_list()
+
+    def on_track_toggled(self, _item: QListWidgetItem):
+        path = self._tracks_path
+        if not path:
+            return
+        excluded = set()
+        for i in range(self.list_tracks.count()):
+            it = self.list_tracks.item(i)
+            if it.checkState() != Qt.Checked:
+                excluded.add(tuple(it.data(Qt.UserRole)))
+        self.track_excluded[path] = excluded
+        self._push_settings()
+        self._update_keymap_hint()
+
+    # -------- piano-roll preview --------
+    def show_preview(self):
+        if self._preview is None:
+            dlg = QDialog(self)
+            dlg.setWindowTitle("預覽（鋼琴捲簾）")
+            v = QVBoxLayout(dlg)
+            self.roll = PianoRoll()
+            v.addWidget(self.roll, 1)
+            self.lbl_preview = QLabel("")
+            self.lbl_preview.setTextFormat(Qt.RichText)
+            v.addWidget(self.lbl_preview)
+            v.addWidget(QLabel("滾輪：捲動　Ctrl+滾輪：縮放　淡色底：目前設定下有對應鍵的音高"))
+            dlg.resize(960, 400)
+            dlg.finished.connect(lambda _result: self._roll_timer.stop())
+            self._preview = dlg
+        self._preview_key = None
+        self._preview.show()
+        self._preview.raise_()
+        self._roll_timer.start()
+        self.refresh_preview()
+
+    @profiled("ui.preview")
+    def refresh_preview(self):
+        """預覽視窗開著時，依目前 MIDI / 音軌 / 設定重算音符狀態（沒變就不重算）。"""
+        if self._preview is None or not self._preview.isVisible():
+            return
+        path = self.ed_midi.text().strip().strip('"')
+        st = self._settings()
+        excluded = st["track_excluded"].get(path)
+        key = (path, frozenset(excluded) if excluded is not None else None, st["transpose"], st["auto_transpose"],
+               st["velocity"], st["keymap"], st["max_chord"], st["velocity_mode"], st["velocity_rate"],
+               st["velocity_share"])
+        if key == self._preview_key:
+            return
+        self._preview_key = key
+        try:
+            index = peek_midi_index(path) if os.path.isfile(path) else None
+        except Exception as e:
+            self._log(f"⚠️ 預覽讀取失敗：{e}")
+            index = None
+        if index is None or index.streamed:
+            self.roll.set_notes([], set(), 0.0)
+            big = index is not None or os.path.isfile(path)   # None + 檔案存在 = 大檔還沒分析
+            self.lbl_preview.setText("檔案太大（串流模式）不提供預覽" if big else "請先選擇 MIDI")
+            return
+        if excluded is None:
+            excluded = index.default_excluded()
+        keymap = get_keymap(st["keymap"])
+        transpose = st["transpose"]
+        if st["auto_transpose"]:
+            transpose = pick_best_transpose_hist(index.pitch_histogram(excluded), keymap.mapping)[0]
+        velocity = index.velocity_threshold(st, excluded)[0]
+        notes = preview_notes(index.schedule(excluded), transpose, velocity, keymap.table, st["max_chord"])
+        counts = [0] * len(PIANO_ROLL_COLORS)
+        for note in notes:
+            counts[note[3]] += 1
+        mapped = {n - transpose for n in range(128) if keymap.table[n]}
+        self.roll.set_notes(notes, mapped, index.duration)
+        labels = ("送出", "沒有對應鍵", "和弦上限省略", "力度不足")
+        self.lbl_preview.setText(f"{keymap.name}　Transpose {transpose:+d}　Velocity ≥ {velocity}　" + "　".join(
+            f'<span style="color:{c}">■</span> {label} {n}' for c, label, n in zip(PIANO_ROLL_COLORS, labels, counts)))
+
+    def _follow_roll_cursor(self):
+        path = self.ed_midi.text().strip().strip('"')
+        playing = METRICS.state != "idle" and METRICS.song and os.path.normcase(METRICS.song) == os.path.normcase(path)
+        pos = METRICS.live_position() if playing else None
+        if pos is not None and pos < 0:
+            pos = 0.0
+        if pos != self.roll.cursor:
+            self.roll.set_cursor(pos)
+
+    # -------- keymap profiles --------
+    def _fill_keymaps(self, current: str):
+        self.cb_keymap.blockSignals(True)
+        self.cb_keymap.clear()
+        for name, prof in KEYMAPS.items():
+            self.cb_keymap.addItem(name)
+            self.cb_keymap.setItemData(self.cb_keymap.count() - 1,
+                                       f"{len(prof)} 鍵" + (f"\n{prof.path}" if prof.path else "（內建）"),
+                                       Qt.ToolTipRole)
+        i = self.cb_keymap.findText(current)
+        self.cb_keymap.setCurrentIndex(i if i >= 0 else 0)
+        self.cb_keymap.blockSignals(False)
+
+    def reload_keymaps(self):
+        current = self.cb_keymap.currentText()
+        for err in reload_keymaps():
+            self._log(f"⚠️ 鍵盤配置讀取失敗：{err}")
+        self._fill_keymaps(current)
+        self.library.clear_playable()
+        self.apply_library_filter()
+        if self.cb_keymap.currentText() != current:
+            self._push_settings()
+        self._log(f"⌨️ 已載入 {len(KEYMAPS)} 個鍵盤配置：{', '.join(KEYMAPS)}")
+        self._update_keymap_hint()
+
+    @Slot(str)
+    def _on_keymap_changed(self, name: str):
+        QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("keymap/name", name)
+        if self.sp_min_playable.value():
+            self.apply_library_filter()
+
+    @profiled("ui.keymap_hint")
+    def _update_keymap_hint(self):
+        """依目前 MIDI（勾選的音軌）一次算完每個配置 × 移調的可彈比例，顯示最佳建議。"""
+        self._keymap_hint = None
+        self.lbl_keymap_hint.setText("")
+        self.lbl_keymap_hint.setToolTip("")
+        self.btn_keymap_apply.setEnabled(False)
+        path = self._tracks_path
+        if not path or not os.path.isfile(path):
+            return
+        try:
+            index = peek_midi_index(path)
+        except Exception:
+            return
+        if index is None:
+            return          # 大檔還在背景分析，好了會重新整理音軌清單
+        rows = score_keymaps(index.pitch_histogram(self.track_excluded.get(path, index.default_excluded())))
+        if not rows or not rows[0][1]:
+            return
+        hit, total, name, tr = rows[0]
+        per_profile = {}
+        for row in rows:
+            per_profile.setdefault(row[2], row)
+        self.lbl_keymap_hint.setText(f"建議：{name} {tr:+d}（可彈 {hit / total:.1%}）")
+        self.lbl_keymap_hint.setToolTip("\n".join(f"{n}：{t:+d}，{h}/{tot} = {h / tot:.1%}"
+                                                   for n, (h, tot, _, t) in per_profile.items()))
+        self._keymap_hint = (name, tr)
+        self.btn_keymap_apply.setEnabled(True)
+
+    def apply_keymap_hint(self):
+        if not self._keymap_hint:
+            return
+        name, tr = self._keymap_hint
+        self.cb_keymap.setCurrentText(name)
+        if not self.chk_auto_tr.isChecked():
+            self.sp_transpose.setValue(tr)
+        self._log(f"⌨️ 套用建議：{name} {tr:+d}")
+
     # -------- import midi --------
     def import_midis(self):
-        folder = self.ed_folder.text().strip().strip('"')
+        folder = (self._library_roots() or [""])[0]
         if not folder or not os.path.isdir(folder):
             QMessageBox.critical(self, "錯誤", f"資料夾不存在：{folder}")
             return
@@ -953,6 +5272,67 @@ class MainWindow(QMainWindow):
         self._log(f"⬆️ 已加入 {ok} 個 MIDI 到：{folder}" + (f"（失敗 {fail}）" if fail else ""))
         self.refresh_midi_list()
 
+    # -------- offline optimize --------
+    def optimize_midis(self):
+        rows = sorted({self.list_folder.row(i) for i in self.list_folder.selectedItems()})
+        if not rows:
+            rows = [r for r in range(len(self.mid_files)) if not self.list_folder.item(r).isHidden()]
+        if not rows:
+            self._log("⚠️ 沒有可精簡的 MIDI")
+            return
+        roots = self._library_roots()
+        out = QFileDialog.getExistingDirectory(self, "選擇精簡版的輸出資料夾（原檔不會被修改）",
+                                               (roots or [os.getcwd()])[0])
+        if not out:
+            return
+        if any(os.path.isdir(r) and os.path.samefile(out, r) for r in roots):
+            QMessageBox.critical(self, "錯誤", "輸出資料夾不能是 MIDI 庫本身，請另選一個資料夾")
+            return
+        ans = QMessageBox.question(
+            self, "精簡 MIDI",
+            f"輸出 {len(rows)} 首到：{out}\n\n要順便省略遊戲不會按的音符嗎？\n"
+            "（依目前的鍵盤配置、Velocity ≥ 與和弦上限；選「No」= 保留全部音符）",
+            QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.No)
+        if ans == QMessageBox.Cancel:
+            return
+
+        jobs = [(self.mid_files[r], os.path.join(out, self.list_folder.item(r).text())) for r in rows]
+        opts = dict(keymap=get_keymap(self.cb_keymap.currentText()),
+                    transpose=None if self.chk_auto_tr.isChecked() else self.sp_transpose.value(),
+                    velocity_th=self.sp_velocity.value(), max_chord=self.sp_max_chord.value(),
+                    thin=ans == QMessageBox.Yes)
+        cancel = self._optimize_cancel = threading.Event()
+        self.btn_optimize.setEnabled(False)
+        self._log(f"🗜 開始精簡 {len(jobs)} 首 → {out}")
+
+        def done(res, src):
+            if isinstance(res, Exception):
+                self.optimize_report.emit(f"❌ 精簡失敗：{os.path.basename(src)}：{res}", False)
+            else:
+                self.optimize_report.emit(f"🗜 {os.path.basename(src)}：{res['bytes_in'] // 1024} KB → "
+                                          f"{res['bytes_out'] // 1024} KB，{res['notes_out']} 音", False)
+
+        def work():
+            t0 = perf_counter()
+            try:
+                results = [r for r in optimize_many(jobs, on_done=done, cancel=cancel, **opts) if isinstance(r, dict)]
+            except Exception as e:
+                self.optimize_report.emit(f"❌ 精簡失敗：{e}", True)
+                return
+            size_in = sum(r["bytes_in"] for r in results)
+            size_out = sum(r["bytes_out"] for r in results)
+            ratio = f"（{size_out / size_in:.0%}）" if size_in else ""
+            self.optimize_report.emit(f"✅ 精簡完成 {len(results)}/{len(jobs)} 首，{size_in // 1024} KB → "
+                                      f"{size_out // 1024} KB{ratio}，{perf_counter() - t0:.1f} 秒", True)
+
+        threading.Thread(target=work, name="midi-optimize", daemon=True).start()
+
+    @Slot(str, bool)
+    def _on_optimize_report(self, text: str, finished: bool):
+        self._log(text)
+        if finished:
+            self.btn_optimize.setEnabled(True)
+
     # -------- pick file --------
     def pick_file(self):
         path, _ = QFileDialog.getOpenFileName(
@@ -964,17 +5344,24 @@ class MainWindow(QMainWindow):
             return
         self.ed_midi.setText(path)
 
-        folder = os.path.dirname(path)
-        if folder and os.path.isdir(folder):
-            self.ed_folder.setText(folder)
+        target = os.path.normcase(os.path.normpath(path))
+        for row, p in enumerate(self.mid_files):
+            if os.path.normcase(os.path.normpath(p)) == target:
+                self.list_folder.setCurrentRow(row)
+                return
+        roots = self._library_roots()
+        folder = os.path.dirname(os.path.normpath(path))
+        if any(_path_under(target, root) for root in roots):
+            if self._scan_cancel.is_set():     # 在 MIDI 庫裡但清單還沒有（新檔）：重新掃描
+                self.refresh_midi_list()
+        elif folder and os.path.isdir(folder):
+            # 不在任何根目錄底下：跟「＋」一樣把資料夾加進去，原本的根目錄都保留
+            self.ed_folder.setText(LIBRARY_ROOT_SEP.join(roots + [folder]))
             self.refresh_midi_list()
-            base = os.path.basename(path).lower()
-            for i, fp in enumerate(self.mid_files):
-                if os.path.basename(fp).lower() == base:
-                    self.list_folder.setCurrentRow(i)
-                    break
+        self._scan_select = target   # 掃到時再選取
 
     # -------- playlist （★ 加上編號）--------
+    @profiled("ui.refresh_playlist")
     def refresh_playlist_ui(self):
         """刷新播放清單，顯示順序編號"""
         self.list_playlist.clear()
@@ -988,15 +5375,7 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "提示", "請先在左邊清單選取一首或多首 MIDI。")
             return
 
-        added = 0
-        for r in rows:
-            if 0 <= r < len(self.mid_files):
-                p = self.mid_files[r]
-                if p not in self.playlist:
-                    self.playlist.append(p)
-                    added += 1
-
-        self.refresh_playlist_ui()
+        added = self.service.enqueue([self.mid_files[r] for r in rows if 0 <= r < len(self.mid_files)])
         self._log(f"➕ 已加入 {added} 首到播放清單")
 
         if self.playlist and not self.ed_midi.text().strip():
@@ -1004,13 +5383,10 @@ class MainWindow(QMainWindow):
             self.list_playlist.setCurrentRow(0)
 
     def remove_selected_from_playlist(self):
-        rows = sorted({self.list_playlist.row(i) for i in self.list_playlist.selectedItems()}, reverse=True)
+        rows = [self.list_playlist.row(i) for i in self.list_playlist.selectedItems()]
         if not rows:
             return
-        for r in rows:
-            if 0 <= r < len(self.playlist):
-                self.playlist.pop(r)
-        self.refresh_playlist_ui()
+        self.service.remove(rows)
 
     def move_playlist(self, delta: int):
         items = self.list_playlist.selectedItems()
@@ -1020,13 +5396,11 @@ class MainWindow(QMainWindow):
         j = i + delta
         if j < 0 or j >= len(self.playlist):
             return
-        self.playlist[i], self.playlist[j] = self.playlist[j], self.playlist[i]
-        self.refresh_playlist_ui()
+        self.service.move(i, j)
         self.list_playlist.setCurrentRow(j)
 
     def clear_playlist(self):
-        self.playlist.clear()
-        self.refresh_playlist_ui()
+        self.service.clear()
 
     def on_playlist_double(self, _item: QListWidgetItem):
         row = self.list_playlist.currentRow()
@@ -1044,8 +5418,142 @@ class MainWindow(QMainWindow):
             release_all_at_end=self.chk_release.isChecked(),
             auto_next=self.chk_auto_next.isChecked(),
             loop_playlist=self.chk_loop.isChecked(),
+            track_excluded={p: set(ex) for p, ex in self.track_excluded.items()},
+            stream=self.chk_stream.isChecked(),
+            latency_comp=self.chk_latency.isChecked(),
+            isolate=self.chk_isolate.isChecked(),
+            keymap=self.cb_keymap.currentText() or KEYMAP_DEFAULT,
+            frame_hz=self.sp_frame_hz.value(),
+            max_chord=self.sp_max_chord.value(),
+            stall_ms=self.sp_stall.value(),
+            stall_policy=self.cb_stall.currentData() or DEFAULT_SETTINGS["stall_policy"],
+            velocity_mode=self.cb_velocity_mode.currentData() or DEFAULT_SETTINGS["velocity_mode"],
+            velocity_rate=self.sp_velocity_rate.value(),
+            velocity_share=self.sp_velocity_share.value(),
+            **self._latency_settings(),
         )
 
+    def _latency_settings(self) -> dict:
+        backend = self.cb_backend.currentText() or DEFAULT_SETTINGS["key_backend"]
+        press, release = load_latency(backend)
+        return dict(key_backend=backend, press_lead=press, release_lead=release)
+
+    def _update_latency_tip(self):
+        st = self._latency_settings()
+        self.chk_latency.setToolTip(
+            f"{st['key_backend']}：press 提早 {st['press_lead'] * 1000:.2f} ms、"
+            f"release 提早 {st['release_lead'] * 1000:.2f} ms（按「校準延遲」重新量測）")
+
+    def calibrate(self):
+        if self.service.is_playing():
+            QMessageBox.information(self, "正在播放", "請先停止播放再校準。")
+            return
+        backend_name = self.cb_backend.currentText() or DEFAULT_SETTINGS["key_backend"]
+        self.btn_calibrate.setEnabled(False)
+        self._log(f"⏱ 校準送鍵延遲（{backend_name}，{CALIBRATION_SAMPLES} 次）…")
+
+        def work():
+            try:
+                result = calibrate_latency(make_key_backend(backend_name))
+            except Exception as e:
+                result = {"error": str(e)}
+            self.calibration_done.emit(result)
+
+        threading.Thread(target=work, name="latency-calibration", daemon=True).start()
+
+    @Slot(object)
+    def _on_calibration_done(self, result: dict):
+        self.btn_calibrate.setEnabled(True)
+        if "error" in result:
+            self._log(f"❌ 校準失敗：{result['error']}")
+            return
+        save_latency(result)
+        p, r = result["press"], result["release"]
+        self._log(f"⏱ 校準完成（{result['method']}）：press {p['median_ms']:.2f} ms ±{p['stdev_ms']:.2f}（p95 {p['p95_ms']:.2f}）、"
+                  f"release {r['median_ms']:.2f} ms ±{r['stdev_ms']:.2f}（p95 {r['p95_ms']:.2f}）")
+        self._update_latency_tip()
+        self._push_settings()
+
+    def _push_settings(self, *_):
+        self._pushing = True
+        try:
+            self.service.update_settings(**self._settings())
+        finally:
+            self._pushing = False
+        self.refresh_preview()
+
+    def _update_velocity_mode_ui(self, *_):
+        mode = self.cb_velocity_mode.currentData()
+        self.sp_velocity_rate.setEnabled(mode == "rate")
+        self.sp_velocity_share.setEnabled(mode == "share")
+
+    def _on_backend_changed(self, name: str):
+        """換送鍵後端：各後端的校準值分開存，一起換掉。"""
+        QSettings("AutoPlayQt", "MIDI-AutoPlay").setValue("keys/backend", name)
+        self._update_latency_tip()
+        self._push_settings()
+
+    @Slot()
+    def _load_service_settings(self):
+        """設定被其他 client（API）改掉時，同步回畫面（自己送出去的變更不用再套回來）。"""
+        if self._pushing:
+            return
+        st = self.service.settings
+        pairs = ((self.sp_transpose, st["transpose"]), (self.sp_velocity, st["velocity"]),
+                 (self.sp_countdown, st["countdown"]), (self.sp_max_chord, st["max_chord"]),
+                 (self.sp_stall, st["stall_ms"]), (self.sp_velocity_rate, st["velocity_rate"]),
+                 (self.sp_velocity_share, st["velocity_share"]))
+        checks = ((self.chk_auto_tr, st["auto_transpose"]), (self.chk_release, st["release_all_at_end"]),
+                  (self.chk_auto_next, st["auto_next"]), (self.chk_loop, st["loop_playlist"]),
+                  (self.chk_stream, st["stream"]), (self.chk_latency, st["latency_comp"]),
+                  (self.chk_isolate, st["isolate"]))
+        for w, v in pairs:
+            w.blockSignals(True)
+            w.setValue(v)
+            w.blockSignals(False)
+        for w, v in checks:
+            w.blockSignals(True)
+            w.setChecked(v)
+            w.blockSignals(False)
+        for w, v in ((self.cb_keymap, st["keymap"]), (self.cb_backend, st["key_backend"])):
+            w.blockSignals(True)
+            w.setCurrentText(v)
+            w.blockSignals(False)
+        self.sp_frame_hz.blockSignals(True)
+        self.sp_frame_hz.setValue(st["frame_hz"])
+        self.sp_frame_hz.blockSignals(False)
+        self.cb_stall.blockSignals(True)
+        self.cb_stall.setCurrentIndex(self.cb_stall.findData(st["stall_policy"]))
+        self.cb_stall.blockSignals(False)
+        self.cb_velocity_mode.blockSignals(True)
+        self.cb_velocity_mode.setCurrentIndex(self.cb_velocity_mode.findData(st["velocity_mode"]))
+        self.cb_velocity_mode.blockSignals(False)
+        self._update_velocity_mode_ui()
+        self._update_latency_tip()
+        excluded = {p: set(ex) for p, ex in st["track_excluded"].items()}
+        if excluded != self.track_excluded:
+            self.track_excluded = excluded
+            self._sync_track_checks()
+        self._update_keymap_hint()
+        self.refresh_preview()
+
+    def _sync_track_checks(self):
+        """只改目前音軌清單的勾選狀態（不重建，捲動位置與選取不變）。"""
+        path = self._tracks_path
+        if not path or not self.list_tracks.count():
+            return
+        excluded = self.track_excluded.get(path)
+        if excluded is None:
+            index = cached_midi_index(path)
+            if index is None:
+                return
+            excluded = index.default_excluded()
+        self.list_tracks.blockSignals(True)
+        for i in range(self.list_tracks.count()):
+            it = self.list_tracks.item(i)
+            it.setCheckState(Qt.Unchecked if tuple(it.data(Qt.UserRole)) in excluded else Qt.Checked)
+        self.list_tracks.blockSignals(False)
+
     def _playlist_selected_index(self) -> int:
         row = self.list_playlist.currentRow()
         if row >= 0:
@@ -1067,15 +5575,9 @@ class MainWindow(QMainWindow):
         return -1
 
     def start(self):
-        # ★★★ 修復 QThread 錯誤：檢查 thread 是否有效 ★★★
-        try:
-            if self.worker_thread and self.worker_thread.isRunning():
-                QMessageBox.information(self, "正在播放", "目前正在播放中。")
-                return
-        except RuntimeError:
-            # Thread 已被刪除，重設為 None
-            self.worker_thread = None
-            self.worker = None
+        if self.service.is_playing():
+            QMessageBox.information(self, "正在播放", "目前正在播放中。")
+            return
 
         path = self.ed_midi.text().strip().strip('"')
         if not path or not os.path.exists(path):
@@ -1085,7 +5587,7 @@ class MainWindow(QMainWindow):
         # 決定播放清單優先順序
         if self.playlist:
             mode = "playlist"
-            play_list = list(self.playlist)
+            play_list = self.playlist
             idx = self._playlist_selected_index()
             if idx == -1:
                 base = os.path.basename(path).lower()
@@ -1114,33 +5616,9 @@ class MainWindow(QMainWindow):
         self._log(f"🎬 播放模式：{mode_name}（起始第 {idx+1} 首 / 共 {len(play_list)} 首）")
         self.statusBar().showMessage(f"播放模式：{mode_name}")
 
-        self.btn_start.setEnabled(False)
-        self.btn_stop.setEnabled(True)
-        self.statusBar().showMessage("播放中…")
         self._log("▶ 開始播放")
-
-        # ★★★ 創建新的 thread，不重用舊的 ★★★
-        self.worker_thread = QThread()
-        self.worker = PlayWorker(mode=mode, play_list=play_list, start_index=idx, settings=self._settings())
-        self.worker.moveToThread(self.worker_thread)
-
-        self.worker_thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self.worker_thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.worker_thread.finished.connect(self.worker_thread.deleteLater)
-
-        self.worker.log.connect(self._log)
-        self.worker.status.connect(self.statusBar().showMessage)
-
-        self.worker.select_folder_index.connect(self._select_folder_row)
-        self.worker.select_playlist_index.connect(self._select_playlist_row)
-
-        # ★★★ 當 thread 結束時，重設變數 ★★★
-        self.worker_thread.finished.connect(self._on_play_finished)
-        self.worker_thread.finished.connect(lambda: setattr(self, 'worker_thread', None))
-        self.worker_thread.finished.connect(lambda: setattr(self, 'worker', None))
-        
-        self.worker_thread.start()
+        self._push_settings()
+        self.service.play(mode, play_list, idx)
 
     def _set_std_icon(self, btn: QPushButton, name: str):
         try:
@@ -1158,15 +5636,50 @@ class MainWindow(QMainWindow):
         widget.setGraphicsEffect(eff)
 
     def stop(self):
-        if self.worker:
-            self.worker.stop()
+        if self.service.is_playing():
+            self.service.stop()
             self._log("🛑 收到停止指令…")
 
-    @Slot()
-    def _on_play_finished(self):
-        self.btn_start.setEnabled(True)
-        self.btn_stop.setEnabled(False)
-        self.statusBar().showMessage("就緒")
+    def toggle_pause(self):
+        self.service.toggle_pause()
+
+    @Slot(bool)
+    def _on_paused_changed(self, paused: bool):
+        self.btn_pause.setText("▶ 繼續" if paused else "⏸ 暫停")
+        self._set_std_icon(self.btn_pause, "SP_MediaPlay" if paused else "SP_MediaPause")
+
+    def closeEvent(self, event):
+        self.hotkeys.stop()
+        self.metrics_server.stop()
+        self.control_server.stop()
+        self.service.shutdown()
+        self._meta_cancel.set()
+        self._scan_cancel.set()
+        self._optimize_cancel.set()
+        try:
+            self.library.save_cache(self._library_cache_path())
+        except OSError:
+            pass
+        self._dump_profile()
+        super().closeEvent(event)
+
+    @Slot(bool)
+    def _on_playing_changed(self, playing: bool):
+        self.btn_start.setEnabled(not playing)
+        self.btn_stop.setEnabled(playing)
+        self.btn_pause.setEnabled(playing)
+        self.btn_pause.setText("⏸ 暫停")
+        self._set_std_icon(self.btn_pause, "SP_MediaPause")
+        self._set_perf_mode(playing)
+        self._show_status("播放中…" if playing else "就緒")
+        if playing:
+            self._progress_timer.start()
+        else:
+            self._progress_timer.stop()
+            self._progress_index = None
+            self.progress.setValue(0)
+            self._progress_text = "—"
+            self.lbl_position.setText("—")
 
     @Slot(int)
     def _select_folder_row(self, idx: int):
@@ -1182,8 +5695,268 @@ class MainWindow(QMainWindow):
             if idx < len(self.playlist):
                 self.ed_midi.setText(self.playlist[idx])
 
+def simulate_playlist(paths, settings: dict | None = None, actions=()):
+    """用 VirtualClock + KeyTrace 把播放清單整個跑一遍（倒數、自動下一首、循環、停止、結束放鍵都走真的 PlayWorker 流程），
+    不送鍵也不真的等。actions = [(時鐘秒數, "stop" | "pause" | "resume" | "next"), ...]。
+    回傳 ([(清單位置, path, [(歌曲開始後秒數, press, key), ...]), ...], log 列表, 模擬總秒數)。"""
+    clock = VirtualClock()
+    trace = KeyTrace(clock)
+    st = dict(DEFAULT_SETTINGS, **(settings or {}))
+    st["isolate"] = False      # 子程序有自己的時鐘，模擬只跑本程序
+    st["stall_ms"] = 0         # 看門狗是另一個 thread，不跟虛擬時鐘同步
+    worker = PlayWorker(mode="playlist", play_list=paths, settings=st, clock=clock, kb=trace)
+    marks = []                 # (清單位置, 開始時間, trace 起點)
+    # 循環播放又沒排停止時，多播一首（確認有繞回第一首）就停
+    limit = None
+    if st["loop_playlist"] and st["auto_next"] and not any(op == "stop" for _, op in actions):
+        limit = len(paths) + 1
+
+    def on_song(i: int):
+        if limit is not None and len(marks) >= limit:
+            worker.stop()
+            return
+        marks.append((i, clock.now(), len(trace.events)))
+
+    logs = []
+    worker.select_playlist_index.connect(on_song)
+    worker.log.connect(logs.append)
+    for t, op in actions:
+        clock.at(t, getattr(worker, "next_song" if op == "next" else op))
+    worker.run()
+
+    songs = []
+    for j, (i, start, pos) in enumerate(marks):
+        end = marks[j + 1][2] if j + 1 < len(marks) else len(trace.events)
+        # 取到 ns：同一首歌不管排在清單第幾首，相減的浮點誤差都不會讓輸出差一位
+        songs.append((i, paths[i], [(round(t - start, 9), press, key) for t, press, key in trace.events[pos:end]]))
+    return songs, logs, clock.now()
+
+def format_trace(events) -> str:
+    """按鍵軌跡 → 文字（一行一個動作，時間到 0.1 ms），拿來跟 golden 檔 diff。"""
+    return "".join(f"{t:10.4f} {'+' if press else '-'}{key}\n" for t, press, key in events)
+
+def simulate_cli(args) -> int:
+    """--simulate：虛擬時鐘跑完整個清單，輸出 / 比對按鍵軌跡。"""
+    import difflib
+    for err in reload_keymaps():
+        print(f"⚠️ 鍵盤配置讀取失敗：{err}", file=sys.stderr)
+    try:
+        base = os.path.dirname(os.path.abspath(__file__))
+    except Exception:
+        base = os.getcwd()
+    paths = []
+    for p in args.simulate or [os.path.join(base, "midi")]:
+        if os.path.isdir(p):
+            paths += scan_midi_tree(p, {}, {})
+        elif os.path.isfile(p):
+            paths.append(os.path.normpath(p))
+        else:
+            print(f"⚠️ 找不到：{p}", file=sys.stderr)
+    if not paths:
+        print("⚠️ 沒有找到 MIDI", file=sys.stderr)
+        return 1
+    settings = {}
+    for item in args.set or []:
+        k, _, raw = item.partition("=")
+        try:
+            v = json.loads(raw)
+        except ValueError:
+            v = raw
+        try:
+            settings[k.strip()] = coerce_setting(k.strip(), v)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"❌ --set {item}：{e}", file=sys.stderr)
+            return 2
+    actions = [(args.stop_at, "stop")] if args.stop_at is not None else []
+
+    t0 = perf_counter()
+    songs, logs, virtual = simulate_playlist(paths, settings, actions)
+    elapsed = perf_counter() - t0
+    for line in logs:
+        if line.startswith(("❌", "⚠️")):
+            print(line)
+
+    failed = 0
+    seen = set()
+    for i, path, events in songs:
+        name = os.path.basename(path)
+        presses = sum(1 for _, press, _ in events if press)
+        print(f"🎹 [{i + 1}] {name}：{presses} 次按鍵，{len(events)} 個動作")
+        if path in seen:
+            continue           # 循環繞回來的那一首只輸出 / 比對第一次
+        seen.add(path)
+        text = format_trace(events)
+        if args.trace_out:
+            os.makedirs(args.trace_out, exist_ok=True)
+            with open(os.path.join(args.trace_out, name + ".trace"), "w", encoding="utf-8") as f:
+                f.write(text)
+        if not args.golden:
+            continue
+        golden = os.path.join(args.golden, name + ".trace")
+        if args.update_golden:
+            os.makedirs(args.golden, exist_ok=True)
+            with open(golden, "w", encoding="utf-8") as f:
+                f.write(text)
+            continue
+        try:
+            with open(golden, encoding="utf-8") as f:
+                expected = f.read()
+        except OSError:
+            failed += 1
+            print(f"   ❓ 沒有 golden：{golden}（加 --update-golden 建立）")
+            continue
+        if expected != text:
+            failed += 1
+            diff = list(difflib.unified_diff(expected.splitlines(), text.splitlines(), "golden", "now", lineterm="", n=1))
+            print(f"   ❌ 跟 golden 不同（{sum(1 for d in diff if d[:1] in '+-') - 2} 行）：")
+            for d in diff[2:42]:
+                print(f"      {d}")
+        else:
+            print("   ✅ 跟 golden 相同")
+    print(f"🧪 模擬 {virtual:.1f} 秒的播放，實際 {elapsed:.2f} 秒（×{virtual / max(elapsed, 1e-9):.0f}）")
+    return 1 if failed else 0
+
+def serve_headless(args) -> int:
+    """無視窗常駐模式：只跑 PlayerService + 控制 API + 指標伺服器。"""
+    app = QCoreApplication(sys.argv[:1])
+    for err in reload_keymaps():
+        print(f"⚠️ 鍵盤配置讀取失敗：{err}", file=sys.stderr)
+    press_lead, release_lead = load_latency(DEFAULT_SETTINGS["key_backend"])
+    service = PlayerService(settings=dict(press_lead=press_lead, release_lead=release_lead))
+    service.log.connect(lambda text: print(text, flush=True))
+
+    # 沒給 --token 就用視窗共用的 api/token（沒有就產生）；真的不要 token 要明確加 --no-token
+    token = args.token or ("" if args.no_token else load_api_token())
+    api = ControlServer(service, args.host, args.api_port, token)
+    err = api.start()
+    if err:
+        print(f"❌ 控制 API 啟動失敗：{err}", file=sys.stderr)
+        service.shutdown()
+        return 1
+    print(f"🔌 控制 API：http://{args.host}:{args.api_port}/api/state", flush=True)
+    if not token:
+        print("⚠️ 控制 API 沒有 token（--no-token）：本機的任何程式都能控制（網頁的跨站請求會被擋）", flush=True)
+    elif not args.token:
+        print(f"🔑 X-Auth-Token: {token}（存在 QSettings 的 api/token）", flush=True)
+
+    metrics = MetricsServer(args.host, args.metrics_port)
+    err = metrics.start()
+    if err:
+        print(f"⚠️ 指標伺服器啟動失敗：{err}", file=sys.stderr)
+    else:
+        print(f"📊 指標伺服器：http://{args.host}:{args.metrics_port}/metrics", flush=True)
+
+    try:
+        return app.exec()
+    finally:
+        service.shutdown()
+        api.stop()
+        metrics.stop()
+        if PROFILER.enabled and PROFILER.has_data():
+            print(f"🧪 效能分析報告：{PROFILER.dump(service.settings)}", flush=True)
+
+def optimize_jobs(paths, out_dir: str) -> list:
+    """來源（檔案或資料夾，資料夾含子資料夾）→ [(src, dest), ...]；dest 保留相對於來源資料夾的路徑。"""
+    roots = [os.path.normpath(p) for p in paths if os.path.isdir(p)]
+    jobs = []
+    for p in paths:
+        p = os.path.normpath(p)
+        if os.path.isfile(p):
+            jobs.append((p, os.path.join(out_dir, os.path.basename(p))))
+        elif os.path.isdir(p):
+            prefix = os.path.basename(p) if len(roots) > 1 else ""
+            for src in scan_midi_tree(p, {}, {}):
+                jobs.append((src, os.path.join(out_dir, prefix, os.path.relpath(src, p))))
+    return jobs
+
+def optimize_cli(args) -> int:
+    """--optimize：批次輸出精簡版 MIDI。"""
+    for err in reload_keymaps():
+        print(f"⚠️ 鍵盤配置讀取失敗：{err}", file=sys.stderr)
+    if args.keymap not in KEYMAPS:
+        print(f"❌ 找不到鍵盤配置：{args.keymap}（可用：{', '.join(KEYMAPS)}）", file=sys.stderr)
+        return 2
+    jobs = optimize_jobs(args.optimize, args.out)
+    if not jobs:
+        print("⚠️ 沒有找到 MIDI", file=sys.stderr)
+        return 1
+    opts = dict(keymap=KEYMAPS[args.keymap], transpose=None if args.transpose == "auto" else int(args.transpose),
+                bake=not args.no_bake, velocity_th=args.velocity, max_chord=args.max_chord, thin=args.thin)
+    fails = 0
+
+    def done(res, src):
+        nonlocal fails
+        if isinstance(res, Exception):
+            fails += 1
+            print(f"❌ {src}：{res}", flush=True)
+        else:
+            print(f"✅ {res['dest']}  {res['bytes_in'] // 1024} KB → {res['bytes_out'] // 1024} KB，"
+                  f"{res['notes_in']} → {res['notes_out']} 音，移調 {res['transpose']:+d}", flush=True)
+
+    t0 = perf_counter()
+    results = [r for r in optimize_many(jobs, args.workers, on_done=done, **opts) if isinstance(r, dict)]
+    size_in = sum(r["bytes_in"] for r in results)
+    size_out = sum(r["bytes_out"] for r in results)
+    print(f"🗜 完成 {len(results)}/{len(jobs)} 首，{size_in // 1024} KB → {size_out // 1024} KB"
+          f"（{size_out / size_in:.0%}），{perf_counter() - t0:.1f} 秒" if size_in else "🗜 沒有成功的檔案", flush=True)
+    return 1 if fails else 0
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="MIDI AutoPlay")
+    ap.add_argument("--serve", action="store_true", help="不開視窗，只啟動播放服務與本機控制 API")
+    ap.add_argument("--host", default=API_HOST_DEFAULT, help="--serve 時 API / 指標綁定的位址")
+    ap.add_argument("--api-port", type=int, default=API_PORT_DEFAULT)
+    ap.add_argument("--metrics-port", type=int, default=METRICS_PORT_DEFAULT)
+    ap.add_argument("--token", default="", help="API 需要的 X-Auth-Token（不給 = 用 QSettings 的 api/token，沒有就產生）")
+    ap.add_argument("--no-token", action="store_true", help="--serve 時不檢查 token（只能綁本機位址，本機任何程式都能控制）")
+    ap.add_argument("--profile", nargs="?", const="1", default=os.environ.get(PROFILE_ENV, ""),
+                    metavar="MODES",
+                    help=f"開啟效能分析：1=計時+GC、all=全部，或逗號列出 {','.join(PROFILE_MODES)}"
+                         f"（也可用環境變數 {PROFILE_ENV}）")
+    sim = ap.add_argument_group("虛擬時鐘模擬（--simulate）")
+    sim.add_argument("--simulate", nargs="*", metavar="PATH",
+                     help="不送鍵、不真的等，把播放清單整個跑一遍輸出按鍵軌跡（預設：程式旁的 midi/）")
+    sim.add_argument("--set", action="append", metavar="KEY=VALUE", help="模擬用的設定，例：--set transpose=2 --set frame_hz=60")
+    sim.add_argument("--stop-at", type=float, metavar="SEC", help="在模擬時鐘第 N 秒按停止")
+    sim.add_argument("--trace-out", metavar="DIR", help="每首的軌跡寫到 DIR/<檔名>.trace")
+    sim.add_argument("--golden", metavar="DIR", help="跟 DIR/<檔名>.trace 比對，不同就列出差異並回傳 1")
+    sim.add_argument("--update-golden", action="store_true", help="把這次的軌跡寫成 --golden 的新基準")
+    opt = ap.add_argument_group("離線精簡 MIDI（--optimize）")
+    opt.add_argument("--optimize", nargs="+", metavar="PATH", help="要精簡的 MIDI 檔或資料夾（含子資料夾），原檔不會被修改")
+    opt.add_argument("--out", help="輸出資料夾（--optimize 必填）")
+    opt.add_argument("--workers", type=int, default=0, help="平行程序數（0 = CPU 核心數 - 1）")
+    opt.add_argument("--keymap", default=KEYMAP_DEFAULT, help="自動移調 / --thin 依據的鍵盤配置")
+    opt.add_argument("--transpose", default="auto", help="auto 或半音數")
+    opt.add_argument("--no-bake", action="store_true", help="不改音高，只把移調寫在 marker")
+    opt.add_argument("--velocity", type=int, default=DEFAULT_SETTINGS["velocity"], help="--thin 時低於此力度的音符丟掉")
+    opt.add_argument("--max-chord", type=int, default=0, help="--thin 時同時最多幾個鍵（0 = 不限）")
+    opt.add_argument("--thin", action="store_true", help="只留遊戲真的會按的音符")
+    args = ap.parse_args(argv)
+    if args.optimize and not args.out:
+        ap.error("--optimize 需要 --out")
+    if args.update_golden and not args.golden:
+        ap.error("--update-golden 需要 --golden")
+    if args.transpose != "auto":
+        try:
+            int(args.transpose)
+        except ValueError:
+            ap.error("--transpose 必須是 auto 或整數")
+    return args
+
 def main():
-    app = QApplication(sys.argv)
+    args = parse_args()
+    try:
+        PROFILER.enable(parse_profile_modes(args.profile))
+    except ValueError as e:
+        sys.exit(f"❌ {e}")
+    if args.simulate is not None:
+        sys.exit(simulate_cli(args))
+    if args.optimize:
+        sys.exit(optimize_cli(args))
+    if args.serve:
+        sys.exit(serve_headless(args))
+
+    app = QApplication(sys.argv[:1])
 
     try:
         app.setFont(QFont("Segoe UI", 10))
@@ -1195,4 +5968,5 @@ def main():
     sys.exit(app.exec())
 
 if __name__ == "__main__":
+    mp.freeze_support()
     main()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# 測試不開視窗、不送鍵：沒有桌面的 Linux（CI）用 Qt offscreen 與 pynput 的 dummy 後端
+if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    os.environ.setdefault("PYNPUT_BACKEND", "dummy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+MIDI_DIR = os.path.join(ROOT, "midi")
@@ -0,0 +1,34 @@
+import glob
+import os
+
+import mido
+import pytest
+
+import AutoPlayUIQT as app
+from conftest import MIDI_DIR
+
+MIDIS = sorted(glob.glob(os.path.join(MIDI_DIR, "*.mid")))
+
+
+@pytest.mark.parametrize("src", MIDIS, ids=os.path.basename)
+def test_optimize_bundled_midi(src, tmp_path):
+    """midi/ 裡每一首（含中日文檔名）都要能精簡，音軌名寫得回來、音符一個不少。"""
+    dest = str(tmp_path / os.path.basename(src))
+    stats = app.optimize_midi(src, dest, app.get_keymap(app.KEYMAP_DEFAULT))
+    assert os.listdir(tmp_path) == [os.path.basename(src)]
+    assert stats["notes_out"] == stats["notes_in"] > 0
+    index = app.load_midi_index(dest, cache=False)
+    names = {g["name"] for g in index.groups.values()}
+    assert names == {os.path.splitext(os.path.basename(src))[0]}
+
+
+def test_optimize_failed_save_leaves_no_tmp(tmp_path, monkeypatch):
+    def broken_save(self, filename=None, file=None):
+        with open(filename, "wb") as f:
+            f.write(b"MThd")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(mido.MidiFile, "save", broken_save)
+    with pytest.raises(OSError):
+        app.optimize_midi(MIDIS[0], str(tmp_path / "out.mid"), app.get_keymap(app.KEYMAP_DEFAULT))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,28 @@
+import AutoPlayUIQT as app
+
+
+def worker(songs, current):
+    w = app.PlayWorker(mode="playlist", play_list=songs, kb=object())
+    with w._cv:
+        w._select(songs.index(current))
+    return w
+
+
+def test_reorder_follows_current_song():
+    w = worker(["a", "b", "c"], "b")
+    w.set_play_list(["c", "a", "b"])
+    assert (w.idx, w.current_path) == (2, "b")
+
+
+def test_removing_current_song_plays_its_successor_next():
+    w = worker(["a", "b", "c"], "b")
+    w.set_play_list(["a", "c"])
+    with w._cv:
+        assert w._select(w.idx + 1) == "c"
+
+
+def test_removing_last_song_ends_playlist():
+    w = worker(["a", "b"], "b")
+    w.set_play_list(["a"])
+    with w._cv:
+        assert w._select(w.idx + 1) is None
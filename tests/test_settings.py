@@ -0,0 +1,17 @@
+import pytest
+
+import AutoPlayUIQT as app
+
+
+@pytest.mark.parametrize("raw, expected", [
+    (True, True), (False, False), (1, True), (0, False),
+    ("true", True), ("false", False), ("1", True), ("0", False), (" False ", False),
+])
+def test_bool_setting_parses_explicit_values(raw, expected):
+    assert app.coerce_setting("release_all_at_end", raw) is expected
+
+
+@pytest.mark.parametrize("raw", ["no", "off", "", 2, None, 0.5, [], {}])
+def test_bool_setting_rejects_anything_else(raw):
+    with pytest.raises(ValueError):
+        app.coerce_setting("isolate", raw)
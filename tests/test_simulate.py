@@ -0,0 +1,48 @@
+import glob
+import os
+
+import pytest
+
+import AutoPlayUIQT as app
+from conftest import MIDI_DIR, ROOT
+
+MIDIS = sorted(glob.glob(os.path.join(MIDI_DIR, "*.mid")))
+GOLDEN_DIR = os.path.join(ROOT, "golden")
+# 更新基準：python AutoPlayUIQT.py --simulate --set loop_playlist=false [--set ...] --golden golden/<名稱> --update-golden
+VARIANTS = {
+    "default": {},
+    "frame60-chord3": {"frame_hz": 60, "max_chord": 3},
+}
+
+
+@pytest.mark.parametrize("variant", VARIANTS)
+def test_simulate_matches_golden(variant):
+    songs, _logs, _ = app.simulate_playlist(MIDIS, dict(VARIANTS[variant], loop_playlist=False))
+    assert [path for _, path, _ in songs] == MIDIS
+    for _, path, events in songs:
+        name = os.path.basename(path)
+        with open(os.path.join(GOLDEN_DIR, variant, name + ".trace"), encoding="utf-8") as f:
+            expected = f.read()
+        assert app.format_trace(events) == expected, f"{variant}/{name} 跟 golden 不同"
+
+
+def test_simulate_stop_and_pause():
+    """停止 / 暫停走真的播放流程：暫停、停止時放開所有鍵，之後不再送鍵；同樣的腳本每次結果一樣。"""
+    song = MIDIS[0]
+    full = app.simulate_playlist([song], {"loop_playlist": False})[0][0][2]
+    actions = [(10.0, "pause"), (12.0, "resume"), (20.0, "stop")]
+    runs = [app.simulate_playlist([song], {"loop_playlist": False}, actions) for _ in range(2)]
+    assert app.format_trace(runs[0][0][0][2]) == app.format_trace(runs[1][0][0][2])
+
+    songs, logs, virtual = runs[0]
+    events = songs[0][2]
+    assert virtual == 20.0
+    assert "🛑 已停止（播放中）" in logs
+    held = set()
+    for _t, press, key in events:
+        (held.add if press else held.discard)(key)
+    assert not held
+    # 暫停前跟原本一模一樣；暫停的 2 秒裡沒有按鍵
+    before = [e for e in events if e[0] < 10.0]
+    assert before == [e for e in full if e[0] < 10.0]
+    assert not [e for e in events if 10.0 < e[0] < 12.0 and e[1]]
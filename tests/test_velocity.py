@@ -0,0 +1,34 @@
+import AutoPlayUIQT as app
+
+
+def hist(**counts):
+    h = [0] * 128
+    for v, c in counts.items():
+        h[int(v[1:])] = c
+    return h
+
+
+def test_share_never_drops_more_than_half():
+    h = hist(v20=300, v60=300, v100=400)
+    assert app.pick_velocity_threshold(h, 10, "share", share=10) == (21, 700, 1000)
+    assert app.pick_velocity_threshold(h, 10, "share", share=70) == (21, 700, 1000)
+    assert app.pick_velocity_threshold(h, 10, "share", share=90) == (1, 1000, 1000)
+
+
+def test_rate_stops_at_target_or_half():
+    h = hist(v20=250, v60=250, v100=500)
+    assert app.pick_velocity_threshold(h, 10, "rate", rate=60) == (61, 500, 1000)
+    assert app.pick_velocity_threshold(h, 10, "rate", rate=10) == (61, 500, 1000)
+    assert app.pick_velocity_threshold(h, 10, "rate", rate=200) == (1, 1000, 1000)
+
+
+def test_flat_velocities_are_left_alone():
+    h = hist(v100=1000)
+    for mode in ("rate", "share"):
+        assert app.pick_velocity_threshold(h, 10, mode, rate=1, share=10) == (1, 1000, 1000)
+
+
+def test_manual_floor_wins():
+    h = hist(v20=500, v80=500)
+    assert app.pick_velocity_threshold(h, 10, "share", share=50, floor=90) == (90, 0, 1000)
+    assert app.pick_velocity_threshold(h, 10, "fixed", floor=30) == (30, 500, 1000)